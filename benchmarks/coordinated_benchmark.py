@@ -0,0 +1,130 @@
+"""Loads the same data with 1, 2, 4, ... coordinated loader processes against one local postgres.
+
+Every run recreates the sparkify database (SPARKIFY_DSN / SPARKIFY_ADMIN_DSN, see src/db.py)
+and starts the loaders with `etl.py --coordinate`. With `--kill-after`, one loader is killed
+with SIGKILL during the run, its chunk is claimed again when its lease has expired. The
+row counts must be the same in every run:
+
+    python3 benchmarks/coordinated_benchmark.py --events 200000 --songs 10000 --loaders 1 2 4 \\
+        --chunk-size-mb 1 --kill-after 5 --output coordinated.json
+"""
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+from run_benchmark import SRC_PATH, count_rows, get_commit, reset_database
+from generate_data import generate
+from db import connect
+from work_queue import WorkQueue
+
+
+def run(num_loaders: int, data_path: str, chunk_size_mb: float, lease_seconds: float, load_mode: str,
+        kill_after: float = None) -> dict:
+    """Runs `num_loaders` coordinated loaders in fresh processes and waits for all of them.
+
+    Args:
+        num_loaders (int): The number of loader processes.
+        data_path (str): The directory that contains "song_data" and "log_data".
+        chunk_size_mb (float): The target size of the chunks of the queue.
+        lease_seconds (float): The lease of the loaders, a killed loader's chunk waits this long.
+        load_mode (str): The load mode of the loaders.
+        kill_after (float): If given, the first loader is killed after this many seconds.
+
+    Returns:
+        dict: The results of the run.
+    """
+    reset_database()
+
+    env = dict(os.environ, PYTHONPATH=SRC_PATH + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    command = [sys.executable, os.path.join(SRC_PATH, 'etl.py'), '--coordinate', '--data-path', data_path,
+               '--unit-size-mb', str(chunk_size_mb), '--lease-seconds', str(lease_seconds),
+               '--load-mode', load_mode]
+    start = time.perf_counter()
+    processes = [subprocess.Popen(command + ['--worker-name', f'loader-{i}'], cwd=SRC_PATH, env=env,
+                                  stdout=subprocess.DEVNULL)
+                 for i in range(num_loaders)]
+    killed = False
+    if kill_after is not None:
+        try:
+            processes[0].wait(kill_after)
+        except subprocess.TimeoutExpired:
+            processes[0].send_signal(signal.SIGKILL)
+            killed = True
+    exit_codes = [process.wait() for process in processes]
+    seconds = time.perf_counter() - start
+    # the killed loader exits with -SIGKILL
+    if any(exit_code != 0 for i, exit_code in enumerate(exit_codes) if not (killed and i == 0)):
+        raise RuntimeError(f'A loader failed, the exit codes are {exit_codes}.')
+
+    conn = connect()
+    queue_status = WorkQueue(conn, data_path).get_status()
+    conn.close()
+    rows = count_rows()
+    return {'loaders': num_loaders,
+            'killed': killed,
+            'seconds': seconds,
+            'rows': rows,
+            'rows_per_second': {table: num_rows / seconds for table, num_rows in rows.items()},
+            'chunks': [{'dataset': dataset, 'status': status, 'chunks': num_chunks, 'max_attempts': max_attempts}
+                       for dataset, status, num_chunks, _, max_attempts in queue_status]}
+
+
+def main(loader_counts: list, num_events: int, num_songs: int, match_rate: float, seed: int, output: str,
+         data_path: str = None, chunk_size_mb: float = 1, lease_seconds: float = 10, load_mode: str = 'values',
+         kill_after: float = None) -> dict:
+    """Generates the data (unless `data_path` is given), runs every loader count and writes the results."""
+    params = {'events': num_events, 'songs': num_songs, 'match_rate': match_rate, 'seed': seed,
+              'chunk_size_mb': chunk_size_mb, 'lease_seconds': lease_seconds, 'load_mode': load_mode,
+              'kill_after': kill_after}
+    if data_path is None:
+        data_path = tempfile.mkdtemp(prefix='sparkify_benchmark_')
+        print(f'Generating data in {data_path}: {params}')
+        generate(data_path, num_events, num_songs, match_rate, seed)
+
+    results = {'commit': get_commit(),
+               'created_at': datetime.now().isoformat(timespec='seconds'),
+               'params': params,
+               'data_path': data_path,
+               'runs': []}
+    for num_loaders in loader_counts:
+        print(f'Running {num_loaders} loaders')
+        result = run(num_loaders, data_path, chunk_size_mb, lease_seconds, load_mode, kill_after)
+        speedup = results['runs'][0]['seconds'] / result['seconds'] if results['runs'] else 1.0
+        print(f'  {result["seconds"]:.2f} seconds ({speedup:.2f}x), {result["rows"]}, {result["chunks"]}')
+        if results['runs'] and result['rows'] != results['runs'][0]['rows']:
+            print('  The row counts differ from the first run!')
+        results['runs'].append(result)
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {output}')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks coordinated loaders on synthetic data.')
+    parser.add_argument('--loaders', type=int, nargs='+', default=[1, 2, 4],
+                        help='The numbers of loader processes to run.')
+    parser.add_argument('--events', type=int, default=10000, help='The number of log events.')
+    parser.add_argument('--songs', type=int, default=1000, help='The number of songs.')
+    parser.add_argument('--match-rate', type=float, default=0.5,
+                        help='The share of NextSong events that match a song.')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the random generator.')
+    parser.add_argument('--data-path', default=None,
+                        help='Use existing data instead of generating it.')
+    parser.add_argument('--chunk-size-mb', type=float, default=1, help='The target size of a chunk.')
+    parser.add_argument('--lease-seconds', type=float, default=10, help='The lease of the loaders.')
+    parser.add_argument('--load-mode', default='values', help='The load mode of the loaders.')
+    parser.add_argument('--kill-after', type=float, default=None,
+                        help='Kill one loader of every run with SIGKILL after this many seconds.')
+    parser.add_argument('--output', default='coordinated_results.json', help='The json file for the results.')
+    args = parser.parse_args()
+
+    main(args.loaders, args.events, args.songs, args.match_rate, args.seed, args.output, args.data_path,
+         args.chunk_size_mb, args.lease_seconds, args.load_mode, args.kill_after)
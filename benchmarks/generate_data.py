@@ -0,0 +1,160 @@
+"""Generates synthetic Sparkify data in the layout and the schema of the files in `data/`.
+
+    python3 benchmarks/generate_data.py --events 100000 --songs 10000 --match-rate 0.3 /tmp/sparkify_data
+"""
+import os
+import json
+import math
+import random
+import string
+import argparse
+from datetime import datetime, timedelta
+
+
+LETTERS = string.ascii_uppercase
+ID_CHARACTERS = string.ascii_uppercase + string.digits
+NON_SONG_PAGES = ['Home', 'Logout', 'Settings', 'Help', 'About']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'New York-Newark-Jersey City, NY-NJ-PA',
+             'Chicago-Naperville-Elgin, IL-IN-WI', 'Atlanta-Sandy Springs-Roswell, GA',
+             'Portland-South Portland, ME', 'Lansing-East Lansing, MI']
+USER_AGENTS = ['"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) '
+               'Chrome/36.0.1985.143 Safari/537.36"',
+               '"Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0"',
+               '"Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) '
+               'Chrome/36.0.1985.143 Safari/537.36"',
+               '"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 '
+               '(KHTML, like Gecko) Version/7.0 Mobile/11D257 Safari/9537.53"']
+FIRST_NAMES = ['Walter', 'Kaylee', 'Ryan', 'Jayden', 'Lily', 'Jacob', 'Layla', 'Tegan', 'Mohammad', 'Chloe']
+LAST_NAMES = ['Frye', 'Summers', 'Smith', 'Bell', 'Koch', 'Klein', 'Griffin', 'Levine', 'Rodriguez', 'Cuevas']
+
+
+def get_id(prefix: str, index: int, rng: random.Random) -> str:
+    """Returns an id like the ones of the original data, e.g. "TRAAAAW128F429D538".
+
+    The three characters after the prefix are derived from the index, so that the files are
+    spread over the nested A/B/C directories like in `data/song_data`.
+    """
+    letters = ''.join(LETTERS[(index // 26 ** position) % 26] for position in range(3))
+    return prefix + letters + ''.join(rng.choice(ID_CHARACTERS) for _ in range(13))
+
+
+def generate_songs(num_songs: int, rng: random.Random) -> list:
+    """Returns the records of the song files, one song per file like in the original data."""
+    num_artists = max(1, num_songs // 3)
+    artists = [{'artist_id': get_id('AR', index, rng),
+                'artist_name': f'Artist {index}',
+                'artist_location': rng.choice(LOCATIONS + ['']),
+                'artist_latitude': round(rng.uniform(-90, 90), 5) if rng.random() < 0.4 else None,
+                'artist_longitude': round(rng.uniform(-180, 180), 5) if rng.random() < 0.4 else None}
+               for index in range(num_artists)]
+
+    songs = []
+    for index in range(num_songs):
+        song = {'num_songs': 1}
+        song.update(rng.choice(artists))
+        song.update({'song_id': get_id('SO', index, rng),
+                     'title': f'Song {index}',
+                     'duration': round(rng.uniform(60, 600), 5),
+                     'year': rng.choice([0] + list(range(1960, 2011)))})
+        songs.append((get_id('TR', index, rng), song))
+    return songs
+
+
+def write_song_data(songs: list, data_path: str) -> None:
+    """Writes every song to song_data/<A>/<B>/<C>/<track id>.json."""
+    for track_id, song in songs:
+        directory = os.path.join(data_path, 'song_data', track_id[2], track_id[3], track_id[4])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f'{track_id}.json'), 'w') as f:
+            f.write(json.dumps(song))
+
+
+def generate_event(ts: int, user: dict, session_id: int, item: int, songs: list, match_rate: float,
+                   rng: random.Random, next_song_rate: float = 0.8) -> dict:
+    """Returns one event of a log file. `match_rate` of the NextSong events match a song."""
+    event = {'artist': None, 'auth': 'Logged In', 'firstName': user['firstName'], 'gender': user['gender'],
+             'itemInSession': item, 'lastName': user['lastName'], 'length': None, 'level': user['level'],
+             'location': user['location'], 'method': 'GET', 'page': rng.choice(NON_SONG_PAGES),
+             'registration': user['registration'], 'sessionId': session_id, 'song': None, 'status': 200,
+             'ts': ts, 'userAgent': user['userAgent'], 'userId': str(user['userId'])}
+
+    if rng.random() < next_song_rate:
+        event['method'] = 'PUT'
+        event['page'] = 'NextSong'
+        if songs and rng.random() < match_rate:
+            song = rng.choice(songs)[1]
+            event.update({'artist': song['artist_name'], 'song': song['title'], 'length': song['duration']})
+        else:
+            event.update({'artist': f'Unknown Artist {rng.randrange(1000)}',
+                          'song': f'Unknown Song {rng.randrange(100000)}',
+                          'length': round(rng.uniform(60, 600), 5)})
+    return event
+
+
+def write_log_data(num_events: int, songs: list, data_path: str, match_rate: float, rng: random.Random,
+                   num_users: int = 100, events_per_file: int = 10000) -> None:
+    """Writes the events to daily files log_data/<year>/<month>/<date>-events.json."""
+    users = [{'userId': index + 1,
+              'firstName': rng.choice(FIRST_NAMES),
+              'lastName': rng.choice(LAST_NAMES),
+              'gender': rng.choice(['F', 'M']),
+              'level': rng.choice(['free', 'paid']),
+              'location': rng.choice(LOCATIONS),
+              'userAgent': rng.choice(USER_AGENTS),
+              'registration': 1540919166796.0}
+             for index in range(num_users)]
+
+    num_files = max(1, math.ceil(num_events / events_per_file))
+    first_day = datetime(2018, 11, 1)
+    session_id = 0
+    for day_index in range(num_files):
+        day = first_day + timedelta(days=day_index)
+        directory = os.path.join(data_path, 'log_data', f'{day:%Y}', f'{day:%m}')
+        os.makedirs(directory, exist_ok=True)
+
+        num_day_events = min(events_per_file, num_events - day_index * events_per_file)
+        day_start_ms = int(day.timestamp() * 1000)
+        timestamps = sorted(day_start_ms + rng.randrange(24 * 3600 * 1000) for _ in range(num_day_events))
+
+        with open(os.path.join(directory, f'{day:%Y-%m-%d}-events.json'), 'w') as f:
+            for item, ts in enumerate(timestamps):
+                if item % 20 == 0:
+                    session_id += 1
+                user = rng.choice(users)
+                # some users upgrade from free to paid
+                if user['level'] == 'free' and rng.random() < 0.001:
+                    user['level'] = 'paid'
+                event = generate_event(ts, user, session_id, item % 20, songs, match_rate, rng)
+                f.write(json.dumps(event, separators=(',', ':')) + '\n')
+
+
+def generate(data_path: str, num_events: int, num_songs: int, match_rate: float, seed: int = 0,
+             events_per_file: int = 10000) -> None:
+    """Generates song_data and log_data below `data_path`.
+
+    Args:
+        data_path (str): The directory that will contain "song_data" and "log_data".
+        num_events (int): The number of events in the log files (NextSong and other pages).
+        num_songs (int): The number of song files.
+        match_rate (float): The share of NextSong events that match a song of song_data.
+        seed (int): The seed of the random generator, the same seed generates the same files.
+        events_per_file (int): The number of events per (daily) log file.
+    """
+    rng = random.Random(seed)
+    songs = generate_songs(num_songs, rng)
+    write_song_data(songs, data_path)
+    write_log_data(num_events, songs, data_path, match_rate, rng, events_per_file=events_per_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates synthetic song_data and log_data.')
+    parser.add_argument('data_path', help='The directory that will contain "song_data" and "log_data".')
+    parser.add_argument('--events', type=int, default=10000, help='The number of log events.')
+    parser.add_argument('--songs', type=int, default=1000, help='The number of songs.')
+    parser.add_argument('--match-rate', type=float, default=0.5,
+                        help='The share of NextSong events that match a song.')
+    parser.add_argument('--events-per-file', type=int, default=10000, help='The number of events per log file.')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the random generator.')
+    args = parser.parse_args()
+
+    generate(args.data_path, args.events, args.songs, args.match_rate, args.seed, args.events_per_file)
@@ -0,0 +1,112 @@
+"""Checks that `etl.py --incremental` never loads a log file twice, against a throwaway postgres.
+
+The sparkify database is recreated (SPARKIFY_DSN / SPARKIFY_ADMIN_DSN, see src/db.py), so never
+point it at a database with data you want to keep. The data is copied to a temporary directory,
+because its log files are touched and changed:
+
+    python3 benchmarks/incremental_check.py --data-path data
+
+1. A full load (without --incremental) records the files in the manifest.
+2. An incremental run right after it loads nothing.
+3. An incremental run after a log file has been touched loads nothing.
+4. An incremental run after a log file has been changed skips it.
+5. An incremental run after a new log file has been added loads exactly its songplays.
+
+The row counts of all tables and the plays of the rollups are compared after every step.
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from run_benchmark import SRC_PATH, count_rows, reset_database
+from db import connect
+from sql_queries import rollup_properties
+
+
+def run_etl(data_path: str, *etl_args: str) -> None:
+    """Runs etl.py in a fresh process and raises if it fails."""
+    env = dict(os.environ, PYTHONPATH=SRC_PATH + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    subprocess.run([sys.executable, os.path.join(SRC_PATH, 'etl.py'), '--data-path', data_path, *etl_args],
+                   cwd=SRC_PATH, env=env, stdout=subprocess.DEVNULL, check=True)
+
+
+def get_state() -> dict:
+    """Returns the row counts of all tables and the sum of the plays of every rollup."""
+    state = count_rows()
+    conn = connect()
+    cur = conn.cursor()
+    for properties in rollup_properties:
+        cur.execute(f'SELECT COALESCE(SUM(plays), 0) FROM {properties.table_name};')
+        state[f'{properties.table_name}.plays'] = int(cur.fetchone()[0])
+    conn.close()
+    return state
+
+
+def get_loaded_songplays(filepath: str) -> int:
+    """Returns the number of songplays that the manifest has recorded for a file."""
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute('SELECT row_counts FROM load_manifest WHERE filepath = %s;', (filepath,))
+    row_counts = cur.fetchone()[0]
+    conn.close()
+    return row_counts['songplays']
+
+
+def check(step: str, expected: dict) -> dict:
+    """Compares the current state with the expected one, raises if they differ."""
+    state = get_state()
+    if state != expected:
+        differences = {key: (expected.get(key), state.get(key)) for key in state if state.get(key) != expected.get(key)}
+        raise AssertionError(f'{step}: expected != actual {json.dumps(differences)}')
+    print(f'{step}: ok')
+    return state
+
+
+def main(data_path: str) -> None:
+    """Runs the steps of the module docstring on a copy of the data."""
+    work_path = os.path.join(tempfile.mkdtemp(prefix='sparkify_incremental_'), 'data')
+    shutil.copytree(data_path, work_path)
+    log_files = sorted(os.path.join(root, name) for root, _, names in os.walk(os.path.join(work_path, 'log_data'))
+                       for name in names if name.endswith('.json'))
+
+    reset_database()
+    run_etl(work_path)
+    expected = get_state()
+    print(f'full load: {expected}')
+
+    run_etl(work_path, '--incremental')
+    check('incremental run after a full load', expected)
+
+    os.utime(log_files[0])
+    run_etl(work_path, '--incremental')
+    check('touched log file', expected)
+
+    with open(log_files[0], 'a') as f:
+        f.write('\n')
+    run_etl(work_path, '--incremental')
+    check('changed log file', expected)
+
+    new_file = os.path.join(os.path.dirname(log_files[1]), 'copy-' + os.path.basename(log_files[1]))
+    shutil.copyfile(log_files[1], new_file)
+    num_songplays = get_loaded_songplays(os.path.abspath(log_files[1]))
+    run_etl(work_path, '--incremental')
+    state = get_state()
+    if state['songplays'] != expected['songplays'] + num_songplays:
+        raise AssertionError(f'new log file: expected {expected["songplays"] + num_songplays} songplays, '
+                             f'got {state["songplays"]}')
+    print('new log file: ok')
+
+    shutil.rmtree(os.path.dirname(work_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks that incremental runs never load a log file twice.')
+    parser.add_argument('--data-path', default='data',
+                        help='The directory that contains "song_data" and "log_data", it is copied.')
+    args = parser.parse_args()
+
+    main(os.path.abspath(args.data_path))
@@ -0,0 +1,146 @@
+"""Runs the ETL scripts against synthetic data and a throwaway postgres database.
+
+Every run recreates the sparkify database (SPARKIFY_DSN / SPARKIFY_ADMIN_DSN, see src/db.py),
+so never point it at a database with data you want to keep. The results are written as json,
+so that they can be diffed between commits:
+
+    python3 benchmarks/run_benchmark.py --events 100000 --songs 10000 --output results.json \\
+        --run "etl.py --load-mode rows" --run "etl.py --load-mode copy" --run "etl_david.py --load-mode copy"
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+SRC_PATH = os.path.join(os.path.dirname(BENCHMARKS_PATH), 'src')
+sys.path.insert(0, SRC_PATH)
+
+from generate_data import generate
+from create_tables import create_database, create_tables
+from db import connect
+from sql_queries import table_properties
+
+
+DEFAULT_RUNS = ['etl.py --load-mode rows', 'etl.py --load-mode values', 'etl.py --load-mode copy',
+                'etl_david.py --load-mode rows', 'etl_david.py --load-mode copy']
+
+
+def get_commit() -> str:
+    """Returns the git commit of the repository or None outside of a git repository."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS_PATH,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def reset_database() -> None:
+    """Recreates the sparkify database with empty tables."""
+    cur, conn = create_database()
+    create_tables(cur, conn)
+    conn.close()
+
+
+def count_rows() -> dict:
+    """Returns the number of rows of every table."""
+    conn = connect()
+    cur = conn.cursor()
+    row_counts = {}
+    for properties in table_properties:
+        cur.execute(f'SELECT COUNT(*) FROM {properties.table_name};')
+        row_counts[properties.table_name] = cur.fetchone()[0]
+    conn.close()
+    return row_counts
+
+
+def run(command: str, data_path: str) -> dict:
+    """Runs one ETL script in a fresh process and measures time, peak RSS, rows and stages.
+
+    Args:
+        command (str): The script in src/ and its arguments, e.g. "etl.py --load-mode copy".
+        data_path (str): The directory that contains "song_data" and "log_data".
+
+    Returns:
+        dict: The results of the run.
+    """
+    reset_database()
+
+    script, *script_args = shlex.split(command)
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as metrics_file:
+        metrics_path = metrics_file.name
+    env = dict(os.environ, PYTHONPATH=SRC_PATH + os.pathsep + os.environ.get('PYTHONPATH', ''))
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(SRC_PATH, script), *script_args,
+                                '--data-path', data_path, '--metrics-file', metrics_path],
+                               cwd=SRC_PATH, env=env, stdout=subprocess.DEVNULL)
+    # wait4 returns the resource usage of exactly this child process
+    _, status, rusage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f'"{command}" failed with exit code {process.returncode}.')
+
+    with open(metrics_path) as f:
+        stages = json.load(f)
+    os.remove(metrics_path)
+
+    rows = count_rows()
+    # ru_maxrss is in bytes on macOS and in kilobytes on linux
+    peak_rss_mb = rusage.ru_maxrss / 1024 ** 2 if sys.platform == 'darwin' else rusage.ru_maxrss / 1024
+    return {'command': command,
+            'seconds': seconds,
+            'peak_rss_mb': peak_rss_mb,
+            'rows': rows,
+            'rows_per_second': {table: num_rows / seconds for table, num_rows in rows.items()},
+            'stages': stages}
+
+
+def main(runs: list, num_events: int, num_songs: int, match_rate: float, seed: int, output: str,
+         data_path: str = None) -> dict:
+    """Generates the data (unless `data_path` is given), runs every ETL script and writes the results."""
+    params = {'events': num_events, 'songs': num_songs, 'match_rate': match_rate, 'seed': seed}
+    if data_path is None:
+        data_path = tempfile.mkdtemp(prefix='sparkify_benchmark_')
+        print(f'Generating data in {data_path}: {params}')
+        generate(data_path, num_events, num_songs, match_rate, seed)
+
+    results = {'commit': get_commit(),
+               'created_at': datetime.now().isoformat(timespec='seconds'),
+               'params': params,
+               'data_path': data_path,
+               'runs': []}
+    for command in runs:
+        print(f'Running "{command}"')
+        result = run(command, data_path)
+        print(f'  {result["seconds"]:.2f} seconds, {result["peak_rss_mb"]:.1f} MB peak RSS, {result["rows"]}')
+        results['runs'].append(result)
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {output}')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the ETL scripts on synthetic data.')
+    parser.add_argument('--events', type=int, default=10000, help='The number of log events.')
+    parser.add_argument('--songs', type=int, default=1000, help='The number of songs.')
+    parser.add_argument('--match-rate', type=float, default=0.5,
+                        help='The share of NextSong events that match a song.')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the random generator.')
+    parser.add_argument('--data-path', default=None,
+                        help='Use existing data instead of generating it.')
+    parser.add_argument('--run', action='append', dest='runs',
+                        help=f'A script in src/ and its arguments (repeatable), default: {DEFAULT_RUNS}')
+    parser.add_argument('--output', default='benchmark_results.json', help='The json file for the results.')
+    args = parser.parse_args()
+
+    main(args.runs or DEFAULT_RUNS, args.events, args.songs, args.match_rate, args.seed, args.output,
+         args.data_path)
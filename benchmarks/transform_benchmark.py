@@ -0,0 +1,115 @@
+"""Measures the cost per log event of the transformation, without a database.
+
+Compares the original per-row path (`iterrows`, a `pd.Series` per event, label indexing) with
+the column path of `transform.py`, `song_lookup.py` and `bulk_load.iter_records` that builds
+ready-to-write tuples. Both paths resolve the songs in memory, so only the CPU cost is measured.
+It also compares parsing the log files with `pd.read_json` and with the typed decoder of
+`typed_json.py` that only decodes the fields of LOG_DATA_SCHEMA:
+
+    python3 benchmarks/transform_benchmark.py --data-path data --repeat 3
+"""
+import os
+import sys
+import time
+import argparse
+
+import pandas as pd
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+SRC_PATH = os.path.join(os.path.dirname(BENCHMARKS_PATH), 'src')
+sys.path.insert(0, SRC_PATH)
+
+from bulk_load import iter_records
+from discovery import iter_files
+from parallel_extract import read_json_lines
+from song_lookup import SongLookup, get_songplays
+from transform import transform_log_data
+from typed_json import LOG_DATA_SCHEMA, SONG_DATA_SCHEMA
+
+
+def transform_rows(df_log: pd.DataFrame, songs: dict) -> list:
+    """The original path of `etl.process_log_file`, with a dict instead of `song_select`."""
+    records = []
+    df_log = df_log[df_log['page'] == 'NextSong']
+
+    t = pd.to_datetime(df_log['ts'], unit='ms')
+    time_data = [t, t.dt.hour, t.dt.day, t.dt.isocalendar().week, t.dt.month, t.dt.year, t.dt.weekday]
+    df_time = pd.DataFrame(dict(zip(['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday'], time_data)))
+    for i, row in df_time.iterrows():
+        records.append(list(row))
+
+    df_users = df_log[['userId', 'firstName', 'lastName', 'gender', 'level']]
+    for i, row in df_users.iterrows():
+        records.append(list(row))
+
+    for index, row in df_log.iterrows():
+        song_id, artist_id = songs.get((row.song, row.artist, row.length), (None, None))
+        ids = pd.Series([song_id, artist_id], index=['song_id', 'artist_id'])
+        # "row.append(ids)" of the original code, which has been removed in pandas 2
+        enriched_row = pd.concat([row, ids])
+        songplay_data = enriched_row[['ts', 'userId', 'level', 'song_id', 'artist_id',
+                                      'sessionId', 'location', 'userAgent']]
+        records.append(list(songplay_data))
+    return records
+
+
+def transform_columns(df_log: pd.DataFrame, song_lookup: SongLookup) -> list:
+    """The column path: vectorized transformation and tuples zipped from the columns."""
+    log_data = transform_log_data(df_log)
+    df_songplays = get_songplays(log_data['events'], song_lookup)
+    records = []
+    for df in (log_data['time'], log_data['users'], df_songplays):
+        records.extend(iter_records(df))
+    return records
+
+
+def measure(transformer, items: list, repeat: int) -> float:
+    """Returns the best time of `repeat` runs of the transformer over all items (DataFrames or files)."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            transformer(item)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(data_path: str, repeat: int) -> None:
+    df_songs = pd.concat([read_json_lines(file_info.path, SONG_DATA_SCHEMA)
+                          for file_info in iter_files(os.path.join(data_path, 'song_data'))], ignore_index=True)
+    songs = {(title, name, duration): (song_id, artist_id) for song_id, artist_id, title, name, duration
+             in df_songs[['song_id', 'artist_id', 'title', 'artist_name', 'duration']].itertuples(index=False)}
+    song_lookup = SongLookup.from_song_data(df_songs)
+
+    log_files = [file_info.path for file_info in iter_files(os.path.join(data_path, 'log_data'))]
+    dfs = [read_json_lines(filepath, LOG_DATA_SCHEMA) for filepath in log_files]
+    num_events = sum(int((df['page'] == 'NextSong').sum()) for df in dfs)
+    num_lines = sum(len(df.index) for df in dfs)
+
+    seconds_inferred = measure(read_json_lines, log_files, repeat)
+    seconds_typed = measure(lambda filepath: read_json_lines(filepath, LOG_DATA_SCHEMA), log_files, repeat)
+
+    seconds_rows = measure(lambda df: transform_rows(df, songs), dfs, repeat)
+    seconds_columns = measure(lambda df: transform_columns(df, song_lookup), dfs, repeat)
+    song_lookup.close()
+
+    print(f'{num_events} NextSong events in {len(dfs)} files')
+    print(f'{"path":<10}{"seconds":>10}{"us/event":>10}')
+    for name, seconds in (('rows', seconds_rows), ('columns', seconds_columns)):
+        print(f'{name:<10}{seconds:>10.3f}{seconds / num_events * 1e6:>10.1f}')
+    print(f'speedup: {seconds_rows / seconds_columns:.1f}x')
+
+    print(f'{num_lines} lines in {len(log_files)} files')
+    print(f'{"parser":<10}{"seconds":>10}{"us/line":>10}')
+    for name, seconds in (('inferred', seconds_inferred), ('typed', seconds_typed)):
+        print(f'{name:<10}{seconds:>10.3f}{seconds / num_lines * 1e6:>10.1f}')
+    print(f'speedup: {seconds_inferred / seconds_typed:.1f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures the transformation cost per log event.')
+    parser.add_argument('--data-path', default='data', help='The directory that contains "song_data" and "log_data".')
+    parser.add_argument('--repeat', type=int, default=3, help='The number of runs, the best one is reported.')
+    args = parser.parse_args()
+
+    main(args.data_path, args.repeat)
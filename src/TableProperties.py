@@ -1,10 +1,93 @@
 import re
-from typing import List
+import copy
+from datetime import datetime, timezone
+from typing import Dict, List
+
+
+class Constraint:
+    """A primary key or foreign key constraint of a table."""
+    def __init__(self, name: str, kind: str, column: str, definition: str):
+        """Instantiate a constraint.
+
+        Args:
+            name (str): The name of the constraint, e.g. "songplays_user_id_fkey".
+            kind (str): Either "primary key" or "foreign key".
+            column (str): The column that the constraint is defined on.
+            definition (str): E.g. "FOREIGN KEY (user_id) REFERENCES users(user_id)".
+        """
+        self.name = name
+        self.kind = kind
+        self.column = column
+        self.definition = definition
+
+    def get_query_add(self, table_name: str) -> str:
+        """Creates the query that adds the constraint to an existing table."""
+        return f'ALTER TABLE {table_name} ADD CONSTRAINT {self.name} {self.definition};'
+
+    def get_query_drop(self, table_name: str) -> str:
+        """Creates the query that drops the constraint."""
+        return f'ALTER TABLE {table_name} DROP CONSTRAINT IF EXISTS {self.name};'
+
+
+class Index:
+    """A secondary index of a table, e.g. on the lookup columns of `song_select`."""
+    def __init__(self, name: str, columns: List[str], unique: bool = False):
+        """Instantiate an index.
+
+        Args:
+            name (str): The name of the index, e.g. "songs_title_duration_idx".
+            columns (List[str]): The indexed columns, in order.
+            unique (bool): Whether the index is unique.
+        """
+        self.name = name
+        self.columns = columns
+        self.unique = unique
+
+    def get_query_create(self, table_name: str) -> str:
+        """Creates the query "create index"."""
+        unique = 'UNIQUE ' if self.unique else ''
+        return f'CREATE {unique}INDEX IF NOT EXISTS {self.name} ON {table_name} ({", ".join(self.columns)});'
+
+    def get_query_drop(self) -> str:
+        """Creates the query "drop index"."""
+        return f'DROP INDEX IF EXISTS {self.name};'
+
+
+class MonthlyPartitioning:
+    """Declarative range partitioning by month on a column with epoch milliseconds (e.g. start_time)."""
+    def __init__(self, column: str):
+        """Instantiate a partitioning.
+
+        Args:
+            column (str): The partition key, a BIGINT column with milliseconds since epoch.
+        """
+        self.column = column
+
+    @staticmethod
+    def get_month_bounds(month: str) -> tuple:
+        """Returns the first millisecond of a month ("2018_11") and of the next month."""
+        year, month = map(int, month.split('_'))
+        start = datetime(year, month, 1, tzinfo=timezone.utc)
+        end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+        return int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+
+    def get_partition_name(self, table_name: str, month: str) -> str:
+        """Returns the name of the partition of a month, e.g. "songplays_2018_11"."""
+        return f'{table_name}_{month}'
+
+    def get_query_create_partition(self, table_name: str, month: str) -> str:
+        """Creates the query that creates the partition of a month if it does not exist."""
+        start, end = self.get_month_bounds(month)
+        return (f'CREATE TABLE IF NOT EXISTS {self.get_partition_name(table_name, month)} '
+                f'PARTITION OF {table_name} FOR VALUES FROM ({start}) TO ({end});')
 
 
 class TableProperties:
     """Class that holds configuration / properties of the tables."""
-    def __init__(self, table_name: str, table_properties: List[tuple]):
+    def __init__(self, table_name: str, table_properties: List[tuple], indexes: List[Index] = None,
+                 update_columns: List[str] = None, partitioning: MonthlyPartitioning = None,
+                 key_columns: List[str] = None, accumulate_columns: List[str] = None,
+                 dictionaries: Dict[str, 'TableProperties'] = None, version_column: str = None):
         """Instantiate an object that holds properties / configuration of a table.
 
         Args:
@@ -12,35 +95,186 @@ class TableProperties:
             table_properties List[tuple]:
               A list of tuples that contain two values. The first value is the column, the second value is the
               configuration for that column. An example of one tuple might be: ('user_id', 'int primary key')
+            indexes (List[Index]): Secondary indexes of the table.
+            update_columns (List[str]):
+              The columns that are updated if a row with the same primary key exists already
+              ("ON CONFLICT ... DO UPDATE SET"). None means that such a row is kept ("DO NOTHING").
+            partitioning (MonthlyPartitioning):
+              If given, the table is partitioned by range and its primary key includes the
+              partition key, because postgres enforces unique constraints per partition.
+            key_columns (List[str]):
+              A primary key over several columns, e.g. ['song_id', 'day']. It is created as a
+              table constraint and is the conflict target of the inserts.
+            accumulate_columns (List[str]):
+              The columns that are added up if a row with the same key exists already
+              ("ON CONFLICT ... DO UPDATE SET plays = t.plays + EXCLUDED.plays"), e.g. counters.
+            dictionaries (Dict[str, TableProperties]):
+              Dictionary-encoded columns and their dictionary tables, e.g. {'user_agent_id':
+              user_agents_properties}. The column holds the primary key of the dictionary, whose
+              only insert column holds the value. See `get_query_create_view`.
+            version_column (str):
+              A column that orders the versions of a row, e.g. the time of the event it comes from.
+              It is updated with the update columns, but only if the new version is newer, so
+              concurrent loaders can write the versions of a row in any order.
         """
         self.table_name = table_name
         self.columns = [table_property[0] for table_property in table_properties]
         self.data_types = [table_property[1] for table_property in table_properties]
+        self.indexes = indexes or []
+        self.update_columns = update_columns
+        self.partitioning = partitioning
+        self.key_columns = key_columns
+        self.accumulate_columns = accumulate_columns
+        self.dictionaries = dictionaries or {}
+        self.version_column = version_column
         self.validate()
+        self.primary_key = self.get_primary_key()
+        self.insert_columns = self.get_insert_columns()
+        self.constraints = self.get_constraints()
+        self.deferred_constraints = self.get_deferred_constraints()
+        self.staging_table_name = f'staging_{self.table_name}'
         self.create_statements = self.concat_cols_with_types()
         self.queries = {'create_table': self.get_query_create_table(),
+                        'create_table_deferred': self.get_query_create_table(deferred=True),
+                        'create_table_unlogged': self.get_query_create_table(deferred=True, unlogged=True),
+                        'add_deferred_constraints': [constraint.get_query_add(self.table_name)
+                                                     for constraint in self.deferred_constraints],
+                        'drop_deferred_constraints': [constraint.get_query_drop(self.table_name)
+                                                      for constraint in self.deferred_constraints],
+                        'create_indexes': [index.get_query_create(self.table_name) for index in self.indexes],
+                        'drop_indexes': [index.get_query_drop() for index in self.indexes],
                         'drop_table': f'DROP TABLE IF EXISTS {self.table_name};',
                         'insert_into': self.get_query_insert_into(),
-                        'select': f'SELECT {", ".join(self.columns)} FROM {self.table_name};'}
+                        'insert_values': self.get_query_insert_values(),
+                        'select': f'SELECT {", ".join(self.columns)} FROM {self.table_name};',
+                        'create_staging': self.get_query_create_staging(),
+                        'truncate_staging': f'TRUNCATE {self.staging_table_name};',
+                        'copy_into_staging': self.get_query_copy_into_staging(),
+                        'merge_from_staging': self.get_query_merge_from_staging()}
 
     def validate(self):
         """Check if columns and configuration are equally long."""
         if len(self.columns) != len(self.data_types):
             raise ValueError('Make sure that columns and data_types are equally long.')
+        for kind, columns in [('update', self.update_columns), ('key', self.key_columns),
+                              ('accumulate', self.accumulate_columns)]:
+            unknown_columns = set(columns or []) - set(self.columns)
+            if unknown_columns:
+                raise ValueError(f'The {kind} columns {sorted(unknown_columns)} are not columns of {self.table_name}.')
+        for column, dictionary in self.dictionaries.items():
+            if column not in self.columns:
+                raise ValueError(f'The dictionary column {column} is not a column of {self.table_name}.')
+            if len(dictionary.get_insert_columns()) != 1:
+                raise ValueError(f'The dictionary {dictionary.table_name} must have one column besides its key.')
+        if self.version_column is not None and self.version_column not in self.columns:
+            raise ValueError(f'The version column {self.version_column} is not a column of {self.table_name}.')
+        if self.version_column is not None and not self.update_columns:
+            raise ValueError(f'The version column of {self.table_name} needs update columns.')
+
+    def get_column_definitions(self) -> dict:
+        """Returns the data type of every column without constraints and defaults, e.g. {'user_id': 'INT'}.
+
+        SERIAL columns are INT columns with a default, so their type is "INT".
+        """
+        definitions = {}
+        for column, data_type in zip(self.columns, self.data_types):
+            data_type = re.split(r'\s+(?:primary key|not null|references|default)\b', data_type,
+                                 flags=re.IGNORECASE)[0]
+            definitions[column] = re.sub('^serial$', 'INT', data_type.strip(), flags=re.IGNORECASE)
+        return definitions
+
+    def get_primary_key(self):
+        """Returns the column that is the primary key or None if the table has no primary key."""
+        for column, data_type in zip(self.columns, self.data_types):
+            if re.search('primary key', data_type, re.IGNORECASE):
+                return column
+        return None
+
+    def get_insert_columns(self) -> List[str]:
+        """Returns the columns that receive values on insert, i.e. all columns except SERIAL ones."""
+        return [column for column, data_type in zip(self.columns, self.data_types)
+                if not re.search('serial', data_type, re.IGNORECASE)]
+
+    def get_constraints(self) -> List[Constraint]:
+        """Returns the primary key and foreign key constraints that are defined inline in the data types."""
+        constraints = []
+        for column, data_type in zip(self.columns, self.data_types):
+            if re.search('primary key', data_type, re.IGNORECASE):
+                key_columns = column
+                if self.partitioning is not None and self.partitioning.column != column:
+                    key_columns = f'{column}, {self.partitioning.column}'
+                constraints.append(Constraint(f'{self.table_name}_pkey', 'primary key', column,
+                                              f'PRIMARY KEY ({key_columns})'))
+            references = re.search(r'references\s+(\w+\s*\(\w+\))', data_type, re.IGNORECASE)
+            if references:
+                constraints.append(Constraint(f'{self.table_name}_{column}_fkey', 'foreign key', column,
+                                              f'FOREIGN KEY ({column}) REFERENCES {references.group(1)}'))
+        if self.key_columns:
+            constraints.append(Constraint(f'{self.table_name}_pkey', 'primary key', self.key_columns[0],
+                                          f'PRIMARY KEY ({", ".join(self.key_columns)})'))
+        return constraints
+
+    def get_deferred_constraints(self) -> List[Constraint]:
+        """Returns the constraints that can be created after a bulk load ("load then index").
+
+        These are all foreign keys and the primary key of a SERIAL column. Other primary keys
+        are needed during the load, because the ON CONFLICT clauses of the inserts rely on them.
+        """
+        return [constraint for constraint in self.constraints
+                if constraint.kind == 'foreign key' or constraint.column not in self.insert_columns]
+
+    @staticmethod
+    def strip_constraint(data_type: str, constraint: Constraint) -> str:
+        """Removes an inline constraint from a data type, e.g. "INT PRIMARY KEY" becomes "INT"."""
+        if constraint.kind == 'primary key':
+            data_type = re.sub(r'\s*primary key', '', data_type, flags=re.IGNORECASE)
+        else:
+            data_type = re.sub(r'\s*references\s+\w+\s*\(\w+\)', '', data_type, flags=re.IGNORECASE)
+        return data_type
 
-    def concat_cols_with_types(self) -> List[str]:
+    def concat_cols_with_types(self, deferred: bool = False) -> List[str]:
         """Returns a list with strings of statements for "create table" statements in SQL.
 
+        Args:
+            deferred (bool): If True, the deferred constraints are left out.
+
         returns List[str]: A list of every create statement for the given table.
         """
-        create_statements = [f'{self.columns[index]} {self.data_types[index]}' for index in range(len(self.columns))]
-        return create_statements
+        data_types = list(self.data_types)
+        if deferred:
+            for constraint in self.deferred_constraints:
+                index = self.columns.index(constraint.column)
+                data_types[index] = self.strip_constraint(data_types[index], constraint)
+        table_constraints = []
+        if self.partitioning is not None or self.key_columns:
+            # the primary key spans several columns, so it is a table constraint instead of an inline one
+            for constraint in self.constraints:
+                if constraint.kind != 'primary key':
+                    continue
+                index = self.columns.index(constraint.column)
+                data_types[index] = self.strip_constraint(data_types[index], constraint)
+                if not (deferred and constraint in self.deferred_constraints):
+                    table_constraints.append(f'CONSTRAINT {constraint.name} {constraint.definition}')
+        create_statements = [f'{self.columns[index]} {data_types[index]}' for index in range(len(self.columns))]
+        return create_statements + table_constraints
+
+    def get_query_create_table(self, deferred: bool = False, unlogged: bool = False) -> str:
+        """Creates the query for "create table".
 
-    def get_query_create_table(self) -> str:
-        """Creates the query for "create table"."""
+        Args:
+            deferred (bool):
+              If True, the table is created without the deferred constraints, which are added
+              with `queries['add_deferred_constraints']` after the bulk load.
+            unlogged (bool):
+              If True, the table is created UNLOGGED, i.e. without WAL. Its content is lost
+              on a crash, use it for tables that are reloaded anyway.
+        """
+        # partitioned tables can not be unlogged, their partitions are created by the loader
+        unlogged = 'UNLOGGED ' if unlogged and self.partitioning is None else ''
+        partition_by = f' PARTITION BY RANGE ({self.partitioning.column})' if self.partitioning is not None else ''
         query_create_table = f"""
-        CREATE TABLE IF NOT EXISTS {self.table_name}
-          ({', '.join(self.create_statements)});
+        CREATE {unlogged}TABLE IF NOT EXISTS {self.table_name}
+          ({', '.join(self.concat_cols_with_types(deferred))}){partition_by};
         """
         query_create_table = query_create_table.replace('\'', '')
         return query_create_table
@@ -48,7 +282,7 @@ class TableProperties:
     def get_query_insert_into(self):
         """Creates the query for "insert into table"."""
 
-        columns = self.columns
+        columns = list(self.columns)
         data_types = self.data_types
         primary_key = False
         foreign_keys = []
@@ -65,7 +299,7 @@ class TableProperties:
 
             if re.search('references', data_type, re.IGNORECASE):
                 index = data_types.index(data_type)
-                foreign_keys.append(columns[index])
+                foreign_keys.append(self.columns[index])
 
         columns_as_string = ', '.join(columns)
 
@@ -81,9 +315,142 @@ class TableProperties:
           ({value_placeholders})
         """
 
-        if primary_key:
+        if self.key_columns:
+            addition = f'{self.get_conflict_clause()};'
+        elif primary_key:
             addition = f'ON CONFLICT ({primary_key}) DO NOTHING;'
         else:
             addition = ';'
 
         return query + addition
+
+    def get_conflict_clause(self) -> str:
+        """Creates the ON CONFLICT clause from the primary key and the update columns.
+
+        An update is skipped if the update columns already have the new values. With a version
+        column, an update is skipped instead if the row is not older than the new version.
+
+        Accumulate columns are added to the existing values, such an update always changes the row.
+
+        Returns an empty string if the primary key is not an insert column (e.g. SERIAL),
+        because such rows can never conflict.
+        """
+        if self.key_columns:
+            conflict_target = ', '.join(self.key_columns)
+        elif self.primary_key is None or self.primary_key not in self.insert_columns:
+            return ''
+        else:
+            conflict_target = self.primary_key
+        if self.accumulate_columns:
+            assignments = ', '.join([f'{column} = EXCLUDED.{column}' for column in self.update_columns or []] +
+                                    [f'{column} = {self.table_name}.{column} + EXCLUDED.{column}'
+                                     for column in self.accumulate_columns])
+            return f'ON CONFLICT ({conflict_target}) DO UPDATE SET {assignments}'
+        if not self.update_columns:
+            return f'ON CONFLICT ({conflict_target}) DO NOTHING'
+        if self.version_column is not None:
+            assignments = ', '.join(f'{column} = EXCLUDED.{column}'
+                                    for column in self.update_columns + [self.version_column])
+            # the column is NULL in rows that have been written before it has been added
+            current = f'{self.table_name}.{self.version_column}'
+            return (f'ON CONFLICT ({conflict_target}) DO UPDATE SET {assignments} '
+                    f'WHERE {current} IS NULL OR EXCLUDED.{self.version_column} > {current}')
+        assignments = ', '.join(f'{column} = EXCLUDED.{column}' for column in self.update_columns)
+        # rows whose values do not change are not written, which saves dead tuples and WAL
+        current = ', '.join(f'{self.table_name}.{column}' for column in self.update_columns)
+        excluded = ', '.join(f'EXCLUDED.{column}' for column in self.update_columns)
+        return (f'ON CONFLICT ({conflict_target}) DO UPDATE SET {assignments} '
+                f'WHERE ({current}) IS DISTINCT FROM ({excluded})')
+
+    def get_query_insert_values(self) -> str:
+        """Creates the multi-row query for `psycopg2.extras.execute_values`.
+
+        The single placeholder "VALUES %s" is expanded to one page of rows by execute_values.
+        """
+        return f"""
+        INSERT INTO
+          {self.table_name} ({', '.join(self.insert_columns)})
+        VALUES %s
+        {self.get_conflict_clause()};
+        """
+
+    def get_query_merge_from_staging(self) -> str:
+        """Creates the query that merges the staging table into the table (COPY loader)."""
+        return f"""
+        INSERT INTO
+          {self.table_name} ({', '.join(self.insert_columns)})
+        SELECT {', '.join(self.insert_columns)}
+        FROM {self.staging_table_name}
+        {self.get_conflict_clause()};
+        """
+
+    def get_query_create_view(self, view_name: str) -> str:
+        """Creates the query for a view with the values of the dictionary-encoded columns instead of their keys.
+
+        The view has the column layout of the table before the encoding, e.g. "user_agent"
+        instead of "user_agent_id", so that queries of that layout keep working.
+        """
+        select_columns, joins = [], []
+        for column in self.columns:
+            dictionary = self.dictionaries.get(column)
+            if dictionary is None:
+                select_columns.append(f'{self.table_name}.{column}')
+                continue
+            value_column = dictionary.insert_columns[0]
+            select_columns.append(f'{dictionary.table_name}.{value_column}')
+            joins.append(f'JOIN {dictionary.table_name} '
+                         f'ON {dictionary.table_name}.{dictionary.primary_key} = {self.table_name}.{column}')
+        newline = '\n        '
+        return f"""
+        CREATE OR REPLACE VIEW {view_name} AS
+        SELECT {', '.join(select_columns)}
+        FROM {self.table_name}
+        {newline.join(joins)};
+        """
+
+    def get_partition_properties(self, partition_name: str) -> 'TableProperties':
+        """Returns the properties of a partition, whose queries load into the partition directly.
+
+        The partition has the columns, constraints and ON CONFLICT clause of this table.
+        """
+        properties = copy.copy(self)
+        properties.table_name = partition_name
+        properties.staging_table_name = f'staging_{partition_name}'
+        properties.partitioning = None
+        placeholders = ', '.join(['(%s)'] * len(self.insert_columns))
+        properties.queries = {'insert_into': f"""
+        INSERT INTO
+          {partition_name} ({', '.join(self.insert_columns)})
+        VALUES
+          ({placeholders})
+        {self.get_conflict_clause()};
+        """,
+                              'insert_values': properties.get_query_insert_values(),
+                              'create_staging': properties.get_query_create_staging(),
+                              'truncate_staging': f'TRUNCATE {properties.staging_table_name};',
+                              'copy_into_staging': properties.get_query_copy_into_staging(),
+                              'merge_from_staging': properties.get_query_merge_from_staging(),
+                              'truncate': f'TRUNCATE {partition_name};'}
+        return properties
+
+    def get_query_create_staging(self) -> str:
+        """Creates the query for the temporary staging table that is used by the COPY loader.
+
+        The staging table only holds the insert columns and has no constraints, so that COPY
+        never fails on a primary key or foreign key check. It lives as long as the session.
+        """
+        return f"""
+        CREATE TEMP TABLE IF NOT EXISTS {self.staging_table_name} AS
+          SELECT {', '.join(self.insert_columns)}
+          FROM {self.table_name}
+          WITH NO DATA;
+        """
+
+    def get_query_copy_into_staging(self) -> str:
+        """Creates the query for "copy from stdin" into the staging table (csv format).
+
+        NULL is written as an unquoted \\N (see COPY_NULL of bulk_load.py), so that an empty
+        field stays an empty string, as with INSERT.
+        """
+        return (f"COPY {self.staging_table_name} ({', '.join(self.insert_columns)}) "
+                f"FROM STDIN WITH (FORMAT csv, NULL '\\N')")
@@ -0,0 +1,83 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, List
+
+from parallel_extract import call_safely
+
+
+# Marks the end of the files in the queue
+DONE = object()
+
+
+async def extract_ahead(files: List[str], transformer: Callable, executor, queue: asyncio.Queue,
+                        max_in_flight: int) -> None:
+    """Transforms the files in the executor and puts (filepath, result) into the queue in file order.
+
+    At most `max_in_flight` files are transformed at the same time. `queue.put` waits while the
+    queue is full, so the transformation stops running ahead when the database falls behind.
+    An exception of the transformer is put into the queue as the result of its file, any other
+    exception is put into the queue on its own and ends the load.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        pending = deque()
+        for filepath in files:
+            pending.append((filepath, loop.run_in_executor(executor, call_safely, transformer, filepath, True)))
+            if len(pending) >= max_in_flight:
+                filepath, future = pending.popleft()
+                await queue.put((filepath, await future))
+        while pending:
+            filepath, future = pending.popleft()
+            await queue.put((filepath, await future))
+    except Exception as error:
+        await queue.put(error)
+        return
+    await queue.put(DONE)
+
+
+async def load_pipelined(files: List[str], transformer: Callable, load_one: Callable, finish: Callable,
+                         workers: int = 1, max_in_flight: int = 4) -> None:
+    """Overlaps reading and transforming files with writing them to the database.
+
+    The database work runs in a single thread, so psycopg2 releases the GIL while it waits
+    for postgres and the next files are read and transformed in the meantime. Because there
+    is one writer, the files are loaded in the same order and with the same statements as
+    with `etl.process_data`, so the tables end up with the same contents.
+
+    Args:
+        files (List[str]): The paths to the files.
+        transformer (Callable): A top level function that takes a path, e.g. `transform_song_file`.
+        load_one (Callable): Takes the path and the result of the transformer and loads it.
+        finish (Callable): Called in the database thread after the last file, e.g. to commit.
+        workers (int):
+          The number of processes that transform the files. 1 transforms them in a thread of
+          this process, which overlaps them with the database writes as well.
+        max_in_flight (int):
+          The number of files that are transformed at the same time. At most as many
+          transformed files wait in the queue for the database.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=max_in_flight)
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = ThreadPoolExecutor(max_workers=1)
+    db_executor = ThreadPoolExecutor(max_workers=1)
+
+    producer = asyncio.create_task(extract_ahead(files, transformer, executor, queue, max_in_flight))
+    try:
+        while True:
+            item = await queue.get()
+            if item is DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            filepath, data = item
+            await loop.run_in_executor(db_executor, load_one, filepath, data)
+        await loop.run_in_executor(db_executor, finish)
+    finally:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+        executor.shutdown(wait=True, cancel_futures=True)
+        db_executor.shutdown(wait=True)
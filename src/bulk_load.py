@@ -0,0 +1,128 @@
+import io
+from typing import Iterator
+
+import pandas as pd
+from psycopg2.extras import execute_values
+
+from TableProperties import TableProperties
+from instrumentation import stage
+
+
+LOAD_MODES = ('rows', 'values', 'copy')
+
+# The number of rows per INSERT statement of the load mode "values"
+DEFAULT_PAGE_SIZE = 1000
+# The NULL marker of COPY. By default an empty csv field is NULL, so '' and NULL could not be told apart
+COPY_NULL = '\\N'
+
+
+def load_dataframe(cur, table_properties: TableProperties, df: pd.DataFrame, load_mode: str = 'rows',
+                   page_size: int = DEFAULT_PAGE_SIZE) -> int:
+    """Loads the rows of a DataFrame into a table, row by row, in multi-row INSERTs or with COPY.
+
+    Args:
+        cur: The cursor from the database connection with psycopg2.
+        table_properties (TableProperties): The properties of the target table, e.g. songs_properties.
+        df (pd.DataFrame):
+          The data to load. The columns must be in the order of `table_properties.insert_columns`,
+          their names do not matter.
+        load_mode (str):
+          Either "rows" (one INSERT INTO per row), "values" (one INSERT INTO per `page_size`
+          rows with `execute_values`) or "copy" (COPY into a staging table and one merge into
+          the target table).
+        page_size (int): The number of rows per INSERT INTO of the load mode "values".
+
+    Returns:
+        int: The number of rows that have been sent to the database.
+    """
+    if load_mode not in LOAD_MODES:
+        raise ValueError(f'load_mode must be one of {LOAD_MODES}, got "{load_mode}".')
+
+    with stage(f'load.{table_properties.table_name}'):
+        if load_mode == 'rows':
+            for record in iter_records(df):
+                cur.execute(table_properties.queries['insert_into'], record)
+            return len(df.index)
+
+        if load_mode == 'values':
+            return insert_values(cur, table_properties, df, page_size)
+
+        return copy_dataframe(cur, table_properties, df)
+
+
+def iter_records(df: pd.DataFrame) -> Iterator[tuple]:
+    """Yields the rows of a DataFrame as tuples of python objects that psycopg2 can adapt.
+
+    Every column is converted once (numpy scalars become int / float, NaN becomes None) and
+    the rows are zipped from the converted columns, so no pandas object is built per row.
+    """
+    columns = [df.iloc[:, i] for i in range(df.shape[1])]
+    return zip(*(column.astype(object).where(column.notna(), None).tolist() for column in columns))
+
+
+def drop_duplicate_keys(table_properties: TableProperties, df: pd.DataFrame) -> pd.DataFrame:
+    """Removes duplicates of the primary key, so that one INSERT never has to touch a row twice.
+
+    The first row is kept for tables that "DO NOTHING" on conflict, the last row is kept for
+    tables that "DO UPDATE" on conflict. This gives the same result as inserting the rows one
+    after another.
+
+    Args:
+        table_properties (TableProperties): The properties of the target table.
+        df (pd.DataFrame): The data, columns named like `table_properties.insert_columns`.
+    """
+    primary_key = table_properties.primary_key
+    if primary_key not in table_properties.insert_columns:
+        return df
+    keep = 'last' if table_properties.update_columns else 'first'
+    return df.drop_duplicates(subset=[primary_key], keep=keep)
+
+
+def insert_values(cur, table_properties: TableProperties, df: pd.DataFrame,
+                  page_size: int = DEFAULT_PAGE_SIZE) -> int:
+    """Inserts a DataFrame with `execute_values`, one multi-row INSERT per page of rows.
+
+    Uses `queries['insert_values']`, which has the ON CONFLICT clause of the table. This works
+    where COPY is not permitted, e.g. on managed databases without the rights for COPY.
+
+    Args:
+        cur: The cursor from the database connection with psycopg2.
+        table_properties (TableProperties): The properties of the target table.
+        df (pd.DataFrame): The data to load, columns in the order of `table_properties.insert_columns`.
+        page_size (int): The number of rows per INSERT INTO.
+
+    Returns:
+        int: The number of rows that have been sent to the database.
+    """
+    df = drop_duplicate_keys(table_properties, df.set_axis(table_properties.insert_columns, axis=1))
+    execute_values(cur, table_properties.queries['insert_values'], iter_records(df), page_size=page_size)
+    return len(df.index)
+
+
+def copy_dataframe(cur, table_properties: TableProperties, df: pd.DataFrame) -> int:
+    """Streams a DataFrame into the staging table with COPY and merges it into the target table.
+
+    The merge uses the statement `queries['merge_from_staging']`, which has the same ON CONFLICT
+    clause as the INSERT INTO statement. Because one INSERT cannot update the same row twice,
+    duplicates of the primary key are removed beforehand with `drop_duplicate_keys`.
+
+    Args:
+        cur: The cursor from the database connection with psycopg2.
+        table_properties (TableProperties): The properties of the target table.
+        df (pd.DataFrame): The data to load, columns in the order of `table_properties.insert_columns`.
+
+    Returns:
+        int: The number of rows that have been copied into the staging table.
+    """
+    df = drop_duplicate_keys(table_properties, df.set_axis(table_properties.insert_columns, axis=1))
+
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False, na_rep=COPY_NULL)
+    buffer.seek(0)
+
+    cur.execute(table_properties.queries['create_staging'])
+    cur.execute(table_properties.queries['truncate_staging'])
+    cur.copy_expert(table_properties.queries['copy_into_staging'], buffer)
+    cur.execute(table_properties.queries['merge_from_staging'])
+
+    return len(df.index)
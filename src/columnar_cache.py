@@ -0,0 +1,159 @@
+import os
+import json
+import hashlib
+from typing import Callable, Dict, List
+
+import pandas as pd
+
+from instrumentation import stage
+from parallel_extract import extract_files, read_json_lines
+
+try:
+    import pyarrow as pa
+except ImportError:  # pyarrow is optional, it is only needed for the cache
+    pa = None
+
+
+# Keys of the schema metadata of a cache file
+SOURCES_KEY = b'sparkify.sources'
+JSON_COLUMNS_KEY = b'sparkify.json_columns'
+
+
+def get_fingerprint(filepath: str) -> List[int]:
+    """Returns size and modification time (ns) of a file, which change whenever the file is rewritten."""
+    stat = os.stat(filepath)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def to_arrow(df: pd.DataFrame, sources: Dict[str, List[int]]):
+    """Converts a DataFrame into an arrow table with the fingerprints of its source files as metadata.
+
+    Object columns with mixed types, e.g. "userId" with integers and empty strings, can not
+    be stored as one arrow type. They are stored as json strings and decoded by `from_arrow`,
+    so that the DataFrame comes back with the same values as `pd.read_json` returned.
+    """
+    columns, json_columns = {}, []
+    for column in df.columns:
+        values = df[column]
+        if values.dtype == object:
+            try:
+                pa.array(values, from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                values = values.map(json.dumps)
+                json_columns.append(column)
+        columns[column] = values
+    table = pa.Table.from_pandas(pd.DataFrame(columns), preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[SOURCES_KEY] = json.dumps(sources).encode()
+    metadata[JSON_COLUMNS_KEY] = json.dumps(json_columns).encode()
+    return table.replace_schema_metadata(metadata)
+
+
+def from_arrow(table) -> pd.DataFrame:
+    """Converts an arrow table of `to_arrow` back into a DataFrame."""
+    df = table.to_pandas()
+    for column in json.loads(table.schema.metadata[JSON_COLUMNS_KEY]):
+        df[column] = df[column].map(json.loads)
+    return df
+
+
+class ColumnarCache:
+    """An on-disk cache of parsed json files in the Arrow IPC format.
+
+    The files of one directory (e.g. "log_data/2018/11") are compacted into one partition,
+    a single arrow file that holds their rows and the fingerprints of the source files. A
+    partition is used as long as its directory contains exactly the same files with the same
+    size and mtime, otherwise it is parsed again and rewritten. Partitions are memory-mapped,
+    so a re-run reads them at the speed of the disk instead of parsing json.
+
+    Requires pyarrow (`pip install pyarrow`).
+    """
+    def __init__(self, cache_dir: str):
+        """Instantiate a cache in `cache_dir`, which is created if it does not exist.
+
+        Raises:
+            ImportError: If pyarrow is not installed.
+        """
+        if pa is None:
+            raise ImportError('The columnar cache requires pyarrow, install it with "pip install pyarrow".')
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def get_partition_path(self, directory: str) -> str:
+        """Returns the path of the cache file of a directory of source files."""
+        key = hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'{key}.arrow')
+
+    def read_partition(self, partition_path: str, sources: Dict[str, List[int]], columns: List[str] = None):
+        """Returns the cached DataFrame of a partition, or None if it is missing or outdated.
+
+        A partition is outdated if its source files changed or, if `columns` is given, if it
+        holds other columns, e.g. because it has been written by another reader.
+        """
+        if not os.path.exists(partition_path):
+            return None
+        with pa.memory_map(partition_path) as source:
+            reader = pa.ipc.open_file(source)
+            if json.loads(reader.schema.metadata[SOURCES_KEY]) != sources:
+                return None
+            if columns is not None and reader.schema.names != list(columns):
+                return None
+            return from_arrow(reader.read_all())
+
+    def write_partition(self, partition_path: str, df: pd.DataFrame, sources: Dict[str, List[int]]) -> bool:
+        """Writes a partition, replacing an older version atomically.
+
+        Returns:
+            bool: False if the data can not be stored in arrow, the partition is not cached then.
+        """
+        try:
+            table = to_arrow(df, sources)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            return False
+        tmp_path = f'{partition_path}.tmp'
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, partition_path)
+        return True
+
+    def read_files(self, files: List[str], reader: Callable = read_json_lines, workers: int = 1,
+                   columns: List[str] = None) -> pd.DataFrame:
+        """Returns the rows of all files, in the order of `files`, from the cache where possible.
+
+        Args:
+            files (List[str]): The paths to the json files. The files of a directory must be adjacent.
+            reader (Callable): Parses one file into a DataFrame, a top level function.
+            workers (int): The number of processes that parse the files that are not cached.
+            columns (List[str]):
+              The columns that the reader returns, e.g. `list(LOG_DATA_SCHEMA)`. Cached partitions
+              with other columns are parsed again.
+
+        Returns:
+            pd.DataFrame: The rows of all files with a new RangeIndex.
+        """
+        partitions = {}
+        for filepath in files:
+            partitions.setdefault(os.path.dirname(filepath), []).append(filepath)
+
+        dfs = []
+        for directory, partition_files in partitions.items():
+            sources = {filepath: get_fingerprint(filepath) for filepath in partition_files}
+            partition_path = self.get_partition_path(directory)
+            with stage('cache.read'):
+                df = self.read_partition(partition_path, sources, columns)
+            if df is not None:
+                self.hits += 1
+                dfs.append(df)
+                continue
+
+            self.misses += 1
+            parsed = [df for _, df in extract_files(partition_files, reader, workers)]
+            df = pd.concat(parsed, ignore_index=True)
+            with stage('cache.write'):
+                self.write_partition(partition_path, df, sources)
+            dfs.append(df)
+
+        return pd.concat(dfs, ignore_index=True)
@@ -0,0 +1,123 @@
+import time
+from typing import Dict, List
+
+from instrumentation import stage
+
+
+COMMIT_MODES = ('files', 'rows', 'seconds', 'table')
+
+
+class CommitPolicy:
+    """Decides when to commit and isolates every unit of work (e.g. a file) with a savepoint.
+
+    The modes are:
+      - "files": commit every `every` files (or batches).
+      - "rows": commit as soon as `every` rows have been written since the last commit.
+      - "seconds": commit as soon as `every` seconds have passed since the last commit.
+      - "table": commit once per table, i.e. when `end_table` is called. etl.py calls it
+        after every directory of files, etl_david.py after every table.
+
+    Every unit runs inside a savepoint, so a bad file only rolls back its own work and the
+    transaction goes on with the next file. Caches that remember what has been written
+    (e.g. TimeDimension) are rolled back together with the savepoint. The policy counts
+    commits and rows to report commits per second and rows per commit.
+    """
+    def __init__(self, conn, mode: str = 'files', every: float = 1, caches: List = None):
+        """Instantiate a commit policy for a connection that is not in autocommit mode.
+
+        Args:
+            conn: The database connection with psycopg2.
+            mode (str): One of COMMIT_MODES.
+            every (float): The number of files, rows or seconds between commits.
+            caches (List): Objects with the methods `begin_unit` and `rollback_unit`.
+        """
+        if mode not in COMMIT_MODES:
+            raise ValueError(f'mode must be one of {COMMIT_MODES}, got "{mode}".')
+        if conn.autocommit:
+            raise ValueError('The commit policy needs a connection that is not in autocommit mode.')
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.mode = mode
+        self.every = every
+        self.caches = caches or []
+
+        self.start = time.perf_counter()
+        self.last_commit = self.start
+        self.pending_units = 0
+        self.pending_rows = 0
+        self.commits = 0
+        self.rows = 0
+        self.failed_units = 0
+
+    def begin_unit(self) -> None:
+        """Sets a savepoint before the work of one unit (e.g. a file) starts."""
+        self.cur.execute('SAVEPOINT unit;')
+        for cache in self.caches:
+            cache.begin_unit()
+
+    def end_unit(self, row_counts: Dict[str, int]) -> None:
+        """Releases the savepoint of a successful unit and commits if the policy says so.
+
+        Args:
+            row_counts (Dict[str, int]): The number of rows that the unit has written per table.
+        """
+        self.cur.execute('RELEASE SAVEPOINT unit;')
+        self.pending_units += 1
+        self.pending_rows += sum(row_counts.values())
+
+        if self.mode == 'files' and self.pending_units >= self.every:
+            self.commit()
+        elif self.mode == 'rows' and self.pending_rows >= self.every:
+            self.commit()
+        elif self.mode == 'seconds' and time.perf_counter() - self.last_commit >= self.every:
+            self.commit()
+
+    def fail_unit(self) -> None:
+        """Rolls back the work of a failed unit, the work of the previous units is kept."""
+        self.cur.execute('ROLLBACK TO SAVEPOINT unit;')
+        self.cur.execute('RELEASE SAVEPOINT unit;')
+        for cache in self.caches:
+            cache.rollback_unit()
+        self.failed_units += 1
+
+    def end_table(self) -> None:
+        """Marks the end of a table (or a directory of files), commits in mode "table"."""
+        if self.mode == 'table':
+            self.commit()
+
+    def commit(self) -> None:
+        """Commits the pending work."""
+        with stage('commit'):
+            self.conn.commit()
+        self.commits += 1
+        self.rows += self.pending_rows
+        self.pending_units = 0
+        self.pending_rows = 0
+        self.last_commit = time.perf_counter()
+
+    def finish(self) -> Dict[str, float]:
+        """Commits what is still pending and returns the statistics.
+
+        Work outside of the units (e.g. the new mtimes of touched files in the manifest) is
+        committed as well, even if no unit is pending.
+        """
+        if self.pending_units:
+            self.commit()
+        else:
+            self.conn.commit()
+        return self.get_stats()
+
+    def get_stats(self) -> Dict[str, float]:
+        """Returns commits, rows, failed units, commits per second and rows per commit."""
+        elapsed = time.perf_counter() - self.start
+        return {'commits': self.commits,
+                'rows': self.rows,
+                'failed_units': self.failed_units,
+                'commits_per_second': self.commits / elapsed if elapsed else 0.0,
+                'rows_per_commit': self.rows / self.commits if self.commits else 0.0}
+
+    def report(self) -> None:
+        """Prints the statistics."""
+        stats = self.get_stats()
+        print(f'{stats["commits"]} commits, {stats["commits_per_second"]:.2f} commits/s, '
+              f'{stats["rows_per_commit"]:.1f} rows/commit, {stats["failed_units"]} failed.')
@@ -1,5 +1,12 @@
-import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+import argparse
+
+from psycopg2.extensions import parse_dsn
+
+from db import connect, get_admin_dsn, get_dsn
+from schema_manager import SchemaManager
+from rollups import rebuild_new_rollups
+from sql_queries import (create_table_queries, drop_table_queries, create_table_deferred_queries,
+                         create_index_queries, add_deferred_constraint_queries, create_view_queries)
 
 
 def create_database():
@@ -9,24 +16,46 @@ def create_database():
     """
     
     # connect to default database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=studentdb user=student password=student")
+    conn = connect(get_admin_dsn())
     conn.set_session(autocommit=True)
     cur = conn.cursor()
     
     # create sparkify database with UTF8 encoding
-    cur.execute("DROP DATABASE IF EXISTS sparkifydb")
-    cur.execute("CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
+    dbname = parse_dsn(get_dsn())['dbname']
+    cur.execute(f"DROP DATABASE IF EXISTS {dbname}")
+    cur.execute(f"CREATE DATABASE {dbname} WITH ENCODING 'utf8' TEMPLATE template0")
 
     # close connection to default database
     conn.close()    
     
     # connect to sparkify database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    conn = connect()
     cur = conn.cursor()
     
     return cur, conn
 
 
+def ensure_database():
+    """
+    - Creates the sparkifydb if it does not exist, without touching an existing one
+    - Returns the connection and cursor to sparkifydb
+    """
+    conn = connect(get_admin_dsn())
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+
+    dbname = parse_dsn(get_dsn())['dbname']
+    cur.execute('SELECT 1 FROM pg_database WHERE datname = %s;', (dbname,))
+    if cur.fetchone() is None:
+        cur.execute(f"CREATE DATABASE {dbname} WITH ENCODING 'utf8' TEMPLATE template0")
+    conn.close()
+
+    conn = connect()
+    cur = conn.cursor()
+
+    return cur, conn
+
+
 def drop_tables(cur, conn):
     """
     Drops each table using the queries in `drop_table_queries` list.
@@ -36,13 +65,54 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, deferred: bool = False):
+    """
+    Creates each table using the queries in `create_table_queries` list and the views
+    in `create_view_queries`.
+
+    If `deferred` is True ("load then index"), the tables are created without foreign keys,
+    SERIAL primary keys and secondary indexes. Build them with `build_indexes` after the load.
+    """
+    if deferred:
+        for query in create_table_deferred_queries + create_view_queries:
+            cur.execute(query)
+            conn.commit()
+        return
+
+    for query in create_table_queries + create_view_queries:
+        cur.execute(query)
+        conn.commit()
+    for query in create_index_queries:
+        cur.execute(query)
+        conn.commit()
+
+
+def build_indexes(cur, conn):
     """
-    Creates each table using the queries in `create_table_queries` list. 
+    Adds the deferred constraints and creates the secondary indexes in one transaction.
     """
-    for query in create_table_queries:
+    for query in add_deferred_constraint_queries + create_index_queries:
         cur.execute(query)
+    conn.commit()
+
+
+def migrate():
+    """
+    - Creates the sparkify database if it does not exist.
+
+    - Creates the missing tables, columns, constraints and indexes and alters columns
+    with another data type. Data is kept.
+
+    - Fills rollup tables that have just been created from songplays.
+    """
+    cur, conn = ensure_database()
+    applied_queries = SchemaManager(cur, conn).apply()
+    for query in applied_queries:
+        print(query)
+    if rebuild_new_rollups(cur, applied_queries):
         conn.commit()
+        print('Rebuilt the rollups from songplays.')
+    conn.close()
 
 
 def main():
@@ -67,4 +137,11 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Creates the sparkify database and its tables.')
+    parser.add_argument('--migrate', action='store_true',
+                        help='Keep the database and its data, only create or alter what differs from the DDL.')
+    args = parser.parse_args()
+    if args.migrate:
+        migrate()
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,75 @@
+import os
+from typing import Callable, Dict, List
+
+import psycopg2
+
+
+DEFAULT_DSN = 'host=127.0.0.1 dbname=sparkifydb user=student password=student'
+DEFAULT_ADMIN_DSN = 'host=127.0.0.1 dbname=studentdb user=student password=student'
+
+# Session settings for bulk loads: commits do not wait for the WAL flush. A crash of the
+# server may lose the last commits, but never corrupts the database.
+BULK_LOAD_SETTINGS = {'synchronous_commit': 'off'}
+
+
+def get_dsn() -> str:
+    """Returns the DSN of the sparkify database, set it with the environment variable SPARKIFY_DSN."""
+    return os.environ.get('SPARKIFY_DSN', DEFAULT_DSN)
+
+
+def get_admin_dsn() -> str:
+    """Returns the DSN of the default database that is used to (re)create the sparkify database.
+
+    Set it with the environment variable SPARKIFY_ADMIN_DSN.
+    """
+    return os.environ.get('SPARKIFY_ADMIN_DSN', DEFAULT_ADMIN_DSN)
+
+
+def get_session_settings(synchronous_commit: bool = True, statement_timeout: str = None) -> Dict[str, str]:
+    """Returns the session settings for the given options.
+
+    Args:
+        synchronous_commit (bool): If False, BULK_LOAD_SETTINGS are used.
+        statement_timeout (str): E.g. "5min". None means no timeout.
+    """
+    settings = {}
+    if not synchronous_commit:
+        settings.update(BULK_LOAD_SETTINGS)
+    if statement_timeout is not None:
+        settings['statement_timeout'] = statement_timeout
+    return settings
+
+
+def configure_session(conn, settings: Dict[str, str] = None, hooks: List[Callable] = None) -> None:
+    """Applies session settings (e.g. synchronous_commit, statement_timeout) and hooks to a connection.
+
+    Args:
+        conn: The database connection with psycopg2.
+        settings (Dict[str, str]): Names and values of settings, applied with `set_config`.
+        hooks (List[Callable]): Functions that take the connection, called after the settings.
+    """
+    if settings:
+        cur = conn.cursor()
+        for name, value in settings.items():
+            cur.execute('SELECT set_config(%s, %s, false);', (name, str(value)))
+        cur.close()
+        if not conn.autocommit:
+            conn.commit()
+    for hook in hooks or []:
+        hook(conn)
+
+
+def connect(dsn: str = None, settings: Dict[str, str] = None, hooks: List[Callable] = None):
+    """Opens a connection to the sparkify database (or `dsn`) and configures its session.
+
+    Args:
+        dsn (str): The DSN to connect to. None means `get_dsn()`.
+        settings (Dict[str, str]): Session settings, see `configure_session`.
+        hooks (List[Callable]): Functions that take the connection, see `configure_session`.
+
+    Returns:
+        The database connection with psycopg2.
+    """
+    conn = psycopg2.connect(dsn or get_dsn())
+    configure_session(conn, settings, hooks)
+    return conn
@@ -0,0 +1,248 @@
+import pandas as pd
+
+from TableProperties import TableProperties
+from sql_queries import time_properties, users_properties
+from bulk_load import drop_duplicate_keys, iter_records, load_dataframe
+from instrumentation import stage
+
+
+class TimeDimension:
+    """Loads the time table and remembers which start_time keys have been written in this run.
+
+    Every log file contains the timestamps of the previous ones again. Instead of sending them
+    to the database and letting `ON CONFLICT (start_time) DO NOTHING` throw them away, every
+    timestamp is only shipped once per run.
+    """
+    def __init__(self):
+        """Instantiate a time dimension that has not emitted any keys yet."""
+        self.emitted = set()
+        self.unit_keys = []
+
+    def begin_unit(self) -> None:
+        """Starts remembering the keys of one unit of work, see `rollback_unit`."""
+        self.unit_keys = []
+
+    def rollback_unit(self) -> None:
+        """Forgets the keys of a unit whose transaction has been rolled back."""
+        self.emitted.difference_update(self.unit_keys)
+        self.unit_keys = []
+
+    def filter_new(self, df_time: pd.DataFrame) -> pd.DataFrame:
+        """Returns the rows whose start_time has not been emitted yet and remembers their keys."""
+        df_time = df_time.drop_duplicates(subset=['start_time'])
+        keys = df_time['start_time'].astype('int64')
+        is_new = ~keys.isin(self.emitted)
+        new_keys = keys[is_new].tolist()
+        self.emitted.update(new_keys)
+        self.unit_keys.extend(new_keys)
+        return df_time[is_new]
+
+    def load(self, cur, df_time: pd.DataFrame, load_mode: str = 'rows') -> int:
+        """Writes the new rows of a batch in one bulk operation.
+
+        Args:
+            cur: The cursor from the database connection with psycopg2.
+            df_time (pd.DataFrame): The result of `transform.get_time_data`.
+            load_mode (str): "rows", "values" or "copy", see `bulk_load.load_dataframe`.
+
+        Returns:
+            int: The number of rows that have been sent to the database.
+        """
+        df_new = self.filter_new(df_time)
+        if df_new.empty:
+            return 0
+        return load_dataframe(cur, time_properties, df_new, load_mode)
+
+
+class UsersDimension:
+    """Loads the users table and caches the start_time of the latest event of every user that has been written.
+
+    The upsert of a user is only sent if the user is new or its latest event is newer than the
+    cache, so the number of updates grows with the distinct users of a batch and not with the
+    events. The upsert keeps the newest version by "last_start_time", so batches (e.g. chunks of
+    concurrent loaders) that are written out of order can not bring back an earlier level.
+    """
+    def __init__(self):
+        """Instantiate a users dimension with an empty cache."""
+        self.last_start_times = {}
+        self.unit_previous_start_times = {}
+
+    def begin_unit(self) -> None:
+        """Starts remembering the cache entries that one unit of work changes, see `rollback_unit`."""
+        self.unit_previous_start_times = {}
+
+    def rollback_unit(self) -> None:
+        """Restores the cache entries that a unit changed whose transaction has been rolled back."""
+        for user_id, start_time in self.unit_previous_start_times.items():
+            if start_time is None:
+                self.last_start_times.pop(user_id, None)
+            else:
+                self.last_start_times[user_id] = start_time
+        self.unit_previous_start_times = {}
+
+    def filter_newer(self, df_users: pd.DataFrame) -> pd.DataFrame:
+        """Returns the users that are new or have newer events than the cache and updates the cache."""
+        is_newer = []
+        for record in df_users.itertuples(index=False, name=None):
+            user_id, start_time = record[0], record[-1]
+            last_start_time = self.last_start_times.get(user_id)
+            newer = last_start_time is None or start_time > last_start_time
+            if newer:
+                self.unit_previous_start_times.setdefault(user_id, last_start_time)
+                self.last_start_times[user_id] = start_time
+            is_newer.append(newer)
+        return df_users[is_newer]
+
+    def load(self, cur, df_users: pd.DataFrame, load_mode: str = 'rows') -> int:
+        """Upserts the users of a batch that have newer events than the ones that have been written.
+
+        Args:
+            cur: The cursor from the database connection with psycopg2.
+            df_users (pd.DataFrame): The result of `transform.get_user_data`, one row per user.
+            load_mode (str): "rows", "values" or "copy", see `bulk_load.load_dataframe`.
+
+        Returns:
+            int: The number of rows that have been sent to the database.
+        """
+        df_newer = self.filter_newer(df_users)
+        if df_newer.empty:
+            return 0
+        return load_dataframe(cur, users_properties, df_newer, load_mode)
+
+
+class CatalogDimension:
+    """Loads a table of the song catalog (artists or songs) and skips rows that have been written.
+
+    A batch is de-duplicated by the primary key first. Then a row is only sent if its key is
+    new or, for tables that update on conflict, if the fingerprint (hash) of its update columns
+    differs from the one that has been written in this run. Re-ingesting an unchanged catalog
+    therefore sends nothing, and the `IS DISTINCT FROM` guard of the upsert skips the rows that
+    do not change the table, e.g. the ones that have been loaded by an earlier run.
+    """
+    def __init__(self, table_properties: TableProperties):
+        """Instantiate a dimension with an empty fingerprint cache.
+
+        Args:
+            table_properties (TableProperties): E.g. artists_properties or songs_properties.
+        """
+        self.table_properties = table_properties
+        self.fingerprints = {}
+        self.unit_previous_fingerprints = {}
+        self.key_position = table_properties.insert_columns.index(table_properties.primary_key)
+        self.update_positions = [table_properties.insert_columns.index(column)
+                                 for column in table_properties.update_columns or []]
+
+    def begin_unit(self) -> None:
+        """Starts remembering the cache entries that one unit of work changes, see `rollback_unit`."""
+        self.unit_previous_fingerprints = {}
+
+    def rollback_unit(self) -> None:
+        """Restores the cache entries that a unit changed whose transaction has been rolled back."""
+        for key, fingerprint in self.unit_previous_fingerprints.items():
+            if fingerprint is None:
+                self.fingerprints.pop(key, None)
+            else:
+                self.fingerprints[key] = fingerprint
+        self.unit_previous_fingerprints = {}
+
+    def get_fingerprint(self, record: tuple) -> int:
+        """Returns the hash of the update columns of a record (0 for tables that do not update)."""
+        return hash(tuple(record[position] for position in self.update_positions))
+
+    def filter_changed(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Returns the rows that are new or have changed and updates the cache."""
+        df = drop_duplicate_keys(self.table_properties, df.set_axis(self.table_properties.insert_columns, axis=1))
+        is_changed = []
+        for record in iter_records(df):
+            key, fingerprint = record[self.key_position], self.get_fingerprint(record)
+            changed = self.fingerprints.get(key) != fingerprint
+            if changed:
+                self.unit_previous_fingerprints.setdefault(key, self.fingerprints.get(key))
+                self.fingerprints[key] = fingerprint
+            is_changed.append(changed)
+        return df[is_changed]
+
+    def load(self, cur, df: pd.DataFrame, load_mode: str = 'rows') -> int:
+        """Writes the rows of a batch that are new or have changed.
+
+        Args:
+            cur: The cursor from the database connection with psycopg2.
+            df (pd.DataFrame): The rows, columns in the order of the insert columns.
+            load_mode (str): "rows", "values" or "copy", see `bulk_load.load_dataframe`.
+
+        Returns:
+            int: The number of rows that have been sent to the database.
+        """
+        df_changed = self.filter_changed(df)
+        if df_changed.empty:
+            return 0
+        return load_dataframe(cur, self.table_properties, df_changed, load_mode)
+
+
+class DictionaryDimension:
+    """Encodes a text column of songplays (e.g. user_agent) as the integer key of a dictionary table.
+
+    The keys of the values that have been seen in this run are cached. Only values that are not
+    in the cache are sent to the database: they are inserted if they are new (the SERIAL key is
+    assigned by the database, so concurrent loaders never hand out the same key twice) and their
+    keys are read back in the same round trip. A batch is then encoded with one `map`.
+    """
+    def __init__(self, table_properties: TableProperties):
+        """Instantiate a dictionary with an empty cache.
+
+        Args:
+            table_properties (TableProperties): E.g. user_agents_properties, a SERIAL key and a UNIQUE value.
+        """
+        self.table_properties = table_properties
+        self.key_column = table_properties.primary_key
+        self.value_column = table_properties.insert_columns[0]
+        self.keys = {}
+        self.unit_values = []
+        table_name = table_properties.table_name
+        self.query_insert_and_select = f"""
+        WITH new_values AS (
+          INSERT INTO {table_name} ({self.value_column})
+          SELECT unnest(%(values)s::TEXT[])
+          ON CONFLICT ({self.value_column}) DO NOTHING
+          RETURNING {self.key_column}, {self.value_column}
+        )
+        SELECT {self.key_column}, {self.value_column} FROM new_values
+        UNION ALL
+        SELECT {self.key_column}, {self.value_column} FROM {table_name}
+        WHERE {self.value_column} = ANY(%(values)s::TEXT[]);
+        """
+
+    def begin_unit(self) -> None:
+        """Starts remembering the values that one unit of work adds to the cache, see `rollback_unit`."""
+        self.unit_values = []
+
+    def rollback_unit(self) -> None:
+        """Forgets the values of a unit whose transaction (and the INSERT of new keys) has been rolled back."""
+        for value in self.unit_values:
+            self.keys.pop(value, None)
+        self.unit_values = []
+
+    def load(self, cur, values: pd.Series) -> int:
+        """Makes sure that every value has a key, in one query for all values that are not cached.
+
+        Returns:
+            int: The number of values that have been sent to the database.
+        """
+        missing = [value for value in values.dropna().unique().tolist() if value not in self.keys]
+        if not missing:
+            return 0
+        num_values = len(missing)
+        self.unit_values.extend(missing)
+        with stage(f'load.{self.table_properties.table_name}'):
+            while missing:
+                cur.execute(self.query_insert_and_select, {'values': missing})
+                for key, value in cur.fetchall():
+                    self.keys[value] = key
+                # a value that a concurrent loader committed while the query ran is neither
+                # inserted nor visible to it, the next query reads it
+                missing = [value for value in missing if value not in self.keys]
+        return num_values
+
+    def encode(self, values: pd.Series) -> pd.Series:
+        """Returns the keys of the values, call `load` for them first."""
+        return values.map(self.keys)
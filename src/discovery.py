@@ -0,0 +1,69 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, NamedTuple
+
+
+class FileInfo(NamedTuple):
+    """A discovered file with the stat info that is needed for scheduling and change detection."""
+    path: str
+    size: int
+    mtime: float
+
+
+def scan_directory(directory: str, extension: str = '.json') -> Iterator[FileInfo]:
+    """Yields the files of a directory tree that end in `extension`, while the tree is listed.
+
+    Every directory is listed once with `os.scandir`. The files of a directory are yielded
+    before the files of its subdirectories, both sorted by name, so the order does not depend
+    on the file system.
+    """
+    with os.scandir(directory) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+
+    subdirectories = []
+    for entry in entries:
+        if entry.is_dir():
+            subdirectories.append(entry.path)
+        elif entry.name.endswith(extension) and entry.is_file():
+            stat = entry.stat()
+            yield FileInfo(entry.path, stat.st_size, stat.st_mtime)
+
+    for subdirectory in subdirectories:
+        yield from scan_directory(subdirectory, extension)
+
+
+def scan_shard(directory: str, extension: str) -> List[FileInfo]:
+    """Lists one top-level shard completely (top level function for the thread pool)."""
+    return list(scan_directory(directory, extension))
+
+
+def iter_files(directory: str, extension: str = '.json', workers: int = 1) -> Iterator[FileInfo]:
+    """Yields the files of a directory tree with their size and mtime, without building a list first.
+
+    Args:
+        directory (str): The root of the tree, e.g. "data/song_data". The paths are absolute.
+        extension (str): Only files with this extension are yielded.
+        workers (int):
+          If > 1, the top-level subdirectories ("shards", e.g. "song_data/A") are listed by this
+          many threads, which helps on network file systems with a high latency per call. The
+          files are yielded in the same order as with one worker, shard by shard.
+
+    Yields:
+        FileInfo: The absolute path, size and mtime of every file.
+    """
+    directory = os.path.abspath(directory)
+    if workers <= 1:
+        yield from scan_directory(directory, extension)
+        return
+
+    with os.scandir(directory) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+    shards = [entry.path for entry in entries if entry.is_dir()]
+    for entry in entries:
+        if entry.name.endswith(extension) and entry.is_file():
+            stat = entry.stat()
+            yield FileInfo(entry.path, stat.st_size, stat.st_mtime)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for shard_files in pool.map(scan_shard, shards, [extension] * len(shards)):
+            yield from shard_files
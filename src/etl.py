@@ -1,13 +1,33 @@
 import os
-import glob
 import sys
-from typing import List, Callable
+import time
+import asyncio
+import argparse
+from functools import partial
+from typing import Dict, Iterator, List, Callable, Tuple
 
-import psycopg2
 import pandas as pd
+from psycopg2.extensions import TransactionRollbackError
 
 from sql_queries import *
-from create_tables import drop_tables, create_tables
+from create_tables import drop_tables, create_tables, build_indexes
+from db import connect, get_session_settings
+from bulk_load import LOAD_MODES
+from song_lookup import SongLookup, get_songplays
+from transform import transform_song_file, transform_log_file, transform_song_unit, transform_log_unit
+from parallel_extract import extract_files
+from async_load import load_pipelined
+from manifest import Manifest
+from discovery import iter_files
+from scheduler import schedule
+from work_queue import (DATASETS, DEFAULT_CHUNK_BYTES, DEFAULT_LEASE_SECONDS, DEFAULT_POLL_SECONDS, Chunk,
+                        LeaseHeartbeat, WorkQueue)
+from dimensions import CatalogDimension, DictionaryDimension, TimeDimension, UsersDimension
+from partitions import PartitionedTable
+from rollups import load_rollups, rebuild_new_rollups
+from commit_policy import COMMIT_MODES, CommitPolicy
+from schema_manager import RESET_MODES, SchemaManager, get_shadow_settings
+from instrumentation import metrics, add_exporters
 
 
 def set_sys_path():
@@ -26,7 +46,125 @@ def set_sys_path():
     sys.path.insert(0, correct_path)
 
 
-def process_song_file(cur, filepath: List[str]) -> None:
+def load_song_data(cur, song_data: Dict[str, pd.DataFrame], load_mode: str = 'rows',
+                   artists_dimension: CatalogDimension = None,
+                   songs_dimension: CatalogDimension = None) -> Dict[str, int]:
+    """Uploads transformed song data to the tables artists and songs.
+
+    Args:
+        cur: The cursor from the database connection with psycopg2.
+        song_data (Dict[str, pd.DataFrame]): The result of `transform_song_data`.
+        load_mode (str): "rows", "values" or "copy", see `bulk_load.load_dataframe`.
+        artists_dimension (CatalogDimension):
+          Remembers the artists that have been written in this run. Pass the same object for
+          every file, so that unchanged artists are not written again.
+        songs_dimension (CatalogDimension): The same for the songs.
+
+    Returns:
+        Dict[str, int]: The number of rows that have been sent to each table.
+    """
+    row_counts = {}
+
+    # insert artist records that are new or have changed
+    if artists_dimension is None:
+        artists_dimension = CatalogDimension(artists_properties)
+    row_counts['artists'] = artists_dimension.load(cur, song_data['artists'], load_mode)
+
+    # insert song records that are new
+    if songs_dimension is None:
+        songs_dimension = CatalogDimension(songs_properties)
+    row_counts['songs'] = songs_dimension.load(cur, song_data['songs'], load_mode)
+
+    return row_counts
+
+
+def encode_songplays(cur, df_songplays: pd.DataFrame, locations_dimension: DictionaryDimension = None,
+                     user_agents_dimension: DictionaryDimension = None) -> Tuple[pd.DataFrame, Dict[str, int]]:
+    """Replaces location and user_agent of the songplays with the keys of their dictionaries.
+
+    Args:
+        cur: The cursor from the database connection with psycopg2.
+        df_songplays (pd.DataFrame): The result of `get_songplays`.
+        locations_dimension (DictionaryDimension):
+          Caches the keys of the locations. Pass the same object for every file, so that
+          every location is only sent to the database once.
+        user_agents_dimension (DictionaryDimension): The same for the user agents.
+
+    Returns:
+        Tuple[pd.DataFrame, Dict[str, int]]:
+          The songplays in the order of the insert columns and the number of values that
+          have been sent to each dictionary.
+    """
+    if locations_dimension is None:
+        locations_dimension = DictionaryDimension(locations_properties)
+    if user_agents_dimension is None:
+        user_agents_dimension = DictionaryDimension(user_agents_properties)
+    row_counts = {'locations': locations_dimension.load(cur, df_songplays['location']),
+                  'user_agents': user_agents_dimension.load(cur, df_songplays['user_agent'])}
+    df_encoded = df_songplays.assign(location=locations_dimension.encode(df_songplays['location']),
+                                     user_agent=user_agents_dimension.encode(df_songplays['user_agent']))
+    return df_encoded, row_counts
+
+
+def load_log_data(cur, log_data: Dict[str, pd.DataFrame], load_mode: str = 'rows',
+                  song_lookup: SongLookup = None, time_dimension: TimeDimension = None,
+                  users_dimension: UsersDimension = None, songplays_table: PartitionedTable = None,
+                  locations_dimension: DictionaryDimension = None,
+                  user_agents_dimension: DictionaryDimension = None) -> Dict[str, int]:
+    """Uploads transformed log data to the tables time, users and songplays and updates the rollups.
+
+    Args:
+        cur: The cursor from the database connection with psycopg2.
+        log_data (Dict[str, pd.DataFrame]): The result of `transform_log_data`.
+        load_mode (str): "rows", "values" or "copy", see `bulk_load.load_dataframe`.
+        song_lookup (SongLookup):
+          Resolves song_id and artist_id. If None, it is loaded from the database.
+        time_dimension (TimeDimension):
+          Remembers the timestamps that have been written in this run. Pass the same
+          object for every file, so that every timestamp is only written once.
+        users_dimension (UsersDimension):
+          Caches the state of the users that have been written in this run. Pass the same
+          object for every file, so that unchanged users are not written again.
+        songplays_table (PartitionedTable):
+          Loads the songplays into their monthly partitions and remembers which partitions
+          exist. Pass the same object for every file.
+        locations_dimension (DictionaryDimension): Caches the keys of the locations, see `encode_songplays`.
+        user_agents_dimension (DictionaryDimension): Caches the keys of the user agents.
+
+    Returns:
+        Dict[str, int]: The number of rows that have been sent to each table.
+    """
+    row_counts = {}
+
+    # insert time data records that have not been written in this run
+    if time_dimension is None:
+        time_dimension = TimeDimension()
+    row_counts['time'] = time_dimension.load(cur, log_data['time'], load_mode)
+
+    # insert user records that are new or have changed
+    if users_dimension is None:
+        users_dimension = UsersDimension()
+    row_counts['users'] = users_dimension.load(cur, log_data['users'], load_mode)
+
+    # insert songplay records, song_id and artist_id are resolved with one merge per file
+    if song_lookup is None:
+        song_lookup = SongLookup.from_database(cur.connection)
+    df_songplays = get_songplays(log_data['events'], song_lookup)
+    # location and user_agent are stored as the keys of their dictionaries
+    df_encoded, dictionary_counts = encode_songplays(cur, df_songplays, locations_dimension, user_agents_dimension)
+    row_counts.update(dictionary_counts)
+    if songplays_table is None:
+        songplays_table = PartitionedTable(songplays_properties)
+    row_counts['songplays'] = songplays_table.load(cur, df_encoded, load_mode)
+
+    # add the plays of the batch to the rollups, in the same transaction as the songplays
+    row_counts.update(load_rollups(cur, df_songplays, load_mode))
+
+    return row_counts
+
+
+def process_song_file(cur, filepath: List[str], load_mode: str = 'rows', artists_dimension: CatalogDimension = None,
+                      songs_dimension: CatalogDimension = None) -> Dict[str, int]:
     """Processes song files and uploads data to the tables artists and songs.
 
     Args:
@@ -34,28 +172,20 @@ def process_song_file(cur, filepath: List[str]) -> None:
         filepath (List[str]):
           A list of strings where each string represents the path to the file
           that contains the data.
+        load_mode (str): "rows", "values" or "copy", see `bulk_load.load_dataframe`.
+        artists_dimension (CatalogDimension): Remembers the artists that have been written.
+        songs_dimension (CatalogDimension): Remembers the songs that have been written.
 
     Returns:
-        None
+        Dict[str, int]: The number of rows that have been sent to each table.
     """
-    # open song file
-    df_song_file = pd.read_json(filepath, lines=True)
-
-    # insert artist record
-    artist_data = df_song_file[['artist_id', 'artist_name', 'artist_location',
-                                'artist_latitude', 'artist_longitude']].values
-    for record in artist_data:
-        record_as_list = list(record)
-        cur.execute(artist_table_insert, record_as_list)
-
-    # insert song record
-    song_data = df_song_file[['song_id', 'title', 'artist_id', 'year', 'duration']].values
-    for record in song_data:
-        record_as_list = list(record)
-        cur.execute(song_table_insert, record_as_list)
+    return load_song_data(cur, transform_song_file(filepath), load_mode, artists_dimension, songs_dimension)
 
 
-def process_log_file(cur, filepath: List[str]):
+def process_log_file(cur, filepath: List[str], load_mode: str = 'rows', song_lookup: SongLookup = None,
+                     time_dimension: TimeDimension = None, users_dimension: UsersDimension = None,
+                     songplays_table: PartitionedTable = None, locations_dimension: DictionaryDimension = None,
+                     user_agents_dimension: DictionaryDimension = None):
     """Processes log files and uploads data to the tables users and time.
 
         Args:
@@ -63,58 +193,80 @@ def process_log_file(cur, filepath: List[str]):
             filepath (List[str]):
               A list of strings where each string represents the path to the file
               that contains the data.
+            load_mode (str): "rows", "values" or "copy", see `bulk_load.load_dataframe`.
+            song_lookup (SongLookup):
+              Resolves song_id and artist_id. If None, it is loaded from the database.
+            time_dimension (TimeDimension): Remembers the timestamps that have been written.
+            users_dimension (UsersDimension): Caches the state of the users that have been written.
+            songplays_table (PartitionedTable): Loads the songplays into their monthly partitions.
+            locations_dimension (DictionaryDimension): Caches the keys of the locations.
+            user_agents_dimension (DictionaryDimension): Caches the keys of the user agents.
 
         Returns:
-            None
+            Dict[str, int]: The number of rows that have been sent to each table.
         """
-    # open log file
-    df_log_file = pd.read_json(filepath, lines=True)
+    return load_log_data(cur, transform_log_file(filepath), load_mode, song_lookup, time_dimension,
+                         users_dimension, songplays_table, locations_dimension, user_agents_dimension)
 
-    # filter by NextSong action
-    next_song_pages = df_log_file['page'] == 'NextSong'
-    df_log_file = df_log_file[next_song_pages]
 
-    # convert timestamp column to datetime
-    timestamp = df_log_file['ts']
-    t = pd.to_datetime(timestamp)
+def get_files(filepath: str) -> List[str]:
+    """Walks a directory (arg "filepath") and returns a list of all files that end in ".json"."""
+    all_files = [file_info.path for file_info in iter_files(filepath)]
 
-    # insert time data records
-    time_data = [t, t.dt.hour, t.dt.day, t.dt.isocalendar().week, t.dt.month, t.dt.year, t.dt.weekday]
-    column_labels = ['timestamp', 'hour', 'day', 'week of year', 'month', 'year', 'weekday']
-    d = dict(zip(column_labels, time_data))
-    df_time = pd.DataFrame(d)
-
-    for i, row in df_time.iterrows():
-        cur.execute(time_table_insert, list(row))
+    # get total number of files found
+    num_files = len(all_files)
+    print(f'{num_files} files found in {filepath}')
 
-    # load user table
-    df_users = df_log_file[['userId', 'firstName', 'lastName', 'gender', 'level']]
+    return all_files
 
-    # insert user records
-    for i, row in df_users.iterrows():
-        cur.execute(user_table_insert, row)
 
-    # insert songplay records
-    for index, row in df_log_file.iterrows():
+def iter_data_files(filepath: str, manifest: Manifest = None) -> Iterator[str]:
+    """Yields the paths of the json files in a directory while it is listed.
 
-        # get song_id and artist_id from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
+    Args:
+        filepath (str): The path to the directory that contains the files.
+        manifest (Manifest): If given, only the files that need to be loaded are yielded.
+          Their size and mtime are taken from the listing, so no file is stat'ed twice.
+    """
+    file_infos = iter_files(filepath)
+    if manifest is not None:
+        return manifest.iter_files_to_load(file_infos)
+    return (file_info.path for file_info in file_infos)
 
-        if results:
-            song_id, artist_id = results
-        else:
-            song_id, artist_id = None, None
 
-        # insert songplay record
-        ids = pd.Series([song_id, artist_id], index=['song_id', 'artist_id'])
-        enriched_row = row.append(ids)
-        songplay_data = enriched_row[['ts', 'userId', 'level', 'song_id', 'artist_id',
-                                      'sessionId', 'location', 'userAgent']]
-        cur.execute(songplay_table_insert, songplay_data)
+def load_file(datafile: str, load: Callable, commit_policy: CommitPolicy, manifest: Manifest = None) -> bool:
+    """Loads one file inside a savepoint of the commit policy and records it in the manifest.
 
+    Args:
+        datafile (str): The path to the file.
+        load (Callable): Loads the file and returns the number of rows per table.
+        commit_policy (CommitPolicy): Decides when to commit.
+        manifest (Manifest): If given, the file is recorded in the same transaction as its data.
 
-def process_data(cur, conn, filepath: str, file_processor: Callable) -> None:
+    Returns:
+        bool: True if the file has been loaded, False if its work has been rolled back.
+    """
+    start = time.perf_counter()
+    commit_policy.begin_unit()
+    try:
+        row_counts = load()
+        if manifest is not None:
+            manifest.mark_loaded(datafile, row_counts)
+    except Exception as error:
+        # only the work of this file is rolled back
+        commit_policy.fail_unit()
+        if manifest is not None:
+            manifest.mark_failed(datafile)
+        metrics.record_file(datafile, time.perf_counter() - start, {}, failed=True)
+        print(f'Failed to load {datafile}: {error}')
+        return False
+    commit_policy.end_unit(row_counts)
+    metrics.record_file(datafile, time.perf_counter() - start, row_counts)
+    return True
+
+
+def process_data(cur, conn, filepath: str, file_processor: Callable, manifest: Manifest = None,
+                 commit_policy: CommitPolicy = None) -> None:
     """Collects all json files from a directory and uses the file_processor on them.
 
     Args:
@@ -123,49 +275,517 @@ def process_data(cur, conn, filepath: str, file_processor: Callable) -> None:
         filepath (str): The path to the directory that contains the files.
         file_processor (Callable):
           Either the  function "process_song_files" or "process_log_files".
+        manifest (Manifest):
+          If given, only new or changed files are processed and every file is recorded
+          in the manifest in the same transaction as its data.
+        commit_policy (CommitPolicy): Decides when to commit. None means a commit per file.
 
     Returns:
         None
     """
-    # get all files matching extension from directory
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root, '*.json'))
-        for f in files:
-            all_files.append(os.path.abspath(f))
+    if commit_policy is None:
+        commit_policy = CommitPolicy(conn)
 
-    # get total number of files found
+    # iterate over files while they are discovered and process
+    num_files = 0
+    for num_files, datafile in enumerate(iter_data_files(filepath, manifest), 1):
+        load_file(datafile, partial(file_processor, cur, datafile), commit_policy, manifest)
+        print(f'{num_files} files processed.')
+    print(f'{num_files} files processed in {filepath}')
+    commit_policy.end_table()
+    commit_policy.finish()
+
+
+def process_data_parallel(cur, conn, filepath: str, transformer: Callable, loader: Callable,
+                          workers: int, manifest: Manifest = None, commit_policy: CommitPolicy = None) -> None:
+    """Parses and transforms the files in a process pool and loads them with one connection.
+
+    The workers only read and transform files, this process owns the connection and loads
+    the results in the order of the files, so the tables end up the same as with `process_data`.
+
+    Args:
+        cur: The cursor from the database connection with psycopg2.
+        conn: The database connection with psycopg2.
+        filepath (str): The path to the directory that contains the files.
+        transformer (Callable): Either "transform_song_file" or "transform_log_file".
+        loader (Callable): Either "load_song_data" or "load_log_data".
+        workers (int): The number of worker processes.
+        manifest (Manifest): If given, only new or changed files are processed.
+        commit_policy (CommitPolicy): Decides when to commit. None means a commit per file.
+
+    Returns:
+        None
+    """
+    if commit_policy is None:
+        commit_policy = CommitPolicy(conn)
+
+    extracted = extract_files(iter_data_files(filepath, manifest), transformer, workers, return_exceptions=True)
+    num_files = 0
+    for num_files, (datafile, data) in enumerate(extracted, 1):
+        if isinstance(data, Exception):
+            load = partial(raise_error, data)
+        else:
+            load = partial(loader, cur, data)
+        load_file(datafile, load, commit_policy, manifest)
+        print(f'{num_files} files processed.')
+    print(f'{num_files} files processed in {filepath}')
+    commit_policy.end_table()
+    commit_policy.finish()
+
+
+def process_data_async(cur, conn, filepath: str, transformer: Callable, loader: Callable, workers: int = 1,
+                       max_in_flight: int = 4, manifest: Manifest = None,
+                       commit_policy: CommitPolicy = None) -> None:
+    """Transforms the next files while the current file is written to the database.
+
+    Uses `async_load.load_pipelined`: up to `max_in_flight` files are read and transformed
+    ahead of the one connection that loads them in the order of the files, so the tables end
+    up the same as with `process_data`. When the database falls behind, the transformation
+    waits for it.
+
+    Args:
+        cur: The cursor from the database connection with psycopg2.
+        conn: The database connection with psycopg2.
+        filepath (str): The path to the directory that contains the files.
+        transformer (Callable): Either "transform_song_file" or "transform_log_file".
+        loader (Callable): Either "load_song_data" or "load_log_data".
+        workers (int): The number of processes that transform the files.
+        max_in_flight (int): The number of files that are transformed ahead of the database.
+        manifest (Manifest): If given, only new or changed files are processed.
+        commit_policy (CommitPolicy): Decides when to commit. None means a commit per file.
+
+    Returns:
+        None
+    """
+    if commit_policy is None:
+        commit_policy = CommitPolicy(conn)
+
+    # the manifest uses the cursor, so the files are filtered before the database thread starts
+    all_files = list(iter_data_files(filepath, manifest))
     num_files = len(all_files)
-    print(f'{num_files} files found in {filepath}')
+    num_processed = 0
 
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        file_processor(cur, datafile)
-        conn.commit()
-        print(f'{i}/{num_files} files processed.')
+    def load_one(datafile: str, data) -> None:
+        nonlocal num_processed
+        if isinstance(data, Exception):
+            load = partial(raise_error, data)
+        else:
+            load = partial(loader, cur, data)
+        load_file(datafile, load, commit_policy, manifest)
+        num_processed += 1
+        print(f'{num_processed}/{num_files} files processed.')
 
+    def finish() -> None:
+        commit_policy.end_table()
+        commit_policy.finish()
+
+    asyncio.run(load_pipelined(all_files, transformer, load_one, finish, workers, max_in_flight))
+
+
+def process_units(cur, conn, filepath: str, transformer: Callable, loader: Callable, unit_bytes: int,
+                  workers: int = 1, commit_policy: CommitPolicy = None) -> None:
+    """Groups the files into units of work of about `unit_bytes` and loads them unit by unit.
+
+    Small files (e.g. song files) are read and loaded together, large files (e.g. log files)
+    are split into line ranges, see `scheduler.schedule`. Every unit is one unit of work of
+    the commit policy, so the overhead per file is paid once per unit, and the workers get
+    units of the same size. The units are loaded in the order of the files.
+
+    Args:
+        cur: The cursor from the database connection with psycopg2.
+        conn: The database connection with psycopg2.
+        filepath (str): The path to the directory that contains the files.
+        transformer (Callable): Either "transform_song_unit" or "transform_log_unit".
+        loader (Callable): Either "load_song_data" or "load_log_data".
+        unit_bytes (int): The target size of a unit of work.
+        workers (int): The number of processes that read and transform the units.
+        commit_policy (CommitPolicy): Decides when to commit. None means a commit per unit.
+
+    Returns:
+        None
+    """
+    if commit_policy is None:
+        commit_policy = CommitPolicy(conn)
+
+    units = schedule(iter_files(filepath), unit_bytes)
+    extracted = extract_files(units, transformer, workers, return_exceptions=True)
+    num_units = 0
+    for num_units, (unit, data) in enumerate(extracted, 1):
+        if isinstance(data, Exception):
+            load = partial(raise_error, data)
+        else:
+            load = partial(loader, cur, data)
+        load_file(str(unit), load, commit_policy)
+        print(f'{num_units} units processed ({unit.size / 1024 ** 2:.1f} MB).')
+    print(f'{num_units} units processed in {filepath}')
+    commit_policy.end_table()
+    commit_policy.finish()
 
-def restart() -> None:
-    """Drops all tables and creates all tables again (without data)."""
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+
+def load_chunk(cur, chunk: Chunk, transformer: Callable, loader: Callable, commit_policy: CommitPolicy,
+               queue: WorkQueue, heartbeat: LeaseHeartbeat = None) -> bool:
+    """Loads one claimed chunk inside a savepoint and marks it in the queue in the same transaction.
+
+    If the heartbeat has lost the lease of the chunk, the chunk is given up before it is loaded.
+
+    A chunk whose transaction is rolled back by a deadlock or a serialization failure with another
+    loader is given back to the queue (until it has been given back `max_releases` times), any
+    other error marks it as failed. Either way the transaction is committed before the next chunk
+    is claimed.
+
+    Returns:
+        bool: True if the chunk has been loaded, False if its work has been rolled back.
+    """
+    start = time.perf_counter()
+    commit_policy.begin_unit()
+    try:
+        data = transformer(chunk.unit)
+        if heartbeat is not None:
+            heartbeat.check(chunk)
+        row_counts = loader(cur, data)
+        queue.mark_done(chunk, row_counts)
+    except TransactionRollbackError as error:
+        commit_policy.fail_unit()
+        queue.release(chunk)
+        commit_policy.commit()
+        print(f'Gave back {chunk} to the queue: {error}')
+        return False
+    except Exception as error:
+        commit_policy.fail_unit()
+        queue.mark_failed(chunk)
+        commit_policy.commit()
+        metrics.record_file(str(chunk), time.perf_counter() - start, {}, failed=True)
+        print(f'Failed to load {chunk}: {error}')
+        return False
+    commit_policy.end_unit(row_counts)
+    metrics.record_file(str(chunk), time.perf_counter() - start, row_counts)
+    return True
+
+
+def process_queue(cur, conn, queue: WorkQueue, dataset: str, transformer: Callable, loader: Callable,
+                  commit_policy: CommitPolicy = None, poll_seconds: float = DEFAULT_POLL_SECONDS) -> None:
+    """Claims the chunks of a dataset from the work queue and loads them until all chunks are finished.
+
+    Any number of processes (on any number of hosts) can call it at the same time, every chunk
+    is loaded by one of them. A process only returns when no chunk is pending or claimed by
+    another process anymore, so that the log data is not looked up before all songs are loaded.
+    While it waits, it claims the chunks of processes that died.
+
+    Args:
+        cur: The cursor from the database connection with psycopg2.
+        conn: The database connection with psycopg2.
+        queue (WorkQueue): The queue, the chunks have been registered with `WorkQueue.register`.
+        dataset (str): Either "song_data" or "log_data".
+        transformer (Callable): Either "transform_song_unit" or "transform_log_unit".
+        loader (Callable): Either "load_song_data" or "load_log_data".
+        commit_policy (CommitPolicy):
+          Must commit every unit (mode "files", every 1), because the lease of a chunk only
+          protects it until its commit. None means a commit per chunk.
+        poll_seconds (float): How long to wait for the chunks of other processes before looking again.
+
+    Returns:
+        None
+    """
+    if commit_policy is None:
+        commit_policy = CommitPolicy(conn)
+
+    num_chunks = 0
+    with LeaseHeartbeat(queue, connect) as heartbeat:
+        while True:
+            chunk = queue.claim(dataset)
+            if chunk is None:
+                if queue.is_finished(dataset):
+                    break
+                time.sleep(poll_seconds)
+                continue
+            heartbeat.hold(chunk)
+            load_chunk(cur, chunk, transformer, loader, commit_policy, queue, heartbeat)
+            heartbeat.hold(None)
+            num_chunks += 1
+            print(f'{num_chunks} chunks processed ({chunk}, attempt {chunk.attempt}).')
+    print(f'{num_chunks} chunks of {dataset} processed by {queue.worker}')
+    commit_policy.end_table()
+    commit_policy.finish()
+
+
+def raise_error(error: Exception):
+    """Raises an error that happened in a worker process, so that it is handled like a load error."""
+    raise error
+
+
+def restart(deferred: bool = False, reset_mode: str = 'drop') -> None:
+    """Prepares empty tables for a full load.
+
+    Args:
+        deferred (bool): If True, foreign keys and secondary indexes are created after the load.
+        reset_mode (str):
+          "drop" drops all tables and creates them again, "truncate" creates what is missing
+          and truncates the tables, "swap" creates unlogged tables in a shadow schema that
+          replace the live tables with `swap_tables` after the load (always deferred).
+    """
+    if reset_mode not in RESET_MODES:
+        raise ValueError(f'reset_mode must be one of {RESET_MODES}, got "{reset_mode}".')
+
+    conn = connect()
+    cur = conn.cursor()
+    if reset_mode == 'drop':
+        drop_tables(cur, conn)
+        create_tables(cur, conn, deferred)
+    elif reset_mode == 'truncate':
+        SchemaManager(cur, conn).reset(deferred)
+    else:
+        SchemaManager(cur, conn).create_shadow_tables()
+    conn.close()
+
+
+def swap_tables() -> None:
+    """Replaces the live tables with the tables that have been loaded with `restart(reset_mode='swap')`."""
+    conn = connect()
     cur = conn.cursor()
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    start = time.perf_counter()
+    SchemaManager(cur, conn).swap()
+    print(f'Swapped the loaded tables in {time.perf_counter() - start:.2f} seconds.')
     conn.close()
 
 
-def main():
-    """Connects to db and processes song_data and log_data"""
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+def print_row_counts(cur) -> None:
+    """Prints the number of rows of every table, e.g. to compare the load modes."""
+    for properties in table_properties:
+        cur.execute(f'SELECT COUNT(*) FROM {properties.table_name};')
+        print(f'{properties.table_name}: {cur.fetchone()[0]} rows')
+
+
+def main(load_mode: str = 'rows', lookup_max_rows: int = None, workers: int = 1, incremental: bool = False,
+         session_settings: Dict[str, str] = None, commit_mode: str = 'files', commit_every: float = 1,
+         load_then_index: bool = False, data_path: str = 'data', metrics_file: str = None,
+         async_load: bool = False, max_in_flight: int = 4, unit_bytes: int = None, coordinate: bool = False,
+         worker: str = None, lease_seconds: float = DEFAULT_LEASE_SECONDS):
+    """Connects to db and processes song_data and log_data
+
+    Args:
+        load_mode (str):
+          Either "rows" (one INSERT INTO per row), "values" (one INSERT INTO per page of
+          rows) or "copy" (COPY FROM STDIN into a staging table that is merged into the
+          target table).
+        lookup_max_rows (int):
+          The maximal number of songs the song lookup holds in memory. None means unbounded.
+        workers (int): The number of processes that parse the json files. 1 parses them serially.
+        incremental (bool):
+          If True, only files that are new or changed according to the table "load_manifest"
+          are loaded. Otherwise every file is loaded, and recorded in the manifest unless
+          it is loaded in units or chunks.
+        session_settings (Dict[str, str]):
+          Settings of the database session, e.g. {'synchronous_commit': 'off'}.
+        commit_mode (str):
+          When to commit: every `commit_every` "files", "rows" or "seconds", or once per "table".
+        commit_every (float): The number of files, rows or seconds between commits.
+        load_then_index (bool):
+          If True, the tables have been created with `restart(deferred=True)`. The deferred
+          constraints and the secondary indexes are built in one pass after the load.
+        data_path (str): The directory that contains "song_data" and "log_data".
+        metrics_file (str): If given, the time spent per stage is written to this json file.
+        async_load (bool):
+          If True, the next files are read and transformed while the current file is written
+          to the database (see `process_data_async`).
+        max_in_flight (int): The number of files that are transformed ahead of the database.
+        unit_bytes (int):
+          If given, the files are grouped or split into units of work of about this size
+          instead of being loaded file by file (see `process_units`). With `coordinate`,
+          the target size of the chunks of the queue.
+        coordinate (bool):
+          If True, the files are registered as chunks in the table "load_queue" and this process
+          loads the chunks that it claims, together with any other process that runs with
+          `coordinate` against the same database (see `process_queue`). The tables have to
+          exist already.
+        worker (str): The name of this process in the queue. None means host and process id.
+        lease_seconds (float): How long a claimed chunk stays claimed without a heartbeat.
+    """
+    conn = connect(settings=session_settings)
     cur = conn.cursor()
 
-    process_data(cur, conn, filepath='data/song_data', file_processor=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', file_processor=process_log_file)
+    manifest = None
+    if incremental:
+        # only missing tables, columns, constraints and indexes are created
+        applied_queries = SchemaManager(cur, conn).apply()
+        # rollups that have just been created count the songplays of the earlier runs first
+        if rebuild_new_rollups(cur, applied_queries):
+            conn.commit()
+        # a changed log file would insert its songplays twice, it is skipped
+        manifest = Manifest(cur, append_only=[os.path.join(data_path, 'log_data')])
+        cur.execute(songplays_exist_select)
+        if not manifest.entries and cur.fetchone()[0]:
+            raise ValueError('The manifest is empty, but songplays has rows, so every log file would be loaded '
+                             'twice. They have been loaded without a manifest (e.g. by etl_david.py, with '
+                             '--unit-size-mb or --coordinate): reload them with etl.py first.')
+    elif unit_bytes is None and not coordinate:
+        # a full load records its files as well, so that the next incremental run only loads the changes
+        manifest = Manifest(cur, append_only=[os.path.join(data_path, 'log_data')])
+
+    queue = None
+    if coordinate:
+        queue = WorkQueue(conn, data_path, worker, lease_seconds)
+        for dataset in DATASETS:
+            num_chunks = queue.register_files(dataset, unit_bytes or DEFAULT_CHUNK_BYTES)
+            if num_chunks:
+                print(f'{num_chunks} chunks of {dataset} registered.')
+
+    song_dimensions = {'artists_dimension': CatalogDimension(artists_properties),
+                       'songs_dimension': CatalogDimension(songs_properties)}
+    dimensions = {'time_dimension': TimeDimension(), 'users_dimension': UsersDimension(),
+                  'songplays_table': PartitionedTable(songplays_properties),
+                  'locations_dimension': DictionaryDimension(locations_properties),
+                  'user_agents_dimension': DictionaryDimension(user_agents_properties)}
+    if coordinate:
+        # a chunk is marked as done in the transaction of its data, every chunk is committed
+        commit_mode, commit_every = 'files', 1
+    commit_policy = CommitPolicy(conn, commit_mode, commit_every,
+                                 caches=list(song_dimensions.values()) + list(dimensions.values()))
+
+    start = time.perf_counter()
+    if queue is not None:
+        process_queue(cur, conn, queue, 'song_data', transformer=transform_song_unit,
+                      loader=partial(load_song_data, load_mode=load_mode, **song_dimensions),
+                      commit_policy=commit_policy)
+    elif unit_bytes is not None:
+        process_units(cur, conn, filepath=os.path.join(data_path, 'song_data'), transformer=transform_song_unit,
+                      loader=partial(load_song_data, load_mode=load_mode, **song_dimensions),
+                      unit_bytes=unit_bytes, workers=workers, commit_policy=commit_policy)
+    elif async_load:
+        process_data_async(cur, conn, filepath=os.path.join(data_path, 'song_data'), transformer=transform_song_file,
+                           loader=partial(load_song_data, load_mode=load_mode, **song_dimensions),
+                           workers=workers, max_in_flight=max_in_flight, manifest=manifest,
+                           commit_policy=commit_policy)
+    elif workers > 1:
+        process_data_parallel(cur, conn, filepath=os.path.join(data_path, 'song_data'), transformer=transform_song_file,
+                              loader=partial(load_song_data, load_mode=load_mode, **song_dimensions),
+                              workers=workers, manifest=manifest, commit_policy=commit_policy)
+    else:
+        process_data(cur, conn, filepath=os.path.join(data_path, 'song_data'),
+                     file_processor=partial(process_song_file, load_mode=load_mode, **song_dimensions),
+                     manifest=manifest, commit_policy=commit_policy)
+
+    song_lookup = SongLookup.from_database(conn, max_rows=lookup_max_rows)
+    if queue is not None:
+        process_queue(cur, conn, queue, 'log_data', transformer=transform_log_unit,
+                      loader=partial(load_log_data, load_mode=load_mode, song_lookup=song_lookup, **dimensions),
+                      commit_policy=commit_policy)
+    elif unit_bytes is not None:
+        process_units(cur, conn, filepath=os.path.join(data_path, 'log_data'), transformer=transform_log_unit,
+                      loader=partial(load_log_data, load_mode=load_mode, song_lookup=song_lookup, **dimensions),
+                      unit_bytes=unit_bytes, workers=workers, commit_policy=commit_policy)
+    elif async_load:
+        process_data_async(cur, conn, filepath=os.path.join(data_path, 'log_data'), transformer=transform_log_file,
+                           loader=partial(load_log_data, load_mode=load_mode, song_lookup=song_lookup,
+                                          **dimensions),
+                           workers=workers, max_in_flight=max_in_flight, manifest=manifest,
+                           commit_policy=commit_policy)
+    elif workers > 1:
+        process_data_parallel(cur, conn, filepath=os.path.join(data_path, 'log_data'), transformer=transform_log_file,
+                              loader=partial(load_log_data, load_mode=load_mode, song_lookup=song_lookup,
+                                             **dimensions),
+                              workers=workers, manifest=manifest, commit_policy=commit_policy)
+    else:
+        process_data(cur, conn, filepath=os.path.join(data_path, 'log_data'),
+                     file_processor=partial(process_log_file, load_mode=load_mode, song_lookup=song_lookup,
+                                            **dimensions),
+                     manifest=manifest, commit_policy=commit_policy)
+    song_lookup.close()
+    print(f'Loaded data with load mode "{load_mode}" in {time.perf_counter() - start:.2f} seconds.')
+    commit_policy.report()
+
+    if load_then_index:
+        start = time.perf_counter()
+        build_indexes(cur, conn)
+        print(f'Built constraints and indexes in {time.perf_counter() - start:.2f} seconds.')
+
+    metrics.finish()
+    if metrics_file is not None:
+        metrics.write(metrics_file)
+
+    print_row_counts(cur)
 
     conn.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Loads song_data and log_data into sparkifydb.')
+    parser.add_argument('--load-mode', choices=LOAD_MODES, default='rows',
+                        help='"rows" inserts row by row, "values" inserts pages of rows with execute_values, '
+                             '"copy" uses COPY FROM STDIN.')
+    parser.add_argument('--lookup-max-rows', type=int, default=None,
+                        help='Spill the song lookup to disk if the catalog has more songs than this.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='The number of processes that parse the json files.')
+    parser.add_argument('--async-load', action='store_true',
+                        help='Read and transform the next files while the current file is written to the database.')
+    parser.add_argument('--max-in-flight', type=int, default=4,
+                        help='The number of files that --async-load transforms ahead of the database.')
+    parser.add_argument('--unit-size-mb', type=float, default=None,
+                        help='Group small files and split large files into units of work of about this size.')
+    parser.add_argument('--coordinate', action='store_true',
+                        help='Load the chunks of the work queue "load_queue" together with other loader processes. '
+                             'The tables have to exist, e.g. from create_tables.py.')
+    parser.add_argument('--worker-name', default=None,
+                        help='The name of this loader in the work queue, default host and process id.')
+    parser.add_argument('--lease-seconds', type=float, default=DEFAULT_LEASE_SECONDS,
+                        help='How long a claimed chunk stays claimed if its loader stops sending heartbeats.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Keep the tables and only load files that are new or changed since the last run.')
+    parser.add_argument('--async-commit', action='store_true',
+                        help='Set synchronous_commit=off for the loading session.')
+    parser.add_argument('--statement-timeout', default=None,
+                        help='The statement_timeout of the loading session, e.g. "5min".')
+    parser.add_argument('--commit-mode', choices=COMMIT_MODES, default='files',
+                        help='Commit every N "files", "rows" or "seconds", or once per "table".')
+    parser.add_argument('--commit-every', type=float, default=1,
+                        help='The N of --commit-mode.')
+    parser.add_argument('--load-then-index', action='store_true',
+                        help='Create foreign keys and secondary indexes after the load instead of before.')
+    parser.add_argument('--reset', choices=RESET_MODES, default=None,
+                        help='How to empty the tables before the load: "drop" (default) and create them again, '
+                             '"truncate" them, or load into unlogged shadow tables and "swap" them in at the end.')
+    parser.add_argument('--data-path', default='data',
+                        help='The directory that contains "song_data" and "log_data".')
+    parser.add_argument('--metrics-file', default=None,
+                        help='Write the time spent per stage to this json file.')
+    parser.add_argument('--metrics-jsonl', default=None,
+                        help='Append one json line per file and the metrics of the run to this file.')
+    parser.add_argument('--metrics-prometheus', default=None,
+                        help='Write the metrics of the run to this file in the prometheus text format.')
+    parser.add_argument('--metrics-summary', action='store_true',
+                        help='Print a table with the time per stage and the counters at the end of the run.')
+    args = parser.parse_args()
+    add_exporters(args.metrics_jsonl, args.metrics_prometheus, args.metrics_summary)
+    if args.incremental and args.load_then_index:
+        parser.error('--load-then-index recreates the tables, it can not be combined with --incremental.')
+    if args.incremental and args.reset is not None:
+        parser.error('--reset empties the tables, it can not be combined with --incremental.')
+    if args.unit_size_mb is not None and (args.incremental or args.async_load):
+        parser.error('--unit-size-mb loads units instead of files, '
+                     'it can not be combined with --incremental or --async-load.')
+    if args.coordinate and (args.incremental or args.reset is not None or args.load_then_index or args.async_load
+                            or args.workers > 1):
+        parser.error('--coordinate loads into the existing tables with one process per loader, it can not be '
+                     'combined with --incremental, --reset, --load-then-index, --async-load or --workers.')
+    if args.coordinate and (args.commit_mode != 'files' or args.commit_every != 1):
+        parser.error('--coordinate commits every chunk, it can not be combined with --commit-mode or --commit-every.')
+    reset_mode = args.reset or 'drop'
+
+    session_settings = get_session_settings(not args.async_commit, args.statement_timeout)
+    if reset_mode == 'swap':
+        # the shadow tables get their constraints and indexes in swap_tables
+        session_settings.update(get_shadow_settings())
+
     # set_sys_path()
-    restart()
-    main()
+    if not args.incremental and not args.coordinate:
+        restart(deferred=args.load_then_index, reset_mode=reset_mode)
+    main(load_mode=args.load_mode, lookup_max_rows=args.lookup_max_rows, workers=args.workers,
+         incremental=args.incremental, session_settings=session_settings,
+         commit_mode=args.commit_mode, commit_every=args.commit_every,
+         load_then_index=args.load_then_index and reset_mode != 'swap',
+         data_path=args.data_path, metrics_file=args.metrics_file,
+         async_load=args.async_load, max_in_flight=args.max_in_flight,
+         unit_bytes=int(args.unit_size_mb * 1024 ** 2) if args.unit_size_mb is not None else None,
+         coordinate=args.coordinate, worker=args.worker_name, lease_seconds=args.lease_seconds)
+    if reset_mode == 'swap':
+        swap_tables()
@@ -1,13 +1,29 @@
 import os
-import glob
 import sys
-from typing import List
+import time
+import argparse
+from functools import partial
+from typing import Callable, Dict, List
 
-import psycopg2
 import pandas as pd
 
 from sql_queries import *
 from create_tables import drop_tables, create_tables
+from db import connect, get_session_settings
+from bulk_load import LOAD_MODES
+from song_lookup import SongLookup, get_songplays
+from parallel_extract import extract_files, read_json_lines
+from typed_json import LOG_DATA_SCHEMA, SONG_DATA_SCHEMA
+from discovery import iter_files
+from stream_logs import stream_log_data
+from etl import encode_songplays, load_log_data
+from transform import get_time_data, get_user_data
+from dimensions import CatalogDimension, DictionaryDimension, TimeDimension, UsersDimension
+from partitions import PartitionedTable
+from rollups import load_rollups
+from commit_policy import COMMIT_MODES, CommitPolicy
+from columnar_cache import ColumnarCache
+from instrumentation import metrics, add_exporters, stage
 
 
 class ETL:
@@ -17,12 +33,8 @@ class ETL:
 
     @staticmethod
     def get_all_json_files(filepath: str):
-        # get all files matching extension from directory
-        all_files = []
-        for root, dirs, files in os.walk(filepath):
-            files = glob.glob(os.path.join(root, '*.json'))
-            for f in files:
-                all_files.append(os.path.abspath(f))
+        # get all files matching extension from directory, every directory is listed once
+        all_files = [file_info.path for file_info in iter_files(filepath)]
 
         # get total number of files found
         num_files = len(all_files)
@@ -31,12 +43,20 @@ class ETL:
         return all_files
 
     @staticmethod
-    def files_to_df(files: List[str]):
+    def files_to_df(files: List[str], schema: Dict[str, str], workers: int = 1, cache: ColumnarCache = None):
+        # only the fields of the schema are decoded, with the same dtypes for every file
+        reader = partial(read_json_lines, schema=schema)
+
+        # unchanged directories are read from the columnar cache instead of parsing their json files
+        if cache is not None:
+            return cache.read_files(files, reader, workers, columns=list(schema))
+
+        # files are parsed in a process pool if workers > 1, the order of the rows stays the same
         dfs = []
-        for file in files:
-            df = pd.read_json(file, lines=True)
+        for file, df in extract_files(files, reader, workers):
             dfs.append(df)
-        df = pd.concat(dfs, ignore_index=True)
+        with stage('parse'):
+            df = pd.concat(dfs, ignore_index=True)
         return df
 
 
@@ -59,87 +79,166 @@ def set_sys_path():
     sys.path.insert(0, correct_path)
 
 
-def main():
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+def load_table(commit_policy: CommitPolicy, table_name: str, load: Callable) -> int:
+    """Loads one table as one unit of work of the commit policy and returns the number of rows."""
+    commit_policy.begin_unit()
+    try:
+        num_rows = load()
+    except Exception:
+        commit_policy.fail_unit()
+        raise
+    commit_policy.end_unit({table_name: num_rows})
+    commit_policy.end_table()
+    metrics.increment(f'rows.{table_name}', num_rows)
+    return num_rows
+
+
+def main(load_mode: str = 'rows', lookup_max_rows: int = None, workers: int = 1, batch_size: int = None,
+         session_settings: Dict[str, str] = None, commit_mode: str = 'table', commit_every: float = 1,
+         data_path: str = '../data', metrics_file: str = None, cache_dir: str = None):
+    conn = connect(settings=session_settings)
     cur = conn.cursor()
-    conn.autocommit = True
 
     etl = ETL(conn, cur)
+    cache = ColumnarCache(cache_dir) if cache_dir is not None else None
+    time_dimension = TimeDimension()
+    users_dimension = UsersDimension()
+    artists_dimension = CatalogDimension(artists_properties)
+    songs_dimension = CatalogDimension(songs_properties)
+    songplays_table = PartitionedTable(songplays_properties)
+    locations_dimension = DictionaryDimension(locations_properties)
+    user_agents_dimension = DictionaryDimension(user_agents_properties)
+    commit_policy = CommitPolicy(conn, commit_mode, commit_every,
+                                 caches=[artists_dimension, songs_dimension, time_dimension, users_dimension,
+                                         songplays_table, locations_dimension, user_agents_dimension])
+    start = time.perf_counter()
 
     # Get Song Data
-    file_path_song_data = '../data/song_data'
+    file_path_song_data = os.path.join(data_path, 'song_data')
     song_data_files = etl.get_all_json_files(file_path_song_data)
-    df_song_data = etl.files_to_df(song_data_files)
-
-    # Get Log Data
-    file_path_log_data = '../data/log_data'
-    log_data_files = etl.get_all_json_files(file_path_log_data)
-    df_log_data = etl.files_to_df(log_data_files)
-
-    # Filter by Pages that have "NextSong" as value
-    next_song_pages = df_log_data['page'] == 'NextSong'
-    df_log_data = df_log_data[next_song_pages]
+    df_song_data = etl.files_to_df(song_data_files, SONG_DATA_SCHEMA, workers, cache)
 
     # Upload Artists Data
     artists_data = df_song_data[['artist_id', 'artist_name', 'artist_location',
-                                 'artist_latitude', 'artist_longitude']].values
+                                 'artist_latitude', 'artist_longitude']]
 
     print(f'Start loading {len(df_song_data.index)} rows for artists table.')
-    for row in artists_data:
-        cur.execute(artist_table_insert, list(row))
+    load_table(commit_policy, 'artists', partial(artists_dimension.load, cur, artists_data, load_mode))
     print('Done')
 
     # Upload Songs Data
-    songs_data = df_song_data[['song_id', 'title', 'artist_id', 'year', 'duration']].values
+    songs_data = df_song_data[['song_id', 'title', 'artist_id', 'year', 'duration']]
     print(f'Start loading {len(df_song_data.index)} rows for songs table.')
-    for row in songs_data:
-        cur.execute(song_table_insert, list(row))
+    load_table(commit_policy, 'songs', partial(songs_dimension.load, cur, songs_data, load_mode))
     print('Done')
 
-    # Extract Data for Time Table
-    timestamps = df_log_data['ts']
-    t = pd.to_datetime(timestamps)
-    time_data = [t, t.dt.hour, t.dt.day, t.dt.isocalendar().week, t.dt.month, t.dt.year, t.dt.weekday]
-    column_labels = ['timestamp', 'hour', 'day', 'week of year', 'month', 'year', 'weekday']
-    d = dict(zip(column_labels, time_data))
-    df_time = pd.DataFrame(d)
+    song_lookup = SongLookup.from_song_data(df_song_data, max_rows=lookup_max_rows)
+
+    # Get Log Data
+    file_path_log_data = os.path.join(data_path, 'log_data')
+    log_data_files = etl.get_all_json_files(file_path_log_data)
+
+    if batch_size is not None:
+        # Stream Log Data in batches, memory is bounded by batch_size instead of the size of log_data
+        print(f'Start streaming log data in batches of {batch_size} events.')
+        loader = partial(load_log_data, load_mode=load_mode, song_lookup=song_lookup,
+                         time_dimension=time_dimension, users_dimension=users_dimension,
+                         songplays_table=songplays_table, locations_dimension=locations_dimension,
+                         user_agents_dimension=user_agents_dimension)
+        stream_log_data(cur, commit_policy, log_data_files, loader, batch_size)
+        song_lookup.close()
+        print(f'Loaded data with load mode "{load_mode}" in {time.perf_counter() - start:.2f} seconds.')
+        commit_policy.report()
+        conn.close()
+        metrics.finish()
+        if metrics_file is not None:
+            metrics.write(metrics_file)
+        return
+
+    df_log_data = etl.files_to_df(log_data_files, LOG_DATA_SCHEMA, workers, cache)
+
+    # Filter by Pages that have "NextSong" as value
+    with stage('filter'):
+        next_song_pages = df_log_data['page'] == 'NextSong'
+        df_log_data = df_log_data[next_song_pages]
+
+    # Extract Data for Time Table (one row per distinct timestamp)
+    with stage('transform'):
+        df_time = get_time_data(df_log_data['ts'])
 
     # Upload Time Data
     print(f'Start loading {len(df_time.index)} rows for time table.')
-    for row in df_time.values:
-        cur.execute(time_table_insert, list(row))
+    load_table(commit_policy, 'time', partial(time_dimension.load, cur, df_time, load_mode))
     print('Done')
 
-    # Upload Users Data
-    df_users = df_log_data[['userId', 'firstName', 'lastName', 'gender', 'level']]
-    print(f'Start loading {len(df_log_data.index)} rows for users table.')
-    for row in df_users.values:
-        cur.execute(user_table_insert, list(row))
+    # Upload Users Data (one row per user with the latest state)
+    with stage('transform'):
+        df_users = get_user_data(df_log_data)
+    print(f'Start loading {len(df_users.index)} rows for users table.')
+    load_table(commit_policy, 'users', partial(users_dimension.load, cur, df_users, load_mode))
     print('Done')
 
     # Upload Songplays Data
     print(f'Start loading {len(df_log_data.index)} rows for songplays table.')
-    for index, row in df_log_data.iterrows():
-
-        # get song_id and artist_id from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-
-        if results:
-            song_id, artist_id = results
-        else:
-            song_id, artist_id = None, None
-
-        # insert songplay record
-        ids = pd.Series([song_id, artist_id], index=['song_id', 'artist_id'])
-        enriched_row = row.append(ids)
-        songplay_data = enriched_row[['ts', 'userId', 'level', 'song_id', 'artist_id',
-                                      'sessionId', 'location', 'userAgent']]
-        cur.execute(songplay_table_insert, list(songplay_data))
+    df_songplays = get_songplays(df_log_data, song_lookup)
+    song_lookup.close()
+
+    def load_songplays() -> int:
+        # the dictionaries and the rollups are updated in the same unit of work as the songplays
+        df_encoded, _ = encode_songplays(cur, df_songplays, locations_dimension, user_agents_dimension)
+        num_rows = songplays_table.load(cur, df_encoded, load_mode)
+        load_rollups(cur, df_songplays, load_mode)
+        return num_rows
+
+    load_table(commit_policy, 'songplays', load_songplays)
     print('Done')
+    commit_policy.finish()
+    print(f'Loaded data with load mode "{load_mode}" in {time.perf_counter() - start:.2f} seconds.')
+    commit_policy.report()
+    conn.close()
+    metrics.finish()
+    if metrics_file is not None:
+        metrics.write(metrics_file)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Loads song_data and log_data into sparkifydb.')
+    parser.add_argument('--load-mode', choices=LOAD_MODES, default='rows',
+                        help='"rows" inserts row by row, "values" inserts pages of rows with execute_values, '
+                             '"copy" uses COPY FROM STDIN.')
+    parser.add_argument('--lookup-max-rows', type=int, default=None,
+                        help='Spill the song lookup to disk if the catalog has more songs than this.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='The number of processes that parse the json files.')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='Stream log data in batches of this many events instead of loading it at once.')
+    parser.add_argument('--async-commit', action='store_true',
+                        help='Set synchronous_commit=off for the loading session.')
+    parser.add_argument('--statement-timeout', default=None,
+                        help='The statement_timeout of the loading session, e.g. "5min".')
+    parser.add_argument('--commit-mode', choices=COMMIT_MODES, default='table',
+                        help='Commit every N "files" (batches), "rows" or "seconds", or once per "table".')
+    parser.add_argument('--commit-every', type=float, default=1,
+                        help='The N of --commit-mode.')
+    parser.add_argument('--data-path', default='../data',
+                        help='The directory that contains "song_data" and "log_data".')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Cache the parsed json files in this directory (Arrow IPC, requires pyarrow).')
+    parser.add_argument('--metrics-file', default=None,
+                        help='Write the time spent per stage to this json file.')
+    parser.add_argument('--metrics-jsonl', default=None,
+                        help='Append one json line per file and the metrics of the run to this file.')
+    parser.add_argument('--metrics-prometheus', default=None,
+                        help='Write the metrics of the run to this file in the prometheus text format.')
+    parser.add_argument('--metrics-summary', action='store_true',
+                        help='Print a table with the time per stage and the counters at the end of the run.')
+    args = parser.parse_args()
+    add_exporters(args.metrics_jsonl, args.metrics_prometheus, args.metrics_summary)
+
     set_sys_path()
     # restart()
-    main()
+    main(load_mode=args.load_mode, lookup_max_rows=args.lookup_max_rows, workers=args.workers,
+         batch_size=args.batch_size,
+         session_settings=get_session_settings(not args.async_commit, args.statement_timeout),
+         commit_mode=args.commit_mode, commit_every=args.commit_every,
+         data_path=args.data_path, metrics_file=args.metrics_file, cache_dir=args.cache_dir)
@@ -0,0 +1,261 @@
+import sys
+import json
+import time
+import bisect
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List
+
+
+# Upper bounds of the histogram buckets, like the buckets of a prometheus histogram
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+ROWS_BUCKETS = [0, 1, 10, 100, 1000, 10000, 100000, 1000000]
+
+
+class Histogram:
+    """Counts observations in buckets with upper bounds, e.g. the latency per file."""
+    def __init__(self, buckets: List[float]):
+        """Instantiate an empty histogram.
+
+        Args:
+            buckets (List[float]): The sorted upper bounds of the buckets, +Inf is added implicitly.
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """Adds one observation."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_cumulative_counts(self) -> List[tuple]:
+        """Returns (upper bound, number of observations <= upper bound) for every bucket."""
+        cumulative, total = [], 0
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+    def to_dict(self) -> dict:
+        """Returns sum, count and the cumulative bucket counts."""
+        return {'sum': self.sum, 'count': self.count,
+                'buckets': {str(bound): count for bound, count in self.get_cumulative_counts()}}
+
+
+class Metrics:
+    """Collects timers, counters and histograms of the ETL.
+
+    Timers measure the time spent in every stage, e.g. "read", "parse", "filter", "transform",
+    "lookup", "load.songs" or "commit". Counters count e.g. files and rows per table.
+    Histograms hold the latency per file and the rows per table per file. Exporters get every
+    file event while the ETL runs and all metrics at the end of the run.
+    """
+    def __init__(self):
+        """Instantiate empty metrics without exporters."""
+        self.timings = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.histograms = {}
+        self.exporters = []
+
+    @contextmanager
+    def stage(self, name: str):
+        """Measures the time of a with block and adds it to the stage `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float) -> None:
+        """Adds time to a stage, for code that can not be wrapped in a with block."""
+        self.timings[name] += seconds
+        self.calls[name] += 1
+
+    def increment(self, name: str, value: int = 1) -> None:
+        """Increments a counter."""
+        self.counters[name] += value
+
+    def observe(self, name: str, value: float, buckets: List[float]) -> None:
+        """Adds an observation to a histogram, which is created with `buckets` if it does not exist."""
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(buckets)
+        self.histograms[name].observe(value)
+
+    def record_file(self, filepath: str, seconds: float, row_counts: Dict[str, int], failed: bool = False) -> None:
+        """Records one processed file (or batch) and passes the event to the exporters.
+
+        Args:
+            filepath (str): The path of the file.
+            seconds (float): The time it took to process the file.
+            row_counts (Dict[str, int]): The number of rows per table.
+            failed (bool): Whether the file failed to load.
+        """
+        self.increment('files_failed' if failed else 'files_processed')
+        self.observe('file_latency_seconds', seconds, LATENCY_BUCKETS)
+        for table, num_rows in row_counts.items():
+            self.increment(f'rows.{table}', num_rows)
+            self.observe(f'rows_per_file.{table}', num_rows, ROWS_BUCKETS)
+
+        event = {'event': 'file', 'filepath': filepath, 'seconds': seconds,
+                 'rows': row_counts, 'failed': failed}
+        for exporter in self.exporters:
+            exporter.on_event(event)
+
+    def add_exporter(self, exporter) -> None:
+        """Adds an exporter, an object with the methods `on_event` and `export`."""
+        self.exporters.append(exporter)
+
+    def finish(self) -> None:
+        """Passes all metrics to the exporters at the end of a run."""
+        for exporter in self.exporters:
+            exporter.export(self)
+
+    def reset(self) -> None:
+        """Forgets everything that has been measured and removes the exporters."""
+        self.timings.clear()
+        self.calls.clear()
+        self.counters.clear()
+        self.histograms.clear()
+        self.exporters.clear()
+
+    def to_dict(self) -> Dict[str, dict]:
+        """Returns the seconds and the number of calls of every stage."""
+        return {name: {'seconds': self.timings[name], 'calls': self.calls[name]}
+                for name in sorted(self.timings)}
+
+    def to_full_dict(self) -> dict:
+        """Returns stages, counters and histograms."""
+        return {'stages': self.to_dict(),
+                'counters': dict(sorted(self.counters.items())),
+                'histograms': {name: histogram.to_dict() for name, histogram in sorted(self.histograms.items())}}
+
+    def write(self, filepath: str) -> None:
+        """Writes the time per stage as json."""
+        with open(filepath, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+class JsonLinesExporter:
+    """Appends one json line per file while the ETL runs and one line with all metrics at the end."""
+    def __init__(self, filepath: str):
+        """Instantiate an exporter that appends to `filepath`."""
+        self.filepath = filepath
+
+    def write_line(self, record: dict) -> None:
+        """Appends one record with a timestamp."""
+        record = dict(record, time=time.time())
+        with open(self.filepath, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def on_event(self, event: dict) -> None:
+        """Writes a file event."""
+        self.write_line(event)
+
+    def export(self, metrics: Metrics) -> None:
+        """Writes all metrics."""
+        self.write_line(dict(event='summary', **metrics.to_full_dict()))
+
+
+class PrometheusExporter:
+    """Writes all metrics in the prometheus text format at the end of a run.
+
+    The file can be picked up by the textfile collector of the node exporter.
+    """
+    def __init__(self, filepath: str, prefix: str = 'sparkify_etl'):
+        """Instantiate an exporter that writes to `filepath`."""
+        self.filepath = filepath
+        self.prefix = prefix
+
+    def on_event(self, event: dict) -> None:
+        """Prometheus only gets the metrics at the end of a run."""
+
+    @staticmethod
+    def split_name(name: str) -> tuple:
+        """Splits e.g. "rows.songs" into ("rows", "songs")."""
+        base, _, label = name.partition('.')
+        return base, label
+
+    def format(self, metrics: Metrics) -> str:
+        """Returns the metrics in the prometheus text format."""
+        lines = [f'# TYPE {self.prefix}_stage_seconds_total counter']
+        for name in sorted(metrics.timings):
+            lines.append(f'{self.prefix}_stage_seconds_total{{stage="{name}"}} {metrics.timings[name]}')
+        lines.append(f'# TYPE {self.prefix}_stage_calls_total counter')
+        for name in sorted(metrics.calls):
+            lines.append(f'{self.prefix}_stage_calls_total{{stage="{name}"}} {metrics.calls[name]}')
+
+        typed = set()
+        for name in sorted(metrics.counters):
+            base, table = self.split_name(name)
+            labels = f'{{table="{table}"}}' if table else ''
+            if base not in typed:
+                typed.add(base)
+                lines.append(f'# TYPE {self.prefix}_{base}_total counter')
+            lines.append(f'{self.prefix}_{base}_total{labels} {metrics.counters[name]}')
+
+        for name, histogram in sorted(metrics.histograms.items()):
+            base, table = self.split_name(name)
+            label = f'table="{table}",' if table else ''
+            if base not in typed:
+                typed.add(base)
+                lines.append(f'# TYPE {self.prefix}_{base} histogram')
+            for bound, count in histogram.get_cumulative_counts():
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append(f'{self.prefix}_{base}_bucket{{{label}le="{le}"}} {count}')
+            labels = f'{{{label.rstrip(",")}}}' if table else ''
+            lines.append(f'{self.prefix}_{base}_sum{labels} {histogram.sum}')
+            lines.append(f'{self.prefix}_{base}_count{labels} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, metrics: Metrics) -> None:
+        """Writes the metrics, replacing the file of the previous run."""
+        with open(self.filepath, 'w') as f:
+            f.write(self.format(metrics))
+
+
+class SummaryExporter:
+    """Prints a table with the time per stage, the counters and the file latencies at the end of a run."""
+    def __init__(self, stream=None):
+        """Instantiate an exporter that prints to `stream` (default: stdout)."""
+        self.stream = stream
+
+    def on_event(self, event: dict) -> None:
+        """The summary is only printed at the end of a run."""
+
+    def export(self, metrics: Metrics) -> None:
+        """Prints the summary table."""
+        stream = self.stream or sys.stdout
+        total = sum(metrics.timings.values())
+        print(f'{"stage":<24}{"seconds":>12}{"calls":>10}{"share":>8}', file=stream)
+        for name, seconds in sorted(metrics.timings.items(), key=lambda item: -item[1]):
+            share = seconds / total if total else 0.0
+            print(f'{name:<24}{seconds:>12.3f}{metrics.calls[name]:>10}{share:>8.1%}', file=stream)
+        print('', file=stream)
+        for name, value in sorted(metrics.counters.items()):
+            print(f'{name:<24}{value:>12}', file=stream)
+        latency = metrics.histograms.get('file_latency_seconds')
+        if latency is not None and latency.count:
+            print(f'{"mean file latency":<24}{latency.sum / latency.count:>12.3f}', file=stream)
+
+
+# The metrics of this process, shared by all modules of the ETL
+metrics = Metrics()
+
+
+def stage(name: str):
+    """Measures the time of a with block in the metrics of this process."""
+    return metrics.stage(name)
+
+
+def add_exporters(jsonl_file: str = None, prometheus_file: str = None, summary: bool = False) -> None:
+    """Adds the exporters that are selected, e.g. from command line arguments, to the metrics."""
+    if jsonl_file is not None:
+        metrics.add_exporter(JsonLinesExporter(jsonl_file))
+    if prometheus_file is not None:
+        metrics.add_exporter(PrometheusExporter(prometheus_file))
+    if summary:
+        metrics.add_exporter(SummaryExporter())
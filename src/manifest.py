@@ -0,0 +1,134 @@
+import os
+import json
+import hashlib
+from typing import Dict, Iterable, Iterator, List, NamedTuple
+
+from discovery import FileInfo
+from sql_queries import load_manifest_insert, load_manifest_select, load_manifest_touch
+
+
+STATUS_LOADED = 'loaded'
+STATUS_FAILED = 'failed'
+
+
+class Fingerprint(NamedTuple):
+    """Size, modification time and content hash of a file."""
+    file_size: int
+    file_mtime: float
+    content_hash: str
+
+
+def hash_file(filepath: str, block_size: int = 1 << 20) -> str:
+    """Returns the sha256 hash of the content of a file."""
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class Manifest:
+    """Keeps track of the files that have been loaded, backed by the table "load_manifest".
+
+    A file is loaded again if it is new, if its last load failed or if its content changed.
+    The content hash is only computed if size or mtime differ from the manifest, so that
+    unchanged files cost one stat call. A file is marked as loaded in the same transaction
+    as its data, hence a crashed run resumes at the first file that has not been committed.
+
+    Note: songplays has no natural key, the songplays of a previous version of a log file can
+    not be told apart from the others. Changed files in an `append_only` directory (the log
+    data) are therefore not loaded again, they are reported and skipped instead of inserting
+    their songplays twice. Load them with a full reload.
+    """
+    def __init__(self, cur, append_only: Iterable[str] = ()):
+        """Instantiate a manifest and read its current entries from the database.
+
+        Args:
+            cur: The cursor from the database connection with psycopg2.
+            append_only (Iterable[str]):
+              Directories whose files can only be added, e.g. "data/log_data". A changed file
+              of these directories is skipped.
+        """
+        self.cur = cur
+        # the discovery yields absolute paths, relative directories are resolved like them
+        self.append_only = tuple(os.path.join(os.path.abspath(directory), '') for directory in append_only)
+        self.entries = {}
+        self.fingerprints = {}
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Reads all entries of the table "load_manifest"."""
+        self.cur.execute(load_manifest_select)
+        self.entries = {filepath: (Fingerprint(file_size, file_mtime, content_hash), status)
+                        for filepath, file_size, file_mtime, content_hash, status in self.cur.fetchall()}
+
+    def needs_loading(self, filepath: str, file_size: int = None, file_mtime: float = None) -> bool:
+        """Returns True if the file is new, has changed (unless it is append-only) or failed to load the last time.
+
+        Size and mtime are read with `os.stat`, unless the discovery has passed them already.
+        """
+        if file_size is None or file_mtime is None:
+            stat = os.stat(filepath)
+            file_size, file_mtime = stat.st_size, stat.st_mtime
+        entry = self.entries.get(filepath)
+
+        if entry is not None:
+            fingerprint, status = entry
+            if status == STATUS_LOADED and (file_size, file_mtime) == fingerprint[:2]:
+                return False
+
+        fingerprint = Fingerprint(file_size, file_mtime, hash_file(filepath))
+        self.fingerprints[filepath] = fingerprint
+
+        if entry is not None and entry[1] == STATUS_LOADED and entry[0].content_hash == fingerprint.content_hash:
+            # touched, but not changed: only remember the new mtime
+            self.touch(filepath, fingerprint)
+            return False
+        if entry is not None and entry[1] == STATUS_LOADED and self.is_append_only(filepath):
+            print(f'Skipped {filepath}: it has changed since it was loaded and its rows can not be replaced. '
+                  f'Reload the data without --incremental to load it.')
+            return False
+        return True
+
+    def is_append_only(self, filepath: str) -> bool:
+        """Returns True if the file is in one of the `append_only` directories."""
+        return os.path.abspath(filepath).startswith(self.append_only)
+
+    def filter_files(self, files: List[str]) -> List[str]:
+        """Returns the files that need to be loaded and prints how many are skipped."""
+        files_to_load = [filepath for filepath in files if self.needs_loading(filepath)]
+        print(f'{len(files) - len(files_to_load)} files skipped, they have been loaded before.')
+        return files_to_load
+
+    def iter_files_to_load(self, file_infos: Iterable[FileInfo]) -> Iterator[str]:
+        """Yields the paths of the discovered files that need to be loaded, while they are discovered."""
+        for file_info in file_infos:
+            if self.needs_loading(*file_info):
+                yield file_info.path
+
+    def touch(self, filepath: str, fingerprint: Fingerprint) -> None:
+        """Records the new mtime of an unchanged file and keeps its row counts.
+
+        The update is not part of the unit of a file, `CommitPolicy.finish` commits it.
+        """
+        self.cur.execute(load_manifest_touch, (fingerprint.file_mtime, filepath))
+        self.entries[filepath] = (fingerprint, STATUS_LOADED)
+
+    def mark(self, filepath: str, status: str, row_counts: Dict[str, int] = None) -> None:
+        """Upserts the entry of a file. Call it in the transaction that loads the file."""
+        fingerprint = self.fingerprints.get(filepath)
+        if fingerprint is None:
+            stat = os.stat(filepath)
+            fingerprint = Fingerprint(stat.st_size, stat.st_mtime, hash_file(filepath))
+
+        row_counts = json.dumps(row_counts) if row_counts is not None else None
+        self.cur.execute(load_manifest_insert, (filepath, *fingerprint, status, row_counts))
+        self.entries[filepath] = (fingerprint, status)
+
+    def mark_loaded(self, filepath: str, row_counts: Dict[str, int]) -> None:
+        """Marks a file as loaded together with the number of rows per table."""
+        self.mark(filepath, STATUS_LOADED, row_counts)
+
+    def mark_failed(self, filepath: str) -> None:
+        """Marks a file as failed, so that the next run loads it again."""
+        self.mark(filepath, STATUS_FAILED)
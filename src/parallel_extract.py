@@ -0,0 +1,97 @@
+import os
+import io
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import pandas as pd
+
+from instrumentation import metrics, stage
+from typed_json import decode_lines
+
+
+def get_default_workers() -> int:
+    """Returns the number of cores, which is the default number of workers."""
+    return os.cpu_count() or 1
+
+
+def read_json_lines(filepath: str, schema: Dict[str, str] = None) -> pd.DataFrame:
+    """Reads a file with line-delimited json (top level function, so that it can be pickled).
+
+    Reading the file and parsing the json are measured as the stages "read" and "parse".
+
+    Args:
+        filepath (str): The path to the file.
+        schema (Dict[str, str]):
+          The fields and their data types, e.g. `typed_json.LOG_DATA_SCHEMA`. Only these fields
+          are decoded, with the same dtypes for every file. None infers all fields with `pd.read_json`.
+    """
+    with stage('read'):
+        with open(filepath, 'rb') as f:
+            data = f.read()
+    with stage('parse'):
+        if schema is not None:
+            return decode_lines(data.splitlines(), schema)
+        return pd.read_json(io.BytesIO(data), lines=True)
+
+
+def call_safely(transformer: Callable, filepath: str, return_exceptions: bool):
+    """Calls the transformer and returns the exception instead of raising it if `return_exceptions`."""
+    try:
+        return transformer(filepath)
+    except Exception as error:
+        if not return_exceptions:
+            raise
+        return error
+
+
+def extract_files(files: List[str], transformer: Callable, workers: int = 1,
+                  prefetch: int = 4, return_exceptions: bool = False) -> Iterator[Tuple[str, object]]:
+    """Applies the transformer to every file, in a process pool if more than one worker is used.
+
+    The results are yielded in the order of `files`, no matter which worker finishes first.
+    The loader that consumes them therefore writes the same rows in the same order as the
+    serial path. At most `workers * prefetch` files are parsed ahead of the loader, so a slow
+    database does not make the parsed batches pile up in memory.
+
+    The stages that run in the worker processes are not recorded in the metrics of this
+    process, only the time the loader waits for a worker is recorded as "extract.wait".
+
+    Args:
+        files (List[str]): The paths to the files.
+        transformer (Callable):
+          A top level function that takes a path and returns the parsed data, e.g.
+          `transform.transform_song_file`.
+        workers (int): The number of worker processes. 1 parses the files in this process.
+        prefetch (int): How many files per worker may be parsed ahead of the loader.
+        return_exceptions (bool):
+          If True, an exception of the transformer is yielded as the result of its file
+          instead of being raised, so that the other files can still be processed.
+
+    Yields:
+        Tuple[str, object]: The path of the file and the result of the transformer.
+    """
+    if workers <= 1:
+        for filepath in files:
+            yield filepath, call_safely(transformer, filepath, return_exceptions)
+        return
+
+    files = iter(files)
+    in_flight = deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for filepath in files:
+            in_flight.append((filepath, pool.submit(call_safely, transformer, filepath, return_exceptions)))
+            if len(in_flight) >= workers * prefetch:
+                break
+
+        while in_flight:
+            filepath, future = in_flight.popleft()
+            start = time.perf_counter()
+            result = future.result()
+            metrics.add_time('extract.wait', time.perf_counter() - start)
+            next_filepath = next(files, None)
+            if next_filepath is not None:
+                in_flight.append((next_filepath,
+                                  pool.submit(call_safely, transformer, next_filepath, return_exceptions)))
+            yield filepath, result
@@ -0,0 +1,75 @@
+import pandas as pd
+
+from TableProperties import TableProperties
+from bulk_load import load_dataframe
+
+
+class PartitionedTable:
+    """Loads a table that is partitioned by month (e.g. songplays) directly into its partitions.
+
+    The partition of a month is created the first time a row of that month shows up. The rows
+    of a batch are split by month and every month is loaded into its partition, so a load only
+    touches the indexes of the partitions it writes to.
+    """
+    def __init__(self, table_properties: TableProperties):
+        """Instantiate a loader that has not created any partitions yet.
+
+        Args:
+            table_properties (TableProperties): The properties of a table with a `partitioning`.
+        """
+        if table_properties.partitioning is None:
+            raise ValueError(f'The table {table_properties.table_name} is not partitioned.')
+        self.table_properties = table_properties
+        self.partitioning = table_properties.partitioning
+        self.key_position = table_properties.insert_columns.index(self.partitioning.column)
+        self.partitions = {}
+        self.unit_months = []
+
+    def begin_unit(self) -> None:
+        """Starts remembering the partitions that one unit of work creates, see `rollback_unit`."""
+        self.unit_months = []
+
+    def rollback_unit(self) -> None:
+        """Forgets the partitions of a unit whose transaction (and CREATE TABLE) has been rolled back."""
+        for month in self.unit_months:
+            self.partitions.pop(month, None)
+        self.unit_months = []
+
+    @staticmethod
+    def get_months(start_times: pd.Series) -> pd.Series:
+        """Returns the month ("2018_11") of every value in epoch milliseconds."""
+        return pd.to_datetime(start_times, unit='ms').dt.strftime('%Y_%m')
+
+    def get_partition(self, cur, month: str) -> TableProperties:
+        """Returns the properties of the partition of a month, which is created if it does not exist."""
+        if month not in self.partitions:
+            table_name = self.table_properties.table_name
+            partition_name = self.partitioning.get_partition_name(table_name, month)
+            # concurrent loaders create a partition one after the other, until the creator commits
+            cur.execute('SELECT pg_advisory_xact_lock(hashtext(%s));', (partition_name,))
+            cur.execute(self.partitioning.get_query_create_partition(table_name, month))
+            self.partitions[month] = self.table_properties.get_partition_properties(partition_name)
+            self.unit_months.append(month)
+        return self.partitions[month]
+
+    def load(self, cur, df: pd.DataFrame, load_mode: str = 'rows') -> int:
+        """Loads the rows of a batch month by month into their partitions.
+
+        Args:
+            cur: The cursor from the database connection with psycopg2.
+            df (pd.DataFrame): The rows, columns in the order of the insert columns.
+            load_mode (str): "rows", "values" or "copy", see `bulk_load.load_dataframe`.
+
+        Returns:
+            int: The number of rows that have been sent to the database.
+        """
+        num_rows = 0
+        months = self.get_months(df.iloc[:, self.key_position])
+        for month, df_month in df.groupby(months, sort=True):
+            num_rows += load_dataframe(cur, self.get_partition(cur, month), df_month, load_mode)
+        return num_rows
+
+    def truncate_month(self, cur, month: str) -> None:
+        """Removes the rows of one month, e.g. to load its log files again."""
+        self.get_partition(cur, month)
+        cur.execute(self.partitions[month].queries['truncate'])
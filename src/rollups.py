@@ -0,0 +1,201 @@
+import re
+import argparse
+from datetime import date, datetime
+from typing import Dict, List
+
+import pandas as pd
+
+from sql_queries import *
+from bulk_load import load_dataframe
+from db import connect
+from instrumentation import stage
+
+
+# The first pattern that matches a user agent names its browser and its operating system
+BROWSER_PATTERNS = [('Internet Explorer', re.compile(r'MSIE |Trident/')),
+                    ('Edge', re.compile(r'Edge/')),
+                    ('Chromium', re.compile(r'Chromium/')),
+                    ('Chrome', re.compile(r'Chrome/')),
+                    ('Firefox', re.compile(r'Firefox/')),
+                    ('Safari', re.compile(r'Safari/'))]
+OS_PATTERNS = [('iOS', re.compile(r'iPhone|iPad')),
+               ('Android', re.compile(r'Android')),
+               ('Mac OS X', re.compile(r'Mac OS X')),
+               ('Windows', re.compile(r'Windows')),
+               ('Linux', re.compile(r'Linux|X11'))]
+OTHER = 'Other'
+
+USER_AGENT_DIMENSIONS = ('browser', 'os')
+
+
+def parse_user_agent(user_agent: str) -> tuple:
+    """Returns the browser and the operating system of a user agent, e.g. ('Chrome', 'Mac OS X')."""
+    user_agent = user_agent or ''
+    browser = next((name for name, pattern in BROWSER_PATTERNS if pattern.search(user_agent)), OTHER)
+    os_name = next((name for name, pattern in OS_PATTERNS if pattern.search(user_agent)), OTHER)
+    return browser, os_name
+
+
+def parse_user_agents(user_agents: pd.Series) -> pd.DataFrame:
+    """Parses a column of user agents, every distinct user agent is only parsed once."""
+    parsed = {user_agent: parse_user_agent(user_agent) for user_agent in user_agents.unique()}
+    return pd.DataFrame(user_agents.map(parsed).tolist(), columns=['browser', 'os'], index=user_agents.index)
+
+
+def count_plays(df: pd.DataFrame, key_columns: List[str]) -> pd.DataFrame:
+    """Counts the rows per key, the columns are the key columns and "plays"."""
+    return df.groupby(key_columns, sort=False).size().reset_index(name='plays')
+
+
+def get_rollup_deltas(df_songplays: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """Aggregates a batch of songplays into the rows that are added to every rollup.
+
+    Args:
+        df_songplays (pd.DataFrame): The songplays of a batch as built by `song_lookup.get_songplays`.
+
+    Returns:
+        Dict[str, pd.DataFrame]: The name of every rollup table and its plays per key in the batch.
+    """
+    start_times = pd.to_datetime(df_songplays['start_time'], unit='ms')
+    days = start_times.dt.date
+
+    df_songs = pd.DataFrame({'song_id': df_songplays['song_id'], 'day': days}).dropna(subset=['song_id'])
+    df_levels = pd.DataFrame({'hour': start_times.dt.floor('h'), 'level': df_songplays['level']})
+    df_user_agents = parse_user_agents(df_songplays['user_agent'])
+    df_user_agents.insert(0, 'day', days)
+
+    return {songplays_by_song_day_properties.table_name: count_plays(df_songs, ['song_id', 'day']),
+            songplays_by_level_hour_properties.table_name: count_plays(df_levels, ['hour', 'level']),
+            songplays_by_user_agent_properties.table_name: count_plays(df_user_agents, ['day', 'browser', 'os'])}
+
+
+def load_rollups(cur, df_songplays: pd.DataFrame, load_mode: str = 'rows') -> Dict[str, int]:
+    """Adds the plays of a batch of songplays to the rollups.
+
+    Call it with the cursor that loads the songplays, so that the rollups are updated in the
+    same transaction (and rolled back with the same savepoint) as the songplays they count.
+
+    Args:
+        cur: The cursor from the database connection with psycopg2.
+        df_songplays (pd.DataFrame): The songplays of a batch as built by `song_lookup.get_songplays`.
+        load_mode (str): "rows", "values" or "copy", see `bulk_load.load_dataframe`.
+
+    Returns:
+        Dict[str, int]: The number of rows that have been sent to each rollup table.
+    """
+    if df_songplays.empty:
+        return {}
+    with stage('rollups'):
+        deltas = get_rollup_deltas(df_songplays)
+    return {properties.table_name: load_dataframe(cur, properties, deltas[properties.table_name], load_mode)
+            for properties in rollup_properties}
+
+
+def rebuild_rollups(cur) -> None:
+    """Recomputes the rollups from songplays, e.g. after a month has been truncated and reloaded.
+
+    The plays per song and per level are aggregated in the database. The user agents are
+    aggregated per day in the database and parsed here.
+    """
+    cur.execute(f'TRUNCATE {", ".join(properties.table_name for properties in rollup_properties)};')
+    cur.execute(songplays_by_song_day_rebuild)
+    cur.execute(songplays_by_level_hour_rebuild)
+
+    cur.execute(songplays_by_day_and_user_agent_select)
+    df = pd.DataFrame(cur.fetchall(), columns=['day', 'user_agent', 'plays'])
+    if df.empty:
+        return
+    df_user_agents = parse_user_agents(df['user_agent'])
+    df_user_agents.insert(0, 'day', df['day'])
+    df_user_agents['plays'] = df['plays']
+    df_user_agents = df_user_agents.groupby(['day', 'browser', 'os'], sort=False)['plays'].sum().reset_index()
+    load_dataframe(cur, songplays_by_user_agent_properties, df_user_agents, 'values')
+
+
+def rebuild_new_rollups(cur, applied_queries: List[str]) -> bool:
+    """Fills the rollups from songplays if `SchemaManager.apply` has just created them.
+
+    Returns True if the rollups have been rebuilt. Commit afterwards.
+    """
+    if not any(properties.queries['create_table'] in applied_queries for properties in rollup_properties):
+        return False
+    rebuild_rollups(cur)
+    return True
+
+
+def get_most_played_songs(cur, limit: int = 10, start_day: date = None, end_day: date = None) -> List[tuple]:
+    """Returns the most played songs as (song_id, title, artist name, plays).
+
+    Args:
+        cur: The cursor from the database connection with psycopg2.
+        limit (int): The number of songs.
+        start_day (date): The first day that is counted. None means since the first play.
+        end_day (date): The first day that is not counted anymore. None means until today.
+    """
+    cur.execute(most_played_songs_select, (start_day, end_day, limit))
+    return cur.fetchall()
+
+
+def get_plays_by_level(cur, start: datetime = None, end: datetime = None) -> Dict[str, int]:
+    """Returns the number of plays of free and paid users, e.g. {'free': 1229, 'paid': 5591}."""
+    cur.execute(plays_by_level_select, (start, end))
+    return {level: int(plays) for level, plays in cur.fetchall()}
+
+
+def get_plays_by_hour_of_day(cur, start: datetime = None, end: datetime = None) -> Dict[int, int]:
+    """Returns the number of plays per hour of the day (UTC), 0 to 23."""
+    cur.execute(plays_by_hour_of_day_select, (start, end))
+    return {hour: int(plays) for hour, plays in cur.fetchall()}
+
+
+def get_user_agent_share(cur, dimension: str = 'browser', start_day: date = None,
+                         end_day: date = None) -> Dict[str, float]:
+    """Returns the share of the plays per browser or per operating system, largest first.
+
+    Args:
+        cur: The cursor from the database connection with psycopg2.
+        dimension (str): Either "browser" or "os".
+        start_day (date): The first day that is counted. None means since the first play.
+        end_day (date): The first day that is not counted anymore. None means until today.
+    """
+    if dimension not in USER_AGENT_DIMENSIONS:
+        raise ValueError(f'dimension must be one of {USER_AGENT_DIMENSIONS}, got "{dimension}".')
+    cur.execute(plays_by_user_agent_select, (start_day, end_day))
+    plays = {}
+    for browser, os_name, num_plays in cur.fetchall():
+        name = browser if dimension == 'browser' else os_name
+        plays[name] = plays.get(name, 0) + int(num_plays)
+    total = sum(plays.values())
+    return {name: num_plays / total for name, num_plays in sorted(plays.items(), key=lambda item: -item[1])}
+
+
+def print_report(cur) -> None:
+    """Prints the answers to the questions of the README, read from the rollups."""
+    print('Most played songs:')
+    for song_id, title, artist_name, plays in get_most_played_songs(cur):
+        print(f'  {plays:>6}  {title} ({artist_name})')
+    print('Plays by level:')
+    for level, plays in get_plays_by_level(cur).items():
+        print(f'  {level:<8} {plays}')
+    print('Plays by hour of the day (UTC):')
+    for hour, plays in get_plays_by_hour_of_day(cur).items():
+        print(f'  {hour:02d}:00 {plays}')
+    for dimension in USER_AGENT_DIMENSIONS:
+        print(f'Share of plays by {dimension}:')
+        for name, share in get_user_agent_share(cur, dimension).items():
+            print(f'  {name:<20} {share:.1%}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prints the analytics of sparkify from the rollups.')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Recompute the rollups from songplays before printing them.')
+    args = parser.parse_args()
+
+    conn = connect()
+    cur = conn.cursor()
+    if args.rebuild:
+        rebuild_rollups(cur)
+        conn.commit()
+    print_report(cur)
+    conn.close()
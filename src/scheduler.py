@@ -0,0 +1,107 @@
+import io
+from typing import Dict, Iterable, Iterator, List, NamedTuple
+
+import pandas as pd
+
+from discovery import FileInfo
+from instrumentation import stage
+from typed_json import decode_text
+
+
+# The default size of a unit of work
+DEFAULT_UNIT_BYTES = 64 * 1024 ** 2
+
+
+class FilePart(NamedTuple):
+    """The lines of a file that start in the byte range [start, end). end None means to the end."""
+    path: str
+    start: int = 0
+    end: int = None
+
+
+class WorkUnit(NamedTuple):
+    """Parts of files that are read, transformed, loaded and committed together."""
+    parts: List[FilePart]
+    size: int
+
+    def __str__(self) -> str:
+        first, last = self.parts[0], self.parts[-1]
+        if len(self.parts) == 1 and first.end is None and first.start == 0:
+            return first.path
+        if len(self.parts) == 1:
+            return f'{first.path} [{first.start}:{first.end}]'
+        return f'{len(self.parts)} files from {first.path} to {last.path}'
+
+
+def schedule(file_infos: Iterable[FileInfo], unit_bytes: int = DEFAULT_UNIT_BYTES) -> Iterator[WorkUnit]:
+    """Groups small files into units of about `unit_bytes` and splits larger files into byte ranges.
+
+    Files keep their order, so the units load the rows in the same order as file by file.
+    All units are about equally large, so parallel workers finish at about the same time.
+
+    Args:
+        file_infos (Iterable[FileInfo]): The files with their size, e.g. from `discovery.iter_files`.
+        unit_bytes (int): The target size of a unit.
+
+    Yields:
+        WorkUnit: The units of work, in the order of the files.
+    """
+    parts, size = [], 0
+    for file_info in file_infos:
+        if file_info.size > unit_bytes:
+            if parts:
+                yield WorkUnit(parts, size)
+                parts, size = [], 0
+            num_parts = -(-file_info.size // unit_bytes)
+            part_bytes = -(-file_info.size // num_parts)
+            for start in range(0, file_info.size, part_bytes):
+                end = start + part_bytes if start + part_bytes < file_info.size else None
+                yield WorkUnit([FilePart(file_info.path, start, end)], min(part_bytes, file_info.size - start))
+            continue
+
+        parts.append(FilePart(file_info.path))
+        size += file_info.size
+        if size >= unit_bytes:
+            yield WorkUnit(parts, size)
+            parts, size = [], 0
+    if parts:
+        yield WorkUnit(parts, size)
+
+
+def read_part(part: FilePart) -> str:
+    """Returns the lines of a file part.
+
+    A line belongs to the part in which it starts, like the splits of hadoop: A part that does
+    not start at 0 skips the line that started before it, and it reads the line that crosses
+    its end completely.
+    """
+    with open(part.path, 'rb') as f:
+        if part.start > 0:
+            f.seek(part.start - 1)
+            # skips the rest of the previous line, or only "\n" if the part starts at a line
+            f.readline()
+        if part.end is None:
+            data = f.read()
+        else:
+            lines = []
+            while f.tell() < part.end:
+                line = f.readline()
+                if not line:
+                    break
+                lines.append(line)
+            data = b''.join(lines)
+    return data.decode()
+
+
+def read_unit(unit: WorkUnit, schema: Dict[str, str] = None) -> pd.DataFrame:
+    """Reads all parts of a unit at once, which saves the overhead per file.
+
+    The fields of `schema` are decoded with `typed_json.decode_text`, None infers all fields
+    with one `pd.read_json`.
+    """
+    with stage('read'):
+        text = '\n'.join(read_part(part).strip('\n') for part in unit.parts)
+    with stage('parse'):
+        if schema is not None:
+            return decode_text(text, schema)
+        return pd.read_json(io.StringIO(text), lines=True)
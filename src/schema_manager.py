@@ -0,0 +1,255 @@
+from typing import Dict, List
+
+from TableProperties import TableProperties
+from sql_queries import all_table_properties, views
+
+
+# The schema that the tables of a reload are built in, before they are swapped into the live schema
+SHADOW_SCHEMA = 'sparkify_load'
+# The schema that the replaced tables are moved to during the swap, it is dropped afterwards
+RETIRED_SCHEMA = 'sparkify_retired'
+
+# Names of the data types of TableProperties in information_schema.columns
+DATA_TYPE_NAMES = {'INT': 'integer',
+                   'INTEGER': 'integer',
+                   'BIGINT': 'bigint',
+                   'TEXT': 'text',
+                   'DECIMAL': 'numeric',
+                   'NUMERIC': 'numeric',
+                   'DATE': 'date',
+                   'TIMESTAMP': 'timestamp without time zone',
+                   'DOUBLE PRECISION': 'double precision',
+                   'JSONB': 'jsonb'}
+
+RESET_MODES = ('drop', 'truncate', 'swap')
+
+
+class SchemaManager:
+    """Brings the tables of the sparkify database to the DDL of their TableProperties.
+
+    Instead of dropping the database or the tables, the desired tables, columns, constraints
+    and indexes are compared with information_schema and only the missing parts are created.
+    Data is removed with one TRUNCATE, and a full reload can be built in unlogged tables in
+    a shadow schema that are swapped with the live tables in one transaction at the end.
+    """
+    def __init__(self, cur, conn, tables: List[TableProperties] = None, managed_views: Dict[str, str] = None):
+        """Instantiate a schema manager.
+
+        Args:
+            cur: The cursor from the database connection with psycopg2.
+            conn: The database connection with psycopg2.
+            tables (List[TableProperties]): The managed tables, default all tables of sparkify.
+            managed_views (Dict[str, str]):
+              The names of the managed views and their "CREATE OR REPLACE VIEW" queries,
+              default all views of sparkify.
+        """
+        self.cur = cur
+        self.conn = conn
+        self.tables = tables or all_table_properties
+        self.views = views if managed_views is None else managed_views
+
+    def get_existing_columns(self, schema: str = None) -> Dict[str, Dict[str, str]]:
+        """Returns {table: {column: data type}} of the tables in `schema` (default: current schema)."""
+        self.cur.execute("""
+            SELECT table_name, column_name, data_type
+            FROM information_schema.columns
+            WHERE table_schema = COALESCE(%s, current_schema());
+        """, (schema,))
+        columns = {}
+        for table_name, column_name, data_type in self.cur.fetchall():
+            columns.setdefault(table_name, {})[column_name] = data_type
+        return columns
+
+    def get_existing_constraints(self, schema: str = None) -> set:
+        """Returns the names of the constraints in `schema` (default: current schema)."""
+        self.cur.execute("""
+            SELECT constraint_name
+            FROM information_schema.table_constraints
+            WHERE constraint_schema = COALESCE(%s, current_schema());
+        """, (schema,))
+        return {name for name, in self.cur.fetchall()}
+
+    def get_existing_indexes(self, schema: str = None) -> set:
+        """Returns the names of the indexes in `schema` (default: current schema)."""
+        self.cur.execute("""
+            SELECT indexname
+            FROM pg_indexes
+            WHERE schemaname = COALESCE(%s, current_schema());
+        """, (schema,))
+        return {name for name, in self.cur.fetchall()}
+
+    def get_existing_views(self, schema: str = None) -> set:
+        """Returns the names of the views in `schema` (default: current schema)."""
+        self.cur.execute("""
+            SELECT table_name
+            FROM information_schema.views
+            WHERE table_schema = COALESCE(%s, current_schema());
+        """, (schema,))
+        return {name for name, in self.cur.fetchall()}
+
+    def get_partitioned_tables(self) -> set:
+        """Returns the names of the partitioned tables in the current schema."""
+        self.cur.execute("""
+            SELECT c.relname
+            FROM pg_partitioned_table p
+            JOIN pg_class c
+              ON c.oid = p.partrelid
+            WHERE c.relnamespace = current_schema()::regnamespace;
+        """)
+        return {name for name, in self.cur.fetchall()}
+
+    def get_partitions(self, schema: str, table_name: str) -> List[str]:
+        """Returns the names of the partitions of a table."""
+        self.cur.execute("""
+            SELECT child.relname
+            FROM pg_inherits
+            JOIN pg_class child
+              ON child.oid = pg_inherits.inhrelid
+            JOIN pg_class parent
+              ON parent.oid = pg_inherits.inhparent
+            WHERE parent.relname = %s
+              AND parent.relnamespace = %s::regnamespace;
+        """, (table_name, schema))
+        return [name for name, in self.cur.fetchall()]
+
+    def diff(self, deferred: bool = False) -> List[str]:
+        """Returns the queries that bring the current schema to the desired DDL.
+
+        Missing tables, columns, constraints, indexes and views are created and columns with
+        another data type are altered. Columns that only exist in the database are kept. A table that
+        should be partitioned can not be converted, it has to be dropped (`etl.py --reset drop`).
+
+        Args:
+            deferred (bool):
+              If True, missing tables are created without the deferred constraints and the
+              secondary indexes ("load then index"), and these are not added to existing tables.
+        """
+        existing_columns = self.get_existing_columns()
+        existing_constraints = self.get_existing_constraints()
+        existing_indexes = self.get_existing_indexes()
+        partitioned_tables = self.get_partitioned_tables()
+        existing_views = self.get_existing_views()
+
+        queries = []
+        for properties in self.tables:
+            columns = existing_columns.get(properties.table_name)
+            if columns is None:
+                queries.append(properties.queries['create_table_deferred' if deferred else 'create_table'])
+                if not deferred:
+                    queries.extend(properties.queries['create_indexes'])
+                continue
+            if properties.partitioning is not None and properties.table_name not in partitioned_tables:
+                raise ValueError(f'The table {properties.table_name} is not partitioned yet, drop it to recreate it.')
+
+            for column, data_type in properties.get_column_definitions().items():
+                expected_type = DATA_TYPE_NAMES.get(data_type.upper(), data_type.lower())
+                if column not in columns:
+                    queries.append(f'ALTER TABLE {properties.table_name} ADD COLUMN {column} {data_type};')
+                elif columns[column] != expected_type:
+                    queries.append(f'ALTER TABLE {properties.table_name} ALTER COLUMN {column} '
+                                   f'TYPE {data_type} USING {column}::{data_type};')
+
+            for constraint in properties.constraints:
+                if constraint.name in existing_constraints:
+                    continue
+                if deferred and constraint in properties.deferred_constraints:
+                    continue
+                queries.append(constraint.get_query_add(properties.table_name))
+
+            if not deferred:
+                queries.extend(index.get_query_create(properties.table_name)
+                               for index in properties.indexes if index.name not in existing_indexes)
+
+        queries.extend(query for name, query in self.views.items() if name not in existing_views)
+        return queries
+
+    def apply(self, deferred: bool = False) -> List[str]:
+        """Executes the queries of `diff` in one transaction and returns them."""
+        queries = self.diff(deferred)
+        for query in queries:
+            self.cur.execute(query)
+        self.conn.commit()
+        return queries
+
+    def truncate(self, deferred: bool = False) -> None:
+        """Removes all rows with one TRUNCATE and restarts the sequences (e.g. of songplay_id).
+
+        Args:
+            deferred (bool):
+              If True, the deferred constraints and the secondary indexes are dropped as well,
+              so that they can be built after the load with `create_tables.build_indexes`.
+        """
+        table_names = ', '.join(properties.table_name for properties in self.tables)
+        self.cur.execute(f'TRUNCATE {table_names} RESTART IDENTITY CASCADE;')
+        if deferred:
+            for properties in self.tables:
+                for query in properties.queries['drop_deferred_constraints'] + properties.queries['drop_indexes']:
+                    self.cur.execute(query)
+        self.conn.commit()
+
+    def reset(self, deferred: bool = False) -> None:
+        """Creates what is missing and empties all tables, without dropping any table."""
+        self.apply(deferred)
+        self.truncate(deferred)
+
+    def create_shadow_tables(self) -> None:
+        """Creates empty unlogged tables in SHADOW_SCHEMA, without deferred constraints and indexes.
+
+        Load into them with a session whose search_path is SHADOW_SCHEMA (see `get_shadow_settings`)
+        while the live tables can still be queried, then call `swap`.
+        """
+        self.cur.execute(f'DROP SCHEMA IF EXISTS {SHADOW_SCHEMA} CASCADE;')
+        self.cur.execute(f'CREATE SCHEMA {SHADOW_SCHEMA};')
+        self.cur.execute(f'SET LOCAL search_path TO {SHADOW_SCHEMA};')
+        for properties in self.tables:
+            self.cur.execute(properties.queries['create_table_unlogged'])
+        self.conn.commit()
+
+    def swap(self) -> None:
+        """Makes the shadow tables durable, builds their constraints and indexes and swaps them in.
+
+        The shadow tables are set LOGGED and get their deferred constraints and indexes first
+        (partitioned tables can not be unlogged, they are logged from the start). Then, in one
+        transaction, the live tables and their partitions are moved to RETIRED_SCHEMA and the
+        shadow tables and their partitions to the current schema. The views are replaced in the
+        same transaction, so that they read the new tables. Readers of the live tables only wait
+        for this transaction, which moves catalog entries and no data. The retired tables are
+        dropped afterwards.
+        """
+        self.cur.execute('SELECT current_schema();')
+        live_schema = self.cur.fetchone()[0]
+
+        self.cur.execute(f'SET LOCAL search_path TO {SHADOW_SCHEMA};')
+        for properties in self.tables:
+            if properties.partitioning is None:
+                self.cur.execute(f'ALTER TABLE {properties.table_name} SET LOGGED;')
+        for properties in self.tables:
+            for query in properties.queries['add_deferred_constraints'] + properties.queries['create_indexes']:
+                self.cur.execute(query)
+        self.conn.commit()
+
+        existing_columns = self.get_existing_columns(live_schema)
+        self.cur.execute(f'DROP SCHEMA IF EXISTS {RETIRED_SCHEMA} CASCADE;')
+        self.cur.execute(f'CREATE SCHEMA {RETIRED_SCHEMA};')
+        for properties in self.tables:
+            if properties.table_name in existing_columns:
+                self.move_table(live_schema, properties.table_name, RETIRED_SCHEMA)
+            self.move_table(SHADOW_SCHEMA, properties.table_name, live_schema)
+        for query in self.views.values():
+            self.cur.execute(query)
+        self.conn.commit()
+
+        self.cur.execute(f'DROP SCHEMA {RETIRED_SCHEMA} CASCADE;')
+        self.cur.execute(f'DROP SCHEMA {SHADOW_SCHEMA} CASCADE;')
+        self.conn.commit()
+
+    def move_table(self, schema: str, table_name: str, new_schema: str) -> None:
+        """Moves a table and its partitions to another schema."""
+        for partition_name in self.get_partitions(schema, table_name):
+            self.cur.execute(f'ALTER TABLE {schema}.{partition_name} SET SCHEMA {new_schema};')
+        self.cur.execute(f'ALTER TABLE {schema}.{table_name} SET SCHEMA {new_schema};')
+
+
+def get_shadow_settings() -> Dict[str, str]:
+    """Returns the session settings that direct a loading session to the shadow tables."""
+    return {'search_path': SHADOW_SCHEMA}
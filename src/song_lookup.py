@@ -0,0 +1,208 @@
+import os
+import math
+import shutil
+import tempfile
+
+import pandas as pd
+
+from sql_queries import song_lookup_select
+from instrumentation import stage
+
+
+KEY_COLUMNS = ['title', 'artist_name', 'duration']
+ID_COLUMNS = ['song_id', 'artist_id']
+
+# Durations are stored with 5 decimals in song_data, rounding makes floats from the logs comparable.
+DURATION_DECIMALS = 5
+
+
+def empty_index() -> pd.DataFrame:
+    """Returns an index without any songs, but with the dtypes of a filled index."""
+    return pd.DataFrame({'title': pd.Series(dtype=object),
+                         'artist_name': pd.Series(dtype=object),
+                         'duration': pd.Series(dtype=float),
+                         'song_id': pd.Series(dtype=object),
+                         'artist_id': pd.Series(dtype=object)})
+
+
+def normalize_keys(titles: pd.Series, artist_names: pd.Series, durations: pd.Series) -> pd.DataFrame:
+    """Returns the lookup key (title, artist name, duration) in a normalized form.
+
+    Titles and artist names are compared as strings, durations are rounded to DURATION_DECIMALS.
+    """
+    return pd.DataFrame({'title': titles.astype(object).values,
+                         'artist_name': artist_names.astype(object).values,
+                         'duration': pd.to_numeric(durations).round(DURATION_DECIMALS).values})
+
+
+class SongLookup:
+    """Resolves song_id and artist_id of log events with a hash join instead of one query per event.
+
+    The index maps the normalized key (title, artist name, duration) to (song_id, artist_id). It
+    can be loaded once from the tables songs and artists or be built from the parsed song_data.
+    If `max_rows` is given and the catalog is larger, the index is split into hash partitions of
+    at most roughly `max_rows` rows that are spilled to disk. A batch is then resolved partition
+    by partition, so that only one partition is in memory at any time.
+    """
+    def __init__(self, max_rows: int = None, num_partitions: int = 1):
+        """Instantiate an empty lookup.
+
+        Args:
+            max_rows (int): The maximal number of index rows to hold in memory. None means unbounded.
+            num_partitions (int): The number of hash partitions. Use 1 to keep the index in memory.
+        """
+        self.max_rows = max_rows
+        self.num_partitions = num_partitions
+        self.index = empty_index()
+        self.spill_dir = tempfile.mkdtemp(prefix='song_lookup_') if num_partitions > 1 else None
+        self.num_chunks = 0
+
+    @staticmethod
+    def get_num_partitions(num_rows: int, max_rows: int = None) -> int:
+        """Returns how many partitions are needed to keep at most `max_rows` rows in memory."""
+        if max_rows is None or num_rows <= max_rows:
+            return 1
+        return math.ceil(num_rows / max_rows)
+
+    @classmethod
+    def from_song_data(cls, df_song_data: pd.DataFrame, max_rows: int = None):
+        """Builds the lookup from parsed song_data (without any database round trip).
+
+        Args:
+            df_song_data (pd.DataFrame): The song files as read by `pd.read_json(..., lines=True)`.
+            max_rows (int): The maximal number of index rows to hold in memory. None means unbounded.
+        """
+        lookup = cls(max_rows, cls.get_num_partitions(len(df_song_data.index), max_rows))
+        lookup.add(df_song_data['title'], df_song_data['artist_name'], df_song_data['duration'],
+                   df_song_data['song_id'], df_song_data['artist_id'])
+        return lookup
+
+    @classmethod
+    def from_database(cls, conn, max_rows: int = None, chunk_size: int = 100000):
+        """Loads songs joined with artists once and builds the lookup from it.
+
+        Args:
+            conn: The database connection with psycopg2.
+            max_rows (int): The maximal number of index rows to hold in memory. None means unbounded.
+            chunk_size (int): The number of rows to fetch at once from the server side cursor.
+        """
+        cur = conn.cursor()
+        cur.execute('SELECT COUNT(*) FROM songs;')
+        num_rows = cur.fetchone()[0]
+        cur.close()
+
+        lookup = cls(max_rows, cls.get_num_partitions(num_rows, max_rows))
+
+        # a named cursor is a server side cursor, so the catalog is streamed in chunks
+        cur = conn.cursor(name='song_lookup')
+        cur.itersize = chunk_size
+        cur.execute(song_lookup_select)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunk = pd.DataFrame(rows, columns=ID_COLUMNS + KEY_COLUMNS)
+            lookup.add(chunk['title'], chunk['artist_name'], chunk['duration'].astype(float),
+                       chunk['song_id'], chunk['artist_id'])
+        cur.close()
+        return lookup
+
+    def add(self, titles: pd.Series, artist_names: pd.Series, durations: pd.Series,
+            song_ids: pd.Series, artist_ids: pd.Series) -> None:
+        """Adds songs to the index. Keys that are already in the index keep their first ids."""
+        entries = normalize_keys(titles, artist_names, durations)
+        entries['song_id'] = song_ids.values
+        entries['artist_id'] = artist_ids.values
+        # NULL never equals anything in SQL, so keys with missing values can not match
+        entries = entries.dropna(subset=KEY_COLUMNS)
+
+        if self.num_partitions == 1:
+            self.index = pd.concat([self.index, entries], ignore_index=True)
+            self.index = self.index.drop_duplicates(subset=KEY_COLUMNS, keep='first')
+            return
+
+        partitions = self.get_partitions(entries)
+        for partition, part in entries.groupby(partitions):
+            part.to_pickle(os.path.join(self.get_partition_dir(partition), f'{self.num_chunks}.pkl'))
+        self.num_chunks += 1
+
+    def get_partitions(self, keys: pd.DataFrame) -> pd.Series:
+        """Returns the partition number of every key."""
+        hashes = pd.util.hash_pandas_object(keys[KEY_COLUMNS], index=False)
+        return hashes % self.num_partitions
+
+    def get_partition_dir(self, partition: int) -> str:
+        """Returns the directory that holds the spilled chunks of one partition."""
+        partition_dir = os.path.join(self.spill_dir, str(partition))
+        os.makedirs(partition_dir, exist_ok=True)
+        return partition_dir
+
+    def load_partition(self, partition: int) -> pd.DataFrame:
+        """Reads one spilled partition back into memory."""
+        partition_dir = self.get_partition_dir(partition)
+        chunks = [pd.read_pickle(os.path.join(partition_dir, f'{chunk}.pkl'))
+                  for chunk in range(self.num_chunks)
+                  if os.path.exists(os.path.join(partition_dir, f'{chunk}.pkl'))]
+        if not chunks:
+            return empty_index()
+        return pd.concat(chunks, ignore_index=True).drop_duplicates(subset=KEY_COLUMNS, keep='first')
+
+    def resolve(self, df_log: pd.DataFrame) -> pd.DataFrame:
+        """Resolves song_id and artist_id for a whole batch of log events with one merge.
+
+        Args:
+            df_log (pd.DataFrame): Log events with the columns "song", "artist" and "length".
+
+        Returns:
+            pd.DataFrame:
+              The columns "song_id" and "artist_id" with the same index as `df_log`. Events
+              without a matching song get None for both ids.
+        """
+        with stage('lookup'):
+            keys = normalize_keys(df_log['song'], df_log['artist'], df_log['length'])
+
+            if self.num_partitions == 1:
+                ids = self.join(keys, self.index)
+            else:
+                ids = pd.DataFrame(index=keys.index, columns=ID_COLUMNS)
+                partitions = self.get_partitions(keys)
+                for partition, part in keys.groupby(partitions):
+                    ids.loc[part.index] = self.join(part, self.load_partition(partition))
+
+            ids = ids.astype(object).where(ids.notna(), None)
+            ids.index = df_log.index
+            return ids
+
+    @staticmethod
+    def join(keys: pd.DataFrame, index: pd.DataFrame) -> pd.DataFrame:
+        """Left joins the keys with the index and returns the ids with the index of `keys`."""
+        merged = keys.merge(index, how='left', on=KEY_COLUMNS)
+        merged.index = keys.index
+        return merged[ID_COLUMNS]
+
+    def close(self) -> None:
+        """Removes the spilled partitions from disk."""
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+
+def get_songplays(df_log: pd.DataFrame, song_lookup: SongLookup) -> pd.DataFrame:
+    """Builds the songplays records of a batch of NextSong events.
+
+    Args:
+        df_log (pd.DataFrame): The NextSong events of the log files.
+        song_lookup (SongLookup): The lookup that resolves song_id and artist_id.
+
+    Returns:
+        pd.DataFrame: The songplays with the columns in the order of the insert columns.
+    """
+    ids = song_lookup.resolve(df_log)
+    return pd.DataFrame({'start_time': df_log['ts'],
+                         'user_id': df_log['userId'],
+                         'level': df_log['level'],
+                         'song_id': ids['song_id'],
+                         'artist_id': ids['artist_id'],
+                         'session_id': df_log['sessionId'],
+                         'location': df_log['location'],
+                         'user_agent': df_log['userAgent']})
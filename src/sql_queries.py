@@ -1,4 +1,4 @@
-from TableProperties import TableProperties
+from TableProperties import Index, MonthlyPartitioning, TableProperties
 
 
 users_properties = TableProperties('users',
@@ -6,21 +6,27 @@ users_properties = TableProperties('users',
                                     ('first_name', 'TEXT NOT NULL'),
                                     ('last_name', 'TEXT NOT NULL'),
                                     ('gender', 'TEXT NOT NULL'),
-                                    ('level', 'TEXT NOT NULL')])
+                                    ('level', 'TEXT NOT NULL'),
+                                    ('last_start_time', 'BIGINT NOT NULL')],
+                                   update_columns=['first_name', 'last_name', 'level'],
+                                   version_column='last_start_time')
 
 songs_properties = TableProperties('songs',
                                    [('song_id', 'TEXT PRIMARY KEY'),
                                     ('title', 'TEXT NOT NULL'),
                                     ('artist_id', 'TEXT NOT NULL REFERENCES artists(artist_id)'),
                                     ('year', 'INT NOT NULL'),
-                                    ('duration', 'DECIMAL NOT NULL')])
+                                    ('duration', 'DECIMAL NOT NULL')],
+                                   indexes=[Index('songs_title_duration_idx', ['title', 'duration'])])
 
 artists_properties = TableProperties('artists',
                                      [('artist_id', 'TEXT PRIMARY KEY'),
                                       ('name', 'TEXT'),
                                       ('location', 'TEXT'),
                                       ('latitude', 'DECIMAL'),
-                                      ('longitude', 'DECIMAL')])
+                                      ('longitude', 'DECIMAL')],
+                                     indexes=[Index('artists_name_idx', ['name'])],
+                                     update_columns=['name', 'location', 'latitude', 'longitude'])
 
 time_properties = TableProperties('time',
                                   [('start_time', 'TIMESTAMP PRIMARY KEY'),
@@ -31,6 +37,15 @@ time_properties = TableProperties('time',
                                    ('year', 'INT NOT NULL'),
                                    ('weekday', 'INT NOT NULL')])
 
+# Dictionaries of the few distinct locations and user agents, songplays only stores their keys
+locations_properties = TableProperties('locations',
+                                       [('location_id', 'SERIAL PRIMARY KEY'),
+                                        ('location', 'TEXT NOT NULL UNIQUE')])
+
+user_agents_properties = TableProperties('user_agents',
+                                         [('user_agent_id', 'SERIAL PRIMARY KEY'),
+                                          ('user_agent', 'TEXT NOT NULL UNIQUE')])
+
 songplays_properties = TableProperties('songplays',
                                        [('songplay_id', 'SERIAL PRIMARY KEY'),
                                         ('start_time', 'BIGINT NOT NULL'),
@@ -39,22 +54,76 @@ songplays_properties = TableProperties('songplays',
                                         ('song_id', 'TEXT REFERENCES songs(song_id)'),
                                         ('artist_id', 'TEXT REFERENCES artists(artist_id)'),
                                         ('session_id', 'TEXT NOT NULL'),
-                                        ('location', 'TEXT NOT NULL'),
-                                        ('user_agent', 'TEXT NOT NULL')])
+                                        ('location_id', 'INT NOT NULL REFERENCES locations(location_id)'),
+                                        ('user_agent_id', 'INT NOT NULL REFERENCES user_agents(user_agent_id)')],
+                                       partitioning=MonthlyPartitioning('start_time'),
+                                       dictionaries={'location_id': locations_properties,
+                                                     'user_agent_id': user_agents_properties})
+
+load_manifest_properties = TableProperties('load_manifest',
+                                           [('filepath', 'TEXT PRIMARY KEY'),
+                                            ('file_size', 'BIGINT NOT NULL'),
+                                            ('file_mtime', 'DOUBLE PRECISION NOT NULL'),
+                                            ('content_hash', 'TEXT NOT NULL'),
+                                            ('status', 'TEXT NOT NULL'),
+                                            ('row_counts', 'JSONB'),
+                                            ('updated_at', 'TIMESTAMP NOT NULL DEFAULT now()')])
+
+# Chunks of files that loader processes claim and load in coordinated mode (see work_queue.py)
+load_queue_properties = TableProperties('load_queue',
+                                        [('chunk_id', 'SERIAL PRIMARY KEY'),
+                                         ('dataset', 'TEXT NOT NULL'),
+                                         ('parts', 'JSONB NOT NULL'),
+                                         ('size', 'BIGINT NOT NULL'),
+                                         ('status', 'TEXT NOT NULL'),
+                                         ('attempts', 'INT NOT NULL DEFAULT 0'),
+                                         ('releases', 'INT NOT NULL DEFAULT 0'),
+                                         ('worker', 'TEXT'),
+                                         ('lease_until', 'TIMESTAMP'),
+                                         ('row_counts', 'JSONB'),
+                                         ('updated_at', 'TIMESTAMP NOT NULL DEFAULT now()')])
+
+# ROLLUPS, the plays of every loaded batch are added to them (see rollups.py)
+
+songplays_by_song_day_properties = TableProperties('songplays_by_song_day',
+                                                   [('song_id', 'TEXT NOT NULL'),
+                                                    ('day', 'DATE NOT NULL'),
+                                                    ('plays', 'BIGINT NOT NULL')],
+                                                   key_columns=['song_id', 'day'],
+                                                   accumulate_columns=['plays'])
+
+songplays_by_level_hour_properties = TableProperties('songplays_by_level_hour',
+                                                     [('hour', 'TIMESTAMP NOT NULL'),
+                                                      ('level', 'TEXT NOT NULL'),
+                                                      ('plays', 'BIGINT NOT NULL')],
+                                                     key_columns=['hour', 'level'],
+                                                     accumulate_columns=['plays'])
+
+songplays_by_user_agent_properties = TableProperties('songplays_by_user_agent',
+                                                     [('day', 'DATE NOT NULL'),
+                                                      ('browser', 'TEXT NOT NULL'),
+                                                      ('os', 'TEXT NOT NULL'),
+                                                      ('plays', 'BIGINT NOT NULL')],
+                                                     key_columns=['day', 'browser', 'os'],
+                                                     accumulate_columns=['plays'])
 
 # Manually create INSERT INTO statements
 users_properties.queries['insert_into'] = """
         INSERT INTO
-          users (user_id, first_name, last_name, gender, level)
+          users (user_id, first_name, last_name, gender, level, last_start_time)
         VALUES
-          ((%s), (%s), (%s), (%s), (%s))
+          ((%s), (%s), (%s), (%s), (%s), (%s))
         ON CONFLICT (user_id) 
         DO 
           UPDATE 
             SET 
               first_name = EXCLUDED.first_name,
               last_name = EXCLUDED.last_name,
-              level = EXCLUDED.level;
+              level = EXCLUDED.level,
+              last_start_time = EXCLUDED.last_start_time
+            WHERE
+              users.last_start_time IS NULL
+              OR EXCLUDED.last_start_time > users.last_start_time;
 """
 
 songs_properties.queries['insert_into'] = """
@@ -78,7 +147,10 @@ artists_properties.queries['insert_into'] = """
               name = EXCLUDED.name,
               location = EXCLUDED.location,
               latitude = EXCLUDED.latitude,
-              longitude = EXCLUDED.longitude;
+              longitude = EXCLUDED.longitude
+            WHERE
+              (artists.name, artists.location, artists.latitude, artists.longitude)
+              IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.location, EXCLUDED.latitude, EXCLUDED.longitude);
 """
 time_properties.queries['insert_into'] = """
         INSERT INTO
@@ -89,11 +161,26 @@ time_properties.queries['insert_into'] = """
 """
 songplays_properties.queries['insert_into'] = """
         INSERT INTO
-          songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+          songplays (start_time, user_id, level, song_id, artist_id, session_id, location_id, user_agent_id)
         VALUES
           ((%s), (%s), (%s), (%s), (%s), (%s), (%s), (%s));
 """
-
+load_manifest_properties.queries['insert_into'] = """
+        INSERT INTO
+          load_manifest (filepath, file_size, file_mtime, content_hash, status, row_counts)
+        VALUES
+          ((%s), (%s), (%s), (%s), (%s), (%s))
+        ON CONFLICT (filepath)
+        DO
+          UPDATE
+            SET
+              file_size = EXCLUDED.file_size,
+              file_mtime = EXCLUDED.file_mtime,
+              content_hash = EXCLUDED.content_hash,
+              status = EXCLUDED.status,
+              row_counts = EXCLUDED.row_counts,
+              updated_at = now();
+"""
 
 # DROP TABLES
 
@@ -102,6 +189,10 @@ user_table_drop = users_properties.queries['drop_table']
 song_table_drop = songs_properties.queries['drop_table']
 artist_table_drop = artists_properties.queries['drop_table']
 time_table_drop = time_properties.queries['drop_table']
+load_manifest_table_drop = load_manifest_properties.queries['drop_table']
+load_queue_table_drop = load_queue_properties.queries['drop_table']
+location_table_drop = locations_properties.queries['drop_table']
+user_agent_table_drop = user_agents_properties.queries['drop_table']
 
 # CREATE TABLES
 
@@ -110,6 +201,10 @@ user_table_create = users_properties.queries['create_table']
 song_table_create = songs_properties.queries['create_table']
 artist_table_create = artists_properties.queries['create_table']
 time_table_create = time_properties.queries['create_table']
+load_manifest_table_create = load_manifest_properties.queries['create_table']
+load_queue_table_create = load_queue_properties.queries['create_table']
+location_table_create = locations_properties.queries['create_table']
+user_agent_table_create = user_agents_properties.queries['create_table']
 
 # INSERT RECORDS
 
@@ -118,6 +213,13 @@ user_table_insert = users_properties.queries['insert_into']
 song_table_insert = songs_properties.queries['insert_into']
 artist_table_insert = artists_properties.queries['insert_into']
 time_table_insert = time_properties.queries['insert_into']
+load_manifest_insert = load_manifest_properties.queries['insert_into']
+
+# VIEWS
+
+# songplays with the columns location and user_agent, as before they were dictionary-encoded
+songplays_decoded_view_create = songplays_properties.get_query_create_view('songplays_decoded')
+songplays_decoded_view_drop = 'DROP VIEW IF EXISTS songplays_decoded;'
 
 # FIND SONGS
 
@@ -132,12 +234,227 @@ WHERE
     AND duration = %s;
 """)
 
+# MANIFEST
+
+load_manifest_select = ("""
+SELECT filepath, file_size, file_mtime, content_hash, status
+FROM load_manifest;
+""")
+
+# An incremental run refuses an empty manifest if songplays has been loaded without one
+songplays_exist_select = ("""
+SELECT EXISTS (SELECT 1 FROM songplays);
+""")
+
+# A file that has been touched, but not changed, only gets its new mtime, the row counts are kept
+load_manifest_touch = ("""
+UPDATE load_manifest
+SET file_mtime = %s, updated_at = now()
+WHERE filepath = %s;
+""")
+
+# WORK QUEUE
+
+# Serializes the registration of the chunks, the first worker registers them
+load_queue_lock = ("""
+SELECT pg_advisory_xact_lock(hashtext('load_queue'));
+""")
+
+load_queue_count = ("""
+SELECT COUNT(*)
+FROM load_queue
+WHERE dataset = %s;
+""")
+
+# For execute_values, the rows are (dataset, parts, size, status)
+load_queue_insert = ("""
+INSERT INTO load_queue (dataset, parts, size, status)
+VALUES %s;
+""")
+
+# A chunk whose lease has expired (its worker died) is claimed again until it has been
+# claimed max_attempts times, then it fails
+load_queue_expire = ("""
+UPDATE load_queue
+SET status = 'failed', updated_at = now()
+WHERE dataset = %(dataset)s
+  AND status = 'claimed'
+  AND lease_until < now()
+  AND attempts - releases >= %(max_attempts)s;
+""")
+
+load_queue_claim = ("""
+UPDATE load_queue
+SET status = 'claimed',
+    worker = %(worker)s,
+    attempts = attempts + 1,
+    lease_until = now() + %(lease_seconds)s * INTERVAL '1 second',
+    updated_at = now()
+WHERE chunk_id = (
+    SELECT chunk_id
+    FROM load_queue
+    WHERE dataset = %(dataset)s
+      AND (status = 'pending'
+           OR (status = 'claimed' AND lease_until < now() AND attempts - releases < %(max_attempts)s))
+    ORDER BY chunk_id
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING chunk_id, parts, attempts;
+""")
+
+# The updates of a claimed chunk only apply while its worker holds the lease of this attempt
+load_queue_renew = ("""
+UPDATE load_queue
+SET lease_until = now() + %(lease_seconds)s * INTERVAL '1 second', updated_at = now()
+WHERE chunk_id = %(chunk_id)s AND status = 'claimed' AND worker = %(worker)s AND attempts = %(attempt)s;
+""")
+
+load_queue_done = ("""
+UPDATE load_queue
+SET status = 'done', row_counts = %(row_counts)s, lease_until = NULL, updated_at = now()
+WHERE chunk_id = %(chunk_id)s AND status = 'claimed' AND worker = %(worker)s AND attempts = %(attempt)s;
+""")
+
+load_queue_fail = ("""
+UPDATE load_queue
+SET status = 'failed', lease_until = NULL, updated_at = now()
+WHERE chunk_id = %(chunk_id)s AND status = 'claimed' AND worker = %(worker)s AND attempts = %(attempt)s;
+""")
+
+# Gives a chunk back without counting the attempt, e.g. after a deadlock
+load_queue_release = ("""
+UPDATE load_queue
+SET status = CASE WHEN releases + 1 >= %(max_releases)s THEN 'failed' ELSE 'pending' END,
+    releases = releases + 1,
+    worker = NULL,
+    lease_until = NULL,
+    updated_at = now()
+WHERE chunk_id = %(chunk_id)s AND status = 'claimed' AND worker = %(worker)s AND attempts = %(attempt)s;
+""")
+
+load_queue_unfinished = ("""
+SELECT COUNT(*)
+FROM load_queue
+WHERE dataset = %s
+  AND status IN ('pending', 'claimed');
+""")
+
+load_queue_status = ("""
+SELECT dataset, status, COUNT(*), SUM(size), MAX(attempts)
+FROM load_queue
+GROUP BY dataset, status
+ORDER BY dataset, status;
+""")
+
+# Loads the whole catalog for the in-memory song lookup (see song_lookup.py)
+song_lookup_select = ("""
+SELECT song_id, artists.artist_id, title, name, duration
+FROM songs
+JOIN artists
+  ON songs.artist_id = artists.artist_id;
+""")
+
+# ROLLUPS
+
+# The answers are read from the rollups, a bound of None means unbounded
+most_played_songs_select = ("""
+SELECT r.song_id, songs.title, artists.name, SUM(r.plays) AS plays
+FROM songplays_by_song_day r
+JOIN songs
+  ON songs.song_id = r.song_id
+JOIN artists
+  ON artists.artist_id = songs.artist_id
+WHERE
+    r.day >= COALESCE(%s, '-infinity'::date)
+    AND r.day < COALESCE(%s, 'infinity'::date)
+GROUP BY r.song_id, songs.title, artists.name
+ORDER BY plays DESC, r.song_id
+LIMIT %s;
+""")
+
+plays_by_level_select = ("""
+SELECT level, SUM(plays)
+FROM songplays_by_level_hour
+WHERE
+    hour >= COALESCE(%s, '-infinity'::timestamp)
+    AND hour < COALESCE(%s, 'infinity'::timestamp)
+GROUP BY level
+ORDER BY level;
+""")
+
+plays_by_hour_of_day_select = ("""
+SELECT EXTRACT(hour FROM hour)::INT AS hour_of_day, SUM(plays)
+FROM songplays_by_level_hour
+WHERE
+    hour >= COALESCE(%s, '-infinity'::timestamp)
+    AND hour < COALESCE(%s, 'infinity'::timestamp)
+GROUP BY hour_of_day
+ORDER BY hour_of_day;
+""")
+
+plays_by_user_agent_select = ("""
+SELECT browser, os, SUM(plays)
+FROM songplays_by_user_agent
+WHERE
+    day >= COALESCE(%s, '-infinity'::date)
+    AND day < COALESCE(%s, 'infinity'::date)
+GROUP BY browser, os;
+""")
+
+# Recompute the rollups from songplays, start_time is in epoch milliseconds (UTC)
+songplays_by_song_day_rebuild = ("""
+INSERT INTO songplays_by_song_day (song_id, day, plays)
+SELECT song_id, (to_timestamp(start_time / 1000.0) AT TIME ZONE 'UTC')::DATE AS day, COUNT(*)
+FROM songplays
+WHERE song_id IS NOT NULL
+GROUP BY song_id, day;
+""")
+
+songplays_by_level_hour_rebuild = ("""
+INSERT INTO songplays_by_level_hour (hour, level, plays)
+SELECT date_trunc('hour', to_timestamp(start_time / 1000.0) AT TIME ZONE 'UTC') AS hour, level, COUNT(*)
+FROM songplays
+GROUP BY hour, level;
+""")
+
+# The user agents are parsed in python, so they are only aggregated per day and key in the database
+songplays_by_day_and_user_agent_select = ("""
+SELECT plays_by_key.day, user_agents.user_agent, plays_by_key.plays
+FROM (
+    SELECT (to_timestamp(start_time / 1000.0) AT TIME ZONE 'UTC')::DATE AS day, user_agent_id, COUNT(*) AS plays
+    FROM songplays
+    GROUP BY day, user_agent_id
+) plays_by_key
+JOIN user_agents
+  ON user_agents.user_agent_id = plays_by_key.user_agent_id;
+""")
+
 # QUERY LISTS
 
-create_table_queries = [artist_table_create, user_table_create, song_table_create,
-                        time_table_create, songplay_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop,
-                      artist_table_drop, time_table_drop]
+table_properties = [artists_properties, users_properties, songs_properties,
+                    time_properties, locations_properties, user_agents_properties, songplays_properties]
+rollup_properties = [songplays_by_song_day_properties, songplays_by_level_hour_properties,
+                     songplays_by_user_agent_properties]
+
+create_table_queries = [artist_table_create, user_table_create, song_table_create, time_table_create,
+                        location_table_create, user_agent_table_create, songplay_table_create,
+                        load_manifest_table_create, load_queue_table_create]
+create_table_queries += [properties.queries['create_table'] for properties in rollup_properties]
+# Views of the tables and the queries that create them, they are created after the tables
+views = {'songplays_decoded': songplays_decoded_view_create}
+create_view_queries = list(views.values())
+# Every table of the sparkify database, in the order in which they can be created
+all_table_properties = table_properties + [load_manifest_properties, load_queue_properties] + rollup_properties
+
+create_table_deferred_queries = [properties.queries['create_table_deferred'] for properties in all_table_properties]
+create_index_queries = [query for properties in table_properties for query in properties.queries['create_indexes']]
+add_deferred_constraint_queries = [query for properties in table_properties
+                                   for query in properties.queries['add_deferred_constraints']]
+drop_table_queries = [songplays_decoded_view_drop, songplay_table_drop, user_table_drop, song_table_drop,
+                      artist_table_drop, time_table_drop, location_table_drop, user_agent_table_drop,
+                      load_manifest_table_drop, load_queue_table_drop]
+drop_table_queries += [properties.queries['drop_table'] for properties in rollup_properties]
 
 
 if __name__ == '__main__':
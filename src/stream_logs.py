@@ -0,0 +1,109 @@
+import sys
+import time
+import resource
+from itertools import islice
+from typing import Callable, Iterator, List
+
+import pandas as pd
+
+from transform import transform_log_data
+from commit_policy import CommitPolicy
+from instrumentation import metrics, stage
+from typed_json import LOG_DATA_SCHEMA, decode_lines
+
+
+
+def get_peak_rss_mb() -> float:
+    """Returns the peak resident set size of this process in MB."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on linux
+    if sys.platform == 'darwin':
+        return peak_rss / 1024 ** 2
+    return peak_rss / 1024
+
+
+def iter_log_chunks(files: List[str], chunk_size: int) -> Iterator[pd.DataFrame]:
+    """Reads log files in chunks of `chunk_size` lines and yields only the NextSong events.
+
+    Only the fields of LOG_DATA_SCHEMA are decoded, and every chunk is filtered right after
+    decoding, so that the fields and events that are thrown away anyway never pile up.
+    """
+    for filepath in files:
+        with open(filepath, 'rb') as f:
+            while True:
+                start = time.perf_counter()
+                lines = list(islice(f, chunk_size))
+                chunk = decode_lines(lines, LOG_DATA_SCHEMA) if lines else None
+                # the file is read while it is parsed, so both are measured as "parse"
+                metrics.add_time('parse', time.perf_counter() - start)
+                if chunk is None:
+                    break
+                with stage('filter'):
+                    chunk = chunk[chunk['page'] == 'NextSong']
+                if len(chunk.index):
+                    yield chunk
+
+
+def iter_batches(chunks: Iterator[pd.DataFrame], batch_size: int) -> Iterator[pd.DataFrame]:
+    """Regroups chunks into batches of `batch_size` rows (the last batch may be smaller)."""
+    pending = []
+    num_pending = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        num_pending += len(chunk.index)
+        while num_pending >= batch_size:
+            rows = pd.concat(pending, ignore_index=True)
+            yield rows.iloc[:batch_size]
+            rest = rows.iloc[batch_size:]
+            pending = [rest]
+            num_pending = len(rest.index)
+    if num_pending:
+        yield pd.concat(pending, ignore_index=True)
+
+
+def stream_log_data(cur, commit_policy: CommitPolicy, files: List[str], loader: Callable,
+                    batch_size: int = 10000) -> dict:
+    """Streams log files through the loader in batches, flushing every batch before reading on.
+
+    Peak memory is set by `batch_size` and not by the number or size of the files.
+
+    Args:
+        cur: The cursor from the database connection with psycopg2.
+        commit_policy (CommitPolicy): Decides when to commit, every batch is one unit of work.
+        files (List[str]): The paths to the log files.
+        loader (Callable):
+          Takes the cursor and the result of `transform_log_data`, e.g. `etl.load_log_data`.
+        batch_size (int): The number of NextSong events per batch.
+
+    Returns:
+        dict: The number of batches and events, the high-water mark of the memory of one
+          batch and the peak resident set size of the process.
+    """
+    stats = {'batches': 0, 'events': 0, 'max_batch_mb': 0.0}
+    for batch in iter_batches(iter_log_chunks(files, batch_size), batch_size):
+        batch_mb = float(batch.memory_usage(deep=True).sum()) / 1024 ** 2
+        start = time.perf_counter()
+        commit_policy.begin_unit()
+        try:
+            log_data = transform_log_data(batch)
+            row_counts = loader(cur, log_data)
+        except Exception as error:
+            # only the work of this batch is rolled back
+            commit_policy.fail_unit()
+            metrics.record_file(f'batch {stats["batches"] + 1}', time.perf_counter() - start, {}, failed=True)
+            print(f'Failed to load batch {stats["batches"] + 1}: {error}')
+            continue
+        commit_policy.end_unit(row_counts)
+        metrics.record_file(f'batch {stats["batches"] + 1}', time.perf_counter() - start, row_counts)
+
+        stats['batches'] += 1
+        stats['events'] += len(batch.index)
+        stats['max_batch_mb'] = max(stats['max_batch_mb'], batch_mb)
+        print(f'{stats["batches"]} batches ({stats["events"]} events) loaded.')
+
+    commit_policy.end_table()
+    commit_policy.finish()
+    stats['peak_rss_mb'] = get_peak_rss_mb()
+    print(f'High-water mark: {stats["max_batch_mb"]:.2f} MB per batch, '
+          f'{stats["peak_rss_mb"]:.2f} MB peak RSS.')
+    return stats
@@ -0,0 +1,116 @@
+from typing import Dict
+
+import pandas as pd
+
+from instrumentation import stage
+from parallel_extract import read_json_lines
+from scheduler import WorkUnit, read_unit
+from typed_json import LOG_DATA_SCHEMA, SONG_DATA_SCHEMA
+
+
+SONGPLAYS_SOURCE_COLUMNS = ['ts', 'userId', 'level', 'song', 'artist', 'length',
+                            'sessionId', 'location', 'userAgent']
+
+
+def transform_song_data(df_song_data: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """Splits song data into the data for the tables artists and songs.
+
+    Args:
+        df_song_data (pd.DataFrame): Song data as read by `read_json_lines(..., SONG_DATA_SCHEMA)`.
+
+    Returns:
+        Dict[str, pd.DataFrame]:
+          The keys "artists" and "songs", the columns in the order of the insert columns.
+    """
+    artist_data = df_song_data[['artist_id', 'artist_name', 'artist_location',
+                                'artist_latitude', 'artist_longitude']]
+    song_data = df_song_data[['song_id', 'title', 'artist_id', 'year', 'duration']]
+    return {'artists': artist_data, 'songs': song_data}
+
+
+def get_time_data(timestamps: pd.Series) -> pd.DataFrame:
+    """Converts epoch milliseconds into the rows of the time table, one row per distinct timestamp.
+
+    Args:
+        timestamps (pd.Series): The column "ts" of the log data (milliseconds since epoch).
+
+    Returns:
+        pd.DataFrame: The rows of the time table with the columns in the order of the insert columns.
+    """
+    t = pd.to_datetime(timestamps.drop_duplicates(), unit='ms')
+    return pd.DataFrame({'start_time': t,
+                         'hour': t.dt.hour,
+                         'day': t.dt.day,
+                         'week': t.dt.isocalendar().week,
+                         'month': t.dt.month,
+                         'year': t.dt.year,
+                         'weekday': t.dt.weekday})
+
+
+def get_user_data(df_log_data: pd.DataFrame) -> pd.DataFrame:
+    """Reduces the events to the latest state of every user.
+
+    The events are ordered by "ts", so that e.g. a change of the level from free to paid
+    is kept, no matter in which order the events are in the file. The "ts" of the latest
+    event is kept as well, it becomes "last_start_time".
+
+    Args:
+        df_log_data (pd.DataFrame): The NextSong events of the log data.
+
+    Returns:
+        pd.DataFrame: The rows of the users table with the columns in the order of the insert columns.
+    """
+    df_users = df_log_data.sort_values('ts', kind='stable')
+    df_users = df_users[['userId', 'firstName', 'lastName', 'gender', 'level', 'ts']]
+    return df_users.drop_duplicates(subset=['userId'], keep='last')
+
+
+def transform_log_data(df_log_data: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """Filters log data by NextSong and splits it into the data for the tables time and users.
+
+    Args:
+        df_log_data (pd.DataFrame): Log data as read by `read_json_lines(..., LOG_DATA_SCHEMA)`.
+
+    Returns:
+        Dict[str, pd.DataFrame]:
+          The keys "time" and "users" with the columns in the order of the insert columns,
+          and "events" with the columns that are needed to build the songplays.
+    """
+    # filter by NextSong action
+    with stage('filter'):
+        next_song_pages = df_log_data['page'] == 'NextSong'
+        df_log_data = df_log_data[next_song_pages]
+
+    with stage('transform'):
+        # time data records, one row per distinct timestamp
+        df_time = get_time_data(df_log_data['ts'])
+
+        # user records, one row per user with the latest state
+        df_users = get_user_data(df_log_data)
+
+    return {'time': df_time, 'users': df_users, 'events': df_log_data[SONGPLAYS_SOURCE_COLUMNS]}
+
+
+def transform_song_file(filepath: str) -> Dict[str, pd.DataFrame]:
+    """Reads one song file and transforms it with `transform_song_data`."""
+    df_song_file = read_json_lines(filepath, SONG_DATA_SCHEMA)
+    with stage('transform'):
+        return transform_song_data(df_song_file)
+
+
+def transform_log_file(filepath: str) -> Dict[str, pd.DataFrame]:
+    """Reads one log file and transforms it with `transform_log_data`."""
+    df_log_file = read_json_lines(filepath, LOG_DATA_SCHEMA)
+    return transform_log_data(df_log_file)
+
+
+def transform_song_unit(unit: WorkUnit) -> Dict[str, pd.DataFrame]:
+    """Reads all song files of a unit of work at once and transforms them with `transform_song_data`."""
+    df_song_data = read_unit(unit, SONG_DATA_SCHEMA)
+    with stage('transform'):
+        return transform_song_data(df_song_data)
+
+
+def transform_log_unit(unit: WorkUnit) -> Dict[str, pd.DataFrame]:
+    """Reads the log lines of a unit of work and transforms them with `transform_log_data`."""
+    return transform_log_data(read_unit(unit, LOG_DATA_SCHEMA))
@@ -0,0 +1,130 @@
+import json
+import math
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from TableProperties import TableProperties
+from sql_queries import (artists_properties, locations_properties, songplays_properties, songs_properties,
+                         user_agents_properties, users_properties)
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, json of the standard library decodes the same values
+    orjson = None
+
+
+# The data types of TableProperties by the kind of array they are decoded into
+INTEGER_TYPES = ('INT', 'INTEGER', 'BIGINT')
+FLOAT_TYPES = ('DECIMAL', 'NUMERIC', 'DOUBLE PRECISION')
+TEXT_TYPES = ('TEXT',)
+
+# The fields of song_data and the columns that they are loaded into
+SONG_DATA_COLUMNS = {'song_id': (songs_properties, 'song_id'),
+                     'title': (songs_properties, 'title'),
+                     'artist_id': (artists_properties, 'artist_id'),
+                     'artist_name': (artists_properties, 'name'),
+                     'artist_location': (artists_properties, 'location'),
+                     'artist_latitude': (artists_properties, 'latitude'),
+                     'artist_longitude': (artists_properties, 'longitude'),
+                     'year': (songs_properties, 'year'),
+                     'duration': (songs_properties, 'duration')}
+
+# The fields of log_data and the columns that they are loaded into (or looked up in)
+LOG_DATA_COLUMNS = {'ts': (songplays_properties, 'start_time'),
+                    'userId': (users_properties, 'user_id'),
+                    'firstName': (users_properties, 'first_name'),
+                    'lastName': (users_properties, 'last_name'),
+                    'gender': (users_properties, 'gender'),
+                    'level': (users_properties, 'level'),
+                    'song': (songs_properties, 'title'),
+                    'artist': (artists_properties, 'name'),
+                    'length': (songs_properties, 'duration'),
+                    'sessionId': (songplays_properties, 'session_id'),
+                    'location': (locations_properties, 'location'),
+                    'userAgent': (user_agents_properties, 'user_agent')}
+
+
+def get_schema(columns: Dict[str, Tuple[TableProperties, str]],
+               extra_fields: Dict[str, str] = None) -> Dict[str, str]:
+    """Returns the data type of every field from the column it is loaded into, e.g. {'userId': 'INT'}.
+
+    Args:
+        columns (Dict[str, Tuple[TableProperties, str]]): The table and column of every json field.
+        extra_fields (Dict[str, str]): Fields that are not loaded into a column and their data types.
+    """
+    schema = {field: properties.get_column_definitions()[column] for field, (properties, column) in columns.items()}
+    schema.update(extra_fields or {})
+    for field, data_type in schema.items():
+        if data_type.upper() not in INTEGER_TYPES + FLOAT_TYPES + TEXT_TYPES:
+            raise ValueError(f'The field {field} has the data type {data_type}, which can not be decoded.')
+    return schema
+
+
+SONG_DATA_SCHEMA = get_schema(SONG_DATA_COLUMNS)
+# "page" is not loaded, it is only needed to filter by NextSong
+LOG_DATA_SCHEMA = get_schema(LOG_DATA_COLUMNS, {'page': 'TEXT'})
+
+
+def loads(line: bytes) -> dict:
+    """Decodes one json line, with orjson if it is installed."""
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+
+def is_null(value) -> bool:
+    """Returns True for missing values, which are null or "" in the logs (e.g. the userId of a guest)."""
+    return value is None or value == ''
+
+
+def decode_integers(values: list) -> pd.arrays.IntegerArray:
+    """Decodes numbers or strings of digits into a nullable Int64 array, nulls are masked."""
+    mask = np.fromiter((is_null(value) for value in values), dtype=bool, count=len(values))
+    data = np.fromiter((0 if is_null(value) else int(value) for value in values), dtype=np.int64, count=len(values))
+    return pd.arrays.IntegerArray(data, mask)
+
+
+def decode_floats(values: list) -> np.ndarray:
+    """Decodes numbers into a float64 array, nulls become NaN."""
+    return np.fromiter((math.nan if is_null(value) else float(value) for value in values),
+                       dtype=np.float64, count=len(values))
+
+
+def decode_texts(values: list) -> np.ndarray:
+    """Decodes values into an object array of strings, numbers are converted and nulls stay None."""
+    texts = np.empty(len(values), dtype=object)
+    texts[:] = [value if value is None or isinstance(value, str) else str(value) for value in values]
+    return texts
+
+
+def decode_lines(lines: List[bytes], schema: Dict[str, str]) -> pd.DataFrame:
+    """Decodes json lines into a DataFrame with exactly the fields of the schema and their dtypes.
+
+    Fields that are not in the schema are skipped, missing fields are null. Integers become
+    Int64, decimals float64 and texts object columns, the same for every file, no matter which
+    values it contains.
+
+    Args:
+        lines (List[bytes]): The json lines (bytes or str), empty lines are skipped.
+        schema (Dict[str, str]): The data type of every field, e.g. LOG_DATA_SCHEMA.
+    """
+    records = [loads(line) for line in lines if line.strip()]
+    columns = {}
+    for field, data_type in schema.items():
+        values = [record.get(field) for record in records]
+        data_type = data_type.upper()
+        if data_type in INTEGER_TYPES:
+            columns[field] = decode_integers(values)
+        elif data_type in FLOAT_TYPES:
+            columns[field] = decode_floats(values)
+        else:
+            # no inference, the column stays an object column of str and None
+            columns[field] = pd.Series(decode_texts(values), dtype=object)
+    return pd.DataFrame(columns)
+
+
+def decode_text(text: str, schema: Dict[str, str]) -> pd.DataFrame:
+    """Decodes a text with one json object per line, see `decode_lines`."""
+    return decode_lines(text.splitlines(), schema)
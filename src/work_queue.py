@@ -0,0 +1,290 @@
+import os
+import json
+import socket
+import argparse
+import threading
+from typing import Callable, Dict, Iterable, List, NamedTuple
+
+from psycopg2.extras import execute_values
+
+from db import connect
+from discovery import iter_files
+from scheduler import FilePart, WorkUnit, schedule
+from sql_queries import (load_queue_claim, load_queue_count, load_queue_done, load_queue_expire, load_queue_fail,
+                         load_queue_insert, load_queue_lock, load_queue_release, load_queue_renew,
+                         load_queue_status, load_queue_unfinished)
+
+
+STATUS_PENDING = 'pending'
+
+# The directories of the data path, in the order in which they are loaded
+DATASETS = ('song_data', 'log_data')
+
+# The target size of a chunk, smaller than a unit of a single loader, so that the chunks spread over the loaders
+DEFAULT_CHUNK_BYTES = 8 * 1024 ** 2
+# A chunk whose lease is not renewed for this long is claimed by another loader
+DEFAULT_LEASE_SECONDS = 60
+# A killed loader's chunk is retried once
+DEFAULT_MAX_ATTEMPTS = 2
+# A chunk that is given back this often (e.g. after deadlocks) fails
+DEFAULT_MAX_RELEASES = 5
+# How long a loader waits for the chunks of other loaders before it looks again
+DEFAULT_POLL_SECONDS = 1.0
+
+
+class LeaseLostError(Exception):
+    """The lease of a chunk has expired and the chunk may have been claimed by another loader."""
+
+
+class Chunk(NamedTuple):
+    """A claimed unit of work of the queue. `attempt` is the fencing token of the claim."""
+    chunk_id: int
+    unit: WorkUnit
+    attempt: int
+
+    def __str__(self) -> str:
+        return f'chunk {self.chunk_id} ({self.unit})'
+
+
+def get_worker_name() -> str:
+    """Returns the name of this loader in the queue, e.g. "loader-2:4711" (host and process id)."""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class WorkQueue:
+    """Hands out the files of a load in chunks to any number of loader processes, backed by "load_queue".
+
+    The first loader registers the units of `scheduler.schedule` as chunks. Every loader claims
+    the next pending chunk with `FOR UPDATE SKIP LOCKED`, so loaders never wait for each other
+    and no chunk is claimed twice at the same time. A claim is a lease of `lease_seconds`, which
+    `LeaseHeartbeat` renews while the chunk is loaded. The chunk is marked as done in the same
+    transaction as its data. If a loader dies, its transaction is rolled back and its lease
+    expires, then the chunk is claimed again until it has been claimed `max_attempts` times.
+    A chunk that is given back (see `release`) does not count as an attempt, but it fails when
+    it has been given back `max_releases` times.
+
+    Every claim increments "attempts", which fences the updates of a chunk: a loader whose
+    lease has been taken over can not mark the chunk as done, so its data is rolled back.
+    Paths are stored relative to the data path, so loaders on several hosts can mount the
+    data at different places.
+    """
+    def __init__(self, conn, data_path: str = 'data', worker: str = None,
+                 lease_seconds: float = DEFAULT_LEASE_SECONDS, max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 max_releases: int = DEFAULT_MAX_RELEASES):
+        """Instantiate a work queue for one loader.
+
+        Args:
+            conn: The database connection with psycopg2 that loads the chunks.
+            data_path (str): The directory that contains "song_data" and "log_data" on this host.
+            worker (str): The name of this loader. None means `get_worker_name()`.
+            lease_seconds (float): How long a claim is valid without being renewed.
+            max_attempts (int): How often a chunk is claimed before it fails, without the releases.
+            max_releases (int): How often a chunk is given back before it fails.
+        """
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.data_path = data_path
+        self.worker = worker or get_worker_name()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.max_releases = max_releases
+
+    def to_parts(self, unit: WorkUnit) -> str:
+        """Serializes the parts of a unit with paths relative to the data path."""
+        return json.dumps([[os.path.relpath(part.path, self.data_path), part.start, part.end] for part in unit.parts])
+
+    def to_unit(self, parts: list, size: int = 0) -> WorkUnit:
+        """Rebuilds a unit from its serialized parts with the paths of this host."""
+        return WorkUnit([FilePart(os.path.join(self.data_path, path), start, end) for path, start, end in parts], size)
+
+    def register(self, dataset: str, units: Iterable[WorkUnit]) -> int:
+        """Registers the units of a dataset as chunks, unless a loader has registered them already.
+
+        Returns the number of registered chunks, 0 if the dataset has been registered before.
+        """
+        self.cur.execute(load_queue_lock)
+        self.cur.execute(load_queue_count, (dataset,))
+        if self.cur.fetchone()[0] > 0:
+            self.conn.commit()
+            return 0
+        rows = [(dataset, self.to_parts(unit), unit.size, STATUS_PENDING) for unit in units]
+        execute_values(self.cur, load_queue_insert, rows)
+        self.conn.commit()
+        return len(rows)
+
+    def register_files(self, dataset: str, chunk_bytes: int = DEFAULT_CHUNK_BYTES) -> int:
+        """Registers the json files of a directory of the data path, see `register`."""
+        return self.register(dataset, schedule(iter_files(os.path.join(self.data_path, dataset)), chunk_bytes))
+
+    def get_fence(self, chunk: Chunk) -> Dict:
+        """Returns the parameters that identify the claim of a chunk."""
+        return {'chunk_id': chunk.chunk_id, 'worker': self.worker, 'attempt': chunk.attempt}
+
+    def claim(self, dataset: str) -> Chunk:
+        """Claims the next pending (or expired) chunk of a dataset and commits the claim.
+
+        Call it between transactions, it commits the connection. Returns None if no chunk is
+        available right now, which does not mean that the dataset is finished (see `is_finished`).
+        """
+        params = {'dataset': dataset, 'worker': self.worker, 'lease_seconds': self.lease_seconds,
+                  'max_attempts': self.max_attempts}
+        self.cur.execute(load_queue_expire, params)
+        self.cur.execute(load_queue_claim, params)
+        row = self.cur.fetchone()
+        self.conn.commit()
+        if row is None:
+            return None
+        chunk_id, parts, attempt = row
+        return Chunk(chunk_id, self.to_unit(parts), attempt)
+
+    def renew(self, chunk: Chunk, cur=None) -> bool:
+        """Extends the lease of a chunk. Returns False if the lease is not held anymore.
+
+        Args:
+            chunk (Chunk): The claimed chunk.
+            cur: The cursor to renew with, e.g. of the heartbeat connection. None means the queue's cursor.
+        """
+        cur = cur or self.cur
+        cur.execute(load_queue_renew, {'lease_seconds': self.lease_seconds, **self.get_fence(chunk)})
+        return cur.rowcount == 1
+
+    def mark_done(self, chunk: Chunk, row_counts: Dict[str, int]) -> None:
+        """Marks a chunk as done. Call it in the transaction that loads the chunk.
+
+        Raises:
+            LeaseLostError: If the lease has expired, then roll back the data of the chunk.
+        """
+        self.cur.execute(load_queue_done, {'row_counts': json.dumps(row_counts), **self.get_fence(chunk)})
+        if self.cur.rowcount != 1:
+            raise LeaseLostError(f'The lease of {chunk} has expired.')
+
+    def mark_failed(self, chunk: Chunk) -> None:
+        """Marks a chunk as failed, e.g. after an error in its data. It is not claimed again."""
+        self.cur.execute(load_queue_fail, self.get_fence(chunk))
+
+    def release(self, chunk: Chunk) -> None:
+        """Gives a chunk back to the queue without counting the attempt, e.g. after a deadlock.
+
+        The release is counted instead, the chunk fails when it has been given back `max_releases` times.
+        """
+        self.cur.execute(load_queue_release, {'max_releases': self.max_releases, **self.get_fence(chunk)})
+
+    def is_finished(self, dataset: str) -> bool:
+        """Returns True if every chunk of a dataset is done or failed."""
+        self.cur.execute(load_queue_unfinished, (dataset,))
+        num_unfinished = self.cur.fetchone()[0]
+        self.conn.commit()
+        return num_unfinished == 0
+
+    def get_status(self) -> List[tuple]:
+        """Returns (dataset, status, chunks, bytes, max attempts) per dataset and status."""
+        self.cur.execute(load_queue_status)
+        rows = self.cur.fetchall()
+        self.conn.commit()
+        return rows
+
+    def print_status(self) -> None:
+        """Prints the number of chunks and megabytes per dataset and status."""
+        for dataset, status, num_chunks, size, max_attempts in self.get_status():
+            print(f'{dataset:<10} {status:<8} {num_chunks:>6} chunks {int(size) / 1024 ** 2:>9.1f} MB '
+                  f'(at most {max_attempts} attempts)')
+
+
+class LeaseHeartbeat:
+    """Renews the lease of the chunk that is being loaded, from a thread with its own connection.
+
+    The loading connection is busy inside the transaction of the chunk, so the lease is renewed
+    from another connection in autocommit mode every third of the lease. A failed renewal (e.g.
+    a dropped connection) is logged, the connection is opened again and the renewal is retried
+    at the next beat. If the queue refuses a renewal, the lease is lost: `check` tells the
+    loader to give up the chunk. Use it as a context manager around the loop that claims chunks.
+    """
+    def __init__(self, queue: WorkQueue, open_connection: Callable):
+        """Instantiate a heartbeat that has no chunk yet.
+
+        Args:
+            queue (WorkQueue): The queue of the chunks.
+            open_connection (Callable): Opens a connection that is only used by the heartbeat, e.g. `db.connect`.
+        """
+        self.queue = queue
+        self.open_connection = open_connection
+        self.conn = None
+        self.chunk = None
+        self.lost_chunk = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self) -> 'LeaseHeartbeat':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stopped.set()
+        self.thread.join()
+        self.close()
+
+    def hold(self, chunk: Chunk) -> None:
+        """Starts renewing the lease of a chunk, None stops renewing."""
+        with self.lock:
+            self.chunk = chunk
+
+    def check(self, chunk: Chunk) -> None:
+        """Raises LeaseLostError if the queue has refused to renew the lease of a chunk."""
+        with self.lock:
+            if self.lost_chunk is chunk:
+                raise LeaseLostError(f'The lease of {chunk} has been lost.')
+
+    def renew(self, chunk: Chunk) -> None:
+        """Renews the lease of a chunk once and remembers if the lease has been lost."""
+        if self.conn is None or self.conn.closed:
+            self.conn = self.open_connection()
+            self.conn.autocommit = True
+        # a chunk that is being marked as done is locked, the renewal waits for its commit
+        if not self.queue.renew(chunk, self.conn.cursor()):
+            with self.lock:
+                # after the commit of a done chunk the renewal is refused as well, the loader has moved on
+                if self.chunk is chunk:
+                    self.lost_chunk = chunk
+
+    def run(self) -> None:
+        """Renews the lease until the heartbeat is stopped, errors do not stop it."""
+        while not self.stopped.wait(self.queue.lease_seconds / 3):
+            with self.lock:
+                chunk = self.chunk
+            if chunk is None:
+                continue
+            try:
+                self.renew(chunk)
+            except Exception as error:
+                print(f'Failed to renew the lease of {chunk}, retrying: {error}')
+                self.close()
+
+    def close(self) -> None:
+        """Closes the connection of the heartbeat, the next renewal opens a new one."""
+        if self.conn is not None and not self.conn.closed:
+            try:
+                self.conn.close()
+            except Exception as error:
+                print(f'Failed to close the connection of the heartbeat: {error}')
+        self.conn = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Registers and shows the chunks of a coordinated load.')
+    parser.add_argument('--register', action='store_true',
+                        help='Register the files of song_data and log_data as chunks, if they are not registered.')
+    parser.add_argument('--data-path', default='data',
+                        help='The directory that contains "song_data" and "log_data".')
+    parser.add_argument('--chunk-size-mb', type=float, default=DEFAULT_CHUNK_BYTES / 1024 ** 2,
+                        help='The target size of a chunk.')
+    args = parser.parse_args()
+
+    conn = connect()
+    queue = WorkQueue(conn, args.data_path)
+    if args.register:
+        for dataset in DATASETS:
+            num_chunks = queue.register_files(dataset, int(args.chunk_size_mb * 1024 ** 2))
+            print(f'{num_chunks} chunks of {dataset} registered.')
+    queue.print_status()
+    conn.close()